@@ -4,5 +4,8 @@ user=admin
 email=admin@rootara.app
 python /app/scripts/rootara_initial.py --name "${USERNAME:-$user}" --email "${EMAIL:-$email}" --db /data/rootara.db --force False
 
+## 核心库二进制索引，核心库未变化时跳过
+python /app/scripts/rootara_core_index.py --core /app/database/Rootara.core.202404.txt.gz
+
 # FASTAPI启动
 python /app/main.py
@@ -1,20 +1,29 @@
 # coding=utf-8
 import os
 import secrets
-from fastapi import FastAPI, HTTPException, Depends, Header, Response
+from fastapi import FastAPI, HTTPException, Depends, Header, Response, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field, RootModel
 from typing import List, Dict, Any, Union
 
 # 自定义脚本API
 from scripts.rootara_get_user_id import get_user_id                                                  # 获取用户ID
-from scripts.rootara_report_create import create_new_report                                          # 创建新报告
+from scripts.rootara_report_create import create_new_report, resume_report, REPORT_STAGES            # 创建新报告
+from scripts.rootara_jobs import submit_job, get_job, get_job_progress, list_jobs, JobQueueFull       # 后台任务队列
+from scripts.rootara_upload import spool_multipart_upload, UploadError                               # 流式上传
+from scripts.rootara_converter import start_converter_service, stop_converter_service, converter_status  # 常驻转换服务
+from scripts.rootara_pipeline import shutdown_process_pool                                           # 报告创建进程池
+from scripts.rootara_report_state import get_build, list_builds, start_build_sweeper, stop_build_sweeper # 报告创建检查点
+from scripts.rootara_report_batch import batch_create_reports, list_batch_files, ImportPathError, SOURCES, BATCH_CONCURRENCY  # 批量导入
 from scripts.rootara_report_del import delete_report                                                 # 删除报告
 from scripts.rootara_report_set_default import set_default_report                                    # 设置默认报告
-from scripts.rootara_rawdata_export import export_rawdata                                            # 导出原始数据
+from scripts.rootara_rawdata_export import open_rawdata, rawdata_response, RangeNotSatisfiable       # 导出原始数据
 from scripts.rootara_reports_info import *                                                           # 报告信息相关
 from scripts.rootara_table_info import get_snp_info_by_rsid, get_clinvar_data                        # 位点表信息相关
-from scripts.rootara_get_admixture import get_admixture_info                                         # 查询祖源分析信息
+from scripts.rootara_snp_2_db import start_index_migration                                           # 报告表索引补建
+from scripts.rootara_maintenance import start_maintenance, stop_maintenance, maintenance_status       # 数据库后台维护
+from scripts.rootara_get_admixture import get_admixture_info, get_admixture_models                   # 查询祖源分析信息
 from scripts.rootara_get_haplogroup import get_haplogroup_info                                       # 查询单倍群分析信息
 from scripts.rootara_traits import *                                                                 # 查询特征分析信息
 
@@ -35,6 +44,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 启动时运行常驻转换服务、未完成报告的清理、报告表索引的补建和数据库维护，退出时停止服务并关闭进程池
+@app.on_event("startup")
+async def startup_services():
+    start_converter_service()
+    start_build_sweeper(DB_PATH)
+    start_index_migration(DB_PATH)
+    start_maintenance(DB_PATH)
+
+@app.on_event("shutdown")
+async def shutdown_services():
+    stop_converter_service()
+    stop_build_sweeper()
+    stop_maintenance()
+    shutdown_process_pool()
+
 # 设置API密钥 - 从环境变量读取
 API_KEY = os.environ.get("ROOTARA_API_KEY", "rootara_api_key_default_001")  # 生产环境必须设置环境变量
 assert API_KEY, "ROOTARA_API_KEY environment variable must be set"
@@ -65,6 +89,11 @@ class InitDbInput(BaseModel):
 class StatusOutput(BaseModel):
     status_code: int
 
+# 后台任务输出
+class JobOutput(BaseModel):
+    status_code: int
+    job_id: str
+
 # 创建API路由
 DB_PATH = '/data/rootara.db'
 if not os.path.exists('/data'):
@@ -83,46 +112,200 @@ async def api_get_user_id(api_key: str = Depends(verify_api_key)):
 class CreateReportInput(BaseModel):
     user_id: str
     input_data: str
-    source_from: str
+    source_from: str = 'auto'
     report_name: str
     default_report: bool = False
 
-## 创建报告
-@app.post("/report/create", response_model=StatusOutput, tags=["report_create"])
+## 创建报告 || 提交到后台任务队列，立即返回任务ID
+@app.post("/report/create", response_model=JobOutput, tags=["report_create"])
 async def api_create_new_report(input_data: CreateReportInput, api_key: str = Depends(verify_api_key)):
     """
-    Create a new report.
-    """
-    create_new_report(
-        input_data.user_id,
-        input_data.input_data,
-        input_data.source_from,
-        input_data.report_name,
-        DB_PATH,
-        input_data.default_report,
-        False
-    )
-    return StatusOutput(status_code=201)
+    Create a new report in the background, returns the job ID.
+    """
+    try:
+        job_id = submit_job(
+            'report_create',
+            create_new_report,
+            input_data.user_id,
+            input_data.input_data,
+            input_data.source_from,
+            input_data.report_name,
+            DB_PATH,
+            input_data.default_report,
+            False,
+            stages=REPORT_STAGES
+        )
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return JobOutput(status_code=202, job_id=job_id)
+
+## 流式上传原始数据并创建报告
+@app.post("/report/upload", response_model=JobOutput, tags=["report_create"])
+async def api_upload_new_report(request: Request, api_key: str = Depends(verify_api_key)):
+    """
+    Upload a raw data file as multipart/form-data and create a new report in the background.
+    Form fields: file, user_id, source_from (optional, detected from the file when omitted or 'auto'), report_name, default_report.
+    """
+    try:
+        fields, spool_path = await spool_multipart_upload(request)
+    except UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    missing = [name for name in ('user_id', 'report_name') if not fields.get(name)]
+    if missing:
+        os.remove(spool_path)
+        raise HTTPException(status_code=400, detail=f"缺少表单字段: {', '.join(missing)}")
+    default_report = fields.get('default_report', 'false').lower() in ('true', '1', 'yes')
+
+    try:
+        job_id = submit_job(
+            'report_create',
+            create_new_report,
+            fields['user_id'],
+            spool_path,
+            fields.get('source_from') or 'auto',
+            fields['report_name'],
+            DB_PATH,
+            default_report,
+            False,
+            move_input=True,
+            stages=REPORT_STAGES
+        )
+    except JobQueueFull as e:
+        os.remove(spool_path)
+        raise HTTPException(status_code=429, detail=str(e))
+    return JobOutput(status_code=202, job_id=job_id)
+
+# 批量导入的请求模型，inputs为导入目录（ROOTARA_IMPORT_DIR）中的文件或目录路径
+class BatchReportInput(BaseModel):
+    user_id: str
+    inputs: List[str]
+    source_from: str = 'auto'
+    concurrency: int = BATCH_CONCURRENCY
+
+## 批量导入原始数据 || 整批作为一个后台任务，每个文件的状态在任务的stages中
+@app.post("/report/batch", response_model=JobOutput, tags=["report_create"])
+async def api_batch_create_reports(batch: BatchReportInput, api_key: str = Depends(verify_api_key)):
+    """
+    Create reports for many raw files with bounded concurrency.
+    Inputs must be files or directories inside the server's import directory (ROOTARA_IMPORT_DIR),
+    given as absolute paths or relative to it. The job result lists the outcome of every file.
+    """
+    if batch.source_from not in SOURCES:
+        raise HTTPException(status_code=400, detail=f"不支持的数据来源: {batch.source_from}")
+    if not 1 <= batch.concurrency <= BATCH_CONCURRENCY:
+        raise HTTPException(status_code=400, detail=f"concurrency必须在1到{BATCH_CONCURRENCY}之间")
+    try:
+        files = list_batch_files(batch.inputs)
+    except ImportPathError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not files:
+        raise HTTPException(status_code=400, detail="没有需要导入的文件")
+    try:
+        job_id = submit_job(
+            'report_batch',
+            batch_create_reports,
+            batch.user_id,
+            files,
+            batch.source_from,
+            DB_PATH,
+            batch.concurrency,
+            stages=files
+        )
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return JobOutput(status_code=202, job_id=job_id)
+
+## 列出未完成的报告创建
+@app.post("/report/builds", tags=["report_create"])
+async def api_list_report_builds(api_key: str = Depends(verify_api_key)):
+    """
+    List unfinished report builds with their per-stage state.
+    """
+    return list_builds(DB_PATH)
+
+## 重试创建失败的报告，从第一个未完成的阶段继续
+@app.post("/report/{report_id}/retry", response_model=JobOutput, tags=["report_create"])
+async def api_retry_report(report_id: str, api_key: str = Depends(verify_api_key)):
+    """
+    Resume a failed report build from its first incomplete stage, returns the job ID.
+    """
+    build = get_build(DB_PATH, report_id)
+    if build is None:
+        raise HTTPException(status_code=404, detail="报告创建记录不存在")
+    if build['active']:
+        raise HTTPException(status_code=409, detail="报告正在创建中")
+    try:
+        job_id = submit_job('report_retry', resume_report, report_id, DB_PATH, stages=REPORT_STAGES)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return JobOutput(status_code=202, job_id=job_id)
+
+## 列出后台任务
+@app.post("/jobs", tags=["jobs"])
+async def api_list_jobs(api_key: str = Depends(verify_api_key)):
+    """
+    List background jobs.
+    """
+    return list_jobs()
+
+## 查询后台任务状态
+@app.post("/jobs/{job_id}", tags=["jobs"])
+async def api_get_job(job_id: str, api_key: str = Depends(verify_api_key)):
+    """
+    Get job status.
+    """
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+## 查询后台任务进度
+@app.post("/jobs/{job_id}/progress", tags=["jobs"])
+async def api_get_job_progress(job_id: str, api_key: str = Depends(verify_api_key)):
+    """
+    Get job progress and the running stage.
+    """
+    progress = get_job_progress(job_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return progress
+
+## 查询转换服务状态
+@app.post("/converter/status", tags=["jobs"])
+async def api_converter_status(api_key: str = Depends(verify_api_key)):
+    """
+    Get converter service status.
+    """
+    return converter_status()
+
+## 查询数据库维护状态
+@app.post("/maintenance/status", tags=["jobs"])
+async def api_maintenance_status(api_key: str = Depends(verify_api_key)):
+    """
+    Get database space usage and background maintenance progress.
+    """
+    return maintenance_status(DB_PATH)
 
 ## 导出原始数据
 @app.post("/report/{report_id}/rawdata", tags=["report_rawdata"])
-async def api_export_rawdata(report_id: str, api_key: str = Depends(verify_api_key)):
+async def api_export_rawdata(report_id: str, request: Request, api_key: str = Depends(verify_api_key)):
     """
-    Export raw data.
+    Export raw data. Streams the stored file; supports gzip passthrough and Range requests.
     """
-    filename, file_content = export_rawdata(report_id)
-
-    if filename is None or file_content is None:
+    rawdata = open_rawdata(report_id, DB_PATH)
+    if rawdata is None:
         raise HTTPException(status_code=404, detail="原始数据文件不存在或无法读取")
 
-    # 返回文件内容作为响应
-    return Response(
-        content=file_content,
-        media_type="text/plain",
-        headers={
-            "Content-Disposition": f"attachment; filename={filename}"
-        }
-    )
+    try:
+        status_code, headers, content = rawdata_response(rawdata, request.headers.get("accept-encoding"), request.headers.get("range"))
+    except RangeNotSatisfiable:
+        raise HTTPException(status_code=416, detail="请求的范围超出文件大小", headers={"Content-Range": f"bytes */{rawdata['size']}"})
+
+    # 按块发送文件内容
+    return StreamingResponse(content, status_code=status_code, media_type="text/plain", headers=headers)
 
 ## 设置默认报告
 @app.post("/report/default", response_model=StatusOutput, tags=["report_default"])
@@ -189,16 +372,27 @@ async def api_get_all_report_info(api_key: str = Depends(verify_api_key)):
 
 ## 查询祖源分析结果 - 从GET改为POST
 @app.post("/report/{report_id}/admixture", tags=["admixture_info"])
-async def api_get_admixture_info(report_id: str, api_key: str = Depends(verify_api_key)):
+async def api_get_admixture_info(report_id: str, model: str = "K47", api_key: str = Depends(verify_api_key)):
     """
-    Admixture query.
+    Admixture query, `model` selects the admixture calculator (default K47).
     """
     try:
-        result = get_admixture_info(report_id, DB_PATH)
+        result = get_admixture_info(report_id, DB_PATH, model)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询祖源分析结果失败: {str(e)}")
 
+## 查询报告已有结果的祖源模型
+@app.post("/report/{report_id}/admixture/models", tags=["admixture_info"])
+async def api_get_admixture_models(report_id: str, api_key: str = Depends(verify_api_key)):
+    """
+    Admixture models available for a report.
+    """
+    try:
+        return {"models": get_admixture_models(report_id, DB_PATH)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"查询祖源模型失败: {str(e)}")
+
 ## 查询单倍群结果 - 从GET改为POST
 @app.post("/report/{report_id}/haplogroup", tags=["haplogroup_info"])
 async def api_get_haplogroup_info(report_id: str, api_key: str = Depends(verify_api_key)):
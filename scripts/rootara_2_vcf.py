@@ -3,64 +3,188 @@
 # 20250423
 # 用于把rootara生成的csv结果文件转换为vcf格式
 # 仅保留SNP
-# vcf文件用于单倍群计算
+# vcf文件用于单倍群计算；已导入的报告也可以按报告编号导出
 
+import os
 import sys
+import numpy as np
 import pandas as pd
 import pysam
+from pysam.libcbgzf import BGZFile
 import argparse
 
-def trans_rootara_to_vcf(rootara_csv, vcf_file):
-    # 首先生成临时VCF文件
-    if vcf_file.endswith('.vcf.gz'):
-        vcf_file = vcf_file.replace('.vcf.gz', '.vcf')
-
-    temp_vcf = vcf_file.replace('.vcf', '_temp.vcf')
-    with open(temp_vcf, 'w', encoding='utf-8') as f:
-        f.write('##fileformat=VCFv4.2\n')
-        f.write('##source=rootara\n')
-        f.write('##reference=GRCh37\n')
-        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tRootara\n')
-
-        df = pd.read_csv(rootara_csv, sep=',', header=0, low_memory=False)
-        df_filter = df[df['Check'] != 'WT']
-        df_filter = df_filter[~df_filter['Genotype'].isin(['DD', 'II', 'DI', 'ID', '--'])]
-
-        for i, row in df_filter.iterrows():
-            chrom = row['Chrom']
-            pos = row['Start']
-            ref = row['Ref']
-            alt = row['Alt']
-            genotype = row['Check']
-
-            gt = '0/0'
-            if genotype == 'HET':
-                gt = '0/1'
-            elif genotype == 'HOM':
-                gt = '1/1'
-
-            f.write('{}\t{}\t.\t{}\t{}\t.\tPASS\t.\tGT\t{}\n'.format(str(chrom), str(pos), ref, alt, gt))
-    
-    # 使用pysam将VCF压缩为vcf.gz并创建索引
-    pysam.tabix_compress(temp_vcf, vcf_file + '.gz', force=True)
-    pysam.tabix_index(vcf_file + '.gz', preset='vcf', force=True)
-    
-    # 删除临时文件
-    import os
-    os.remove(temp_vcf)
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_columnar import load_columns
+    from scripts.rootara_db import connect, attach_report
+    from scripts.rootara_genotype_store import open_packed_genotypes
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_columnar import load_columns
+    from scripts.rootara_db import connect, attach_report
+    from scripts.rootara_genotype_store import open_packed_genotypes
+
+VCF_HEADER = (
+    '##fileformat=VCFv4.2\n'
+    '##source=rootara\n'
+    '##reference=GRCh37\n'
+    '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tRootara\n'
+)
+
+# 插入缺失的基因型不写入VCF
+INDEL_GENOTYPES = ['DD', 'II', 'DI', 'ID', '--']
+
+# 每次格式化并压缩写入的行数
+BLOCK_SIZE = 100000
+
+# 单倍群分析只需要的染色体
+HAPLOGROUP_CHROMS = {'y': 'Y', 'mt': 'MT'}
+
+# 需要写入VCF的位点：非野生型的SNP，可以只保留指定的染色体
+def vcf_row_mask(chrom, check, genotype, chroms=None):
+    mask = (pd.Series(check) != 'WT') & ~pd.Series(genotype).isin(INDEL_GENOTYPES)
+    if chroms is not None:
+        mask &= pd.Series(chrom).isin([str(c) for c in chroms])
+    return mask.to_numpy()
+
+def read_rootara_result(rootara_data, chroms=None, positions=None):
+    """
+    读取转换结果中需要写入VCF的位点
+    列存储目录先用字典编码的列筛选位点，只解码保留下来的行
+    :param rootara_data: 转换结果的列存储目录或CSV文件
+    :param chroms: 只保留的染色体列表，默认全部
+    :param positions: 只保留的位置集合，默认全部
+    :return: DataFrame，包含Chrom、Start、Ref、Alt、Check列
+    """
+    if os.path.isdir(rootara_data):
+        columns, _ = load_columns(rootara_data)
+        check = columns['Check'].decode()
+        mask = vcf_row_mask(columns['Chrom'].decode(), check, columns['Genotype'].decode(), chroms)
+        if positions is not None:
+            mask = mask & np.isin(np.asarray(columns['Start']), np.fromiter(positions, dtype=np.int64))
+        rows = np.flatnonzero(mask)
+        return pd.DataFrame({
+            'Chrom': columns['Chrom'].decode(rows),
+            'Start': np.asarray(columns['Start'])[rows],
+            'Ref': columns['Ref'].decode(rows),
+            'Alt': columns['Alt'].decode(rows),
+            'Check': check[rows]
+        })
+    df = pd.read_csv(rootara_data, sep=',', header=0, dtype={'Chrom': str}, low_memory=False)
+    mask = vcf_row_mask(df['Chrom'], df['Check'], df['Genotype'], chroms)
+    if positions is not None:
+        mask = mask & df['Start'].isin(positions).to_numpy()
+    df = df[mask]
+    return df[['Chrom', 'Start', 'Ref', 'Alt', 'Check']].reset_index(drop=True)
+
+def read_report_sites(report_id, db_path, chroms=None):
+    """
+    读取已导入的报告中需要写入VCF的位点，优先使用压缩的基因型，未启用或不可用时读取报告表
+    :param chroms: 只保留的染色体列表，默认全部
+    :return: DataFrame，包含Chrom、Start、Ref、Alt、Check列，按染色体、位置排序
+    """
+    packed = open_packed_genotypes(report_id)
+    if packed is not None:
+        df = packed.dataframe(chroms, alleles=True)
+    else:
+        conn = connect(db_path)
+        try:
+            attach_report(conn, report_id)
+            df = pd.read_sql_query(f'''
+                SELECT chromosome AS Chrom, position AS Start, ref AS Ref, alt AS Alt, genotype AS Genotype, gt AS "Check"
+                FROM "{report_id}"
+            ''', conn)
+        finally:
+            conn.close()
+    df = df[vcf_row_mask(df['Chrom'].astype(str), df['Check'], df['Genotype'], chroms)]
+    # 压缩的基因型中无法编码的位点在最后，排序后tabix才能建立索引
+    df = df.sort_values(['Chrom', 'Start'], kind='stable')
+    return df[['Chrom', 'Start', 'Ref', 'Alt', 'Check']].reset_index(drop=True)
+
+def trans_rootara_to_vcf(rootara_data, vcf_file, chroms=None, positions=None, block_size=BLOCK_SIZE):
+    """
+    :param rootara_data: 转换结果的列存储目录或CSV文件
+    :param vcf_file: 输出的vcf.gz文件
+    :param chroms: 只写入的染色体列表，默认全部
+    :param positions: 只写入的位置集合，默认全部
+    :return: vcf.gz文件路径
+    """
+    return write_vcf(read_rootara_result(rootara_data, chroms, positions), vcf_file, block_size)
+
+def trans_report_to_vcf(report_id, db_path, vcf_file, chroms=None, block_size=BLOCK_SIZE):
+    """
+    导出已导入的报告，位点见read_report_sites
+    :return: vcf.gz文件路径
+    """
+    return write_vcf(read_report_sites(report_id, db_path, chroms), vcf_file, block_size)
+
+def write_vcf(df, vcf_file, block_size=BLOCK_SIZE):
+    """
+    按块格式化VCF内容，直接写入BGZF压缩文件，不生成临时文件
+    tabix索引不是在写入的同一遍中建立的：写入完成后由pysam.tabix_index再读取一遍压缩文件建立，
+    保证.tbi与htslib生成的一致，这一遍只需要几毫秒
+    :param df: 包含Chrom、Start、Ref、Alt、Check列的DataFrame
+    :return: vcf.gz文件路径
+    """
+    if not vcf_file.endswith('.gz'):
+        vcf_file = vcf_file + '.gz'
+
+    chrom = df['Chrom'].astype(str).tolist()
+    pos = df['Start'].astype(str).tolist()
+    ref = df['Ref'].tolist()
+    alt = df['Alt'].tolist()
+    gt = np.select([df['Check'] == 'HET', df['Check'] == 'HOM'], ['0/1', '1/1'], '0/0').tolist()
+
+    with BGZFile(vcf_file, 'wb') as f:
+        f.write(VCF_HEADER.encode('utf-8'))
+        for start in range(0, len(df), block_size):
+            end = start + block_size
+            block = zip(chrom[start:end], pos[start:end], ref[start:end], alt[start:end], gt[start:end])
+            f.write(''.join(f'{c}\t{p}\t.\t{r}\t{a}\t.\tPASS\t.\tGT\t{g}\n' for c, p, r, a, g in block).encode('utf-8'))
+
+    # 索引由htslib读取压缩文件建立
+    pysam.tabix_index(vcf_file, preset='vcf', force=True)
+    return vcf_file
+
+def trans_rootara_to_haplogroup_vcf(rootara_data, out_prefix, loci=None):
+    """
+    单倍群模式：分别生成只包含Y染色体和线粒体位点的VCF
+    :param rootara_data: 转换结果的列存储目录或CSV文件
+    :param out_prefix: 输出文件前缀，生成 <前缀>.Y.vcf.gz 和 <前缀>.MT.vcf.gz
+    :param loci: {'y': 位置集合, 'mt': 位置集合}，只保留单倍群树中用到的位点，缺少或为None时保留整条染色体
+    :return: {'y': Y染色体VCF, 'mt': 线粒体VCF}
+    """
+    loci = loci or {}
+    vcf_files = {}
+    for name, chrom in HAPLOGROUP_CHROMS.items():
+        vcf_files[name] = trans_rootara_to_vcf(rootara_data, f'{out_prefix}.{chrom}.vcf.gz', [chrom], loci.get(name))
+    return vcf_files
 
 def main():
     parser = argparse.ArgumentParser(description='转换CSV结果到VCF')
-    parser.add_argument('--input', type=str, help='输入CSV文件')
+    parser.add_argument('--input', type=str, help='输入CSV文件或列存储目录')
+    parser.add_argument('--id', type=str, help='报告编号，与--db一起使用时导出已导入的报告')
+    parser.add_argument('--db', type=str, help='数据库文件')
     parser.add_argument('--output', type=str, help='输出VCF.gz文件')
+    parser.add_argument('--chroms', type=str, help='只写入的染色体，逗号分隔，默认全部')
+    parser.add_argument('--haplogroup', action='store_true', help='单倍群模式，output作为前缀分别输出Y和MT的VCF')
     args = parser.parse_args()
 
     # 检查是否提供了所有必需参数
-    if not all([args.input, args.output]):
+    if not args.output or not (args.input or (args.id and args.db)):
         parser.print_help()
         sys.exit(1)
 
-    trans_rootara_to_vcf(args.input, args.output)
+    chroms = args.chroms.split(',') if args.chroms else None
+    if not args.input:
+        trans_report_to_vcf(args.id, args.db, args.output, chroms)
+        return
+    if args.haplogroup:
+        trans_rootara_to_haplogroup_vcf(args.input, args.output)
+        return
+    trans_rootara_to_vcf(args.input, args.output, chroms)
 
 if __name__ == '__main__':
     main()
@@ -6,13 +6,67 @@
 # 模型参考 https://dnagenics.com/products/admixturecalculators
 
 import os
+import sys
 import tempfile
 import sqlite3
 import argparse
 import shutil
+import subprocess
 
-# admix运行，可能会占用较高的计算资源
-def admix_cli(input_file, rpt_id, method):
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_admixture_engine import (ADMIX_MODELS, ReportGenotypes, admixture_engine_available,
+                                                  compute_admixture_inprocess, load_admixture_model,
+                                                  population_column, read_raw_genotypes)
+    from scripts.rootara_db import connect
+    from scripts.rootara_parsers import is_gzip, iter_records
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_admixture_engine import (ADMIX_MODELS, ReportGenotypes, admixture_engine_available,
+                                                  compute_admixture_inprocess, load_admixture_model,
+                                                  population_column, read_raw_genotypes)
+    from scripts.rootara_db import connect
+    from scripts.rootara_parsers import is_gzip, iter_records
+
+# 祖源分析方式：inprocess 在进程内计算（见rootara_admixture_engine），admix 每次运行admix命令行
+# 进程内计算与admix读取相同的位点，模型文件无法加载时回退到admix
+ADMIX_ENGINE = os.environ.get('ROOTARA_ADMIX_ENGINE', 'inprocess')
+
+# --check 时每个成分允许的最大差异（百分点）
+# admix的SLSQP在tol=1e-3时停止，进程内计算求解到收敛，在admix自带的23andme示例数据上5个模型的最大差异为0.17
+CHECK_TOLERANCE = float(os.environ.get('ROOTARA_ADMIX_CHECK_TOLERANCE', '0.5'))
+
+# admix可以直接读取的数据来源（-v参数），其余来源（vcf、myheritage、ftdna）或gzip压缩的文件
+# 先用rootara_parsers解析，写成23andme格式的临时文件再交给admix
+ADMIX_VENDORS = ['23andme', 'ancestry', 'wegene']
+
+class AdmixError(Exception):
+    """admix运行失败或没有输出结果"""
+    pass
+
+# 祖源分析结果，每个模型的每个成分一行
+ADMIXTURE_RESULT_SQL = '''
+CREATE TABLE IF NOT EXISTS admixture_result (
+    report_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    component TEXT NOT NULL,
+    value REAL DEFAULT 0.00,
+    PRIMARY KEY (report_id, model, component)
+)
+'''
+
+# 转换为23andme格式：rsid 染色体 位置 基因型，制表符分隔
+def write_admix_input(input_file, method, output_file):
+    with open(output_file, 'w') as f:
+        f.write('# rsid\tchromosome\tposition\tgenotype\n')
+        for records in iter_records(input_file, method):
+            records.to_csv(f, sep='\t', header=False, index=False)
+    return output_file
+
+# admix运行，可能会占用较高的计算资源，一次运行可以计算多个模型
+def admix_cli(input_file, rpt_id, method, models=ADMIX_MODELS):
     input_file = os.path.abspath(input_file)
     
     # 创建一个固定的临时目录
@@ -22,99 +76,162 @@ def admix_cli(input_file, rpt_id, method):
     
     # 使用固定目录创建临时目录
     temp_dir = tempfile.mkdtemp(dir=temp_base_dir)
-    
-    cmd = f'admix -f {input_file} -v {method} -m K47 > {temp_dir}/{rpt_id}.admix.txt'
-    os.system(cmd)
-    return f'{temp_dir}/{rpt_id}.admix.txt'
+    result_file = f'{temp_dir}/{rpt_id}.admix.txt'
+
+    try:
+        if method not in ADMIX_VENDORS or is_gzip(input_file):
+            input_file = write_admix_input(input_file, method, f'{temp_dir}/{rpt_id}.23andme.txt')
+            method = '23andme'
+
+        cmd = ['admix', '-f', input_file, '-v', method, '-m'] + list(models)
+        with open(result_file, 'w') as f:
+            process = subprocess.run(cmd, stdout=f, stderr=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            raise AdmixError(f"admix运行失败，返回状态码: {process.returncode}，{process.stderr.strip()[-500:]}")
+    except Exception:
+        shutil.rmtree(temp_dir)
+        raise
+    return result_file
 
-# 解析admix结果
-def parse_admix_result(admix_file):
+# 解析admix结果，返回 {模型: {祖源成分: 比例}}
+def parse_admix_result(admix_file, models=ADMIX_MODELS):
     admix_file = os.path.abspath(admix_file)
     with open(admix_file, 'r') as f:
         lines = f.readlines()
 
-    ances_dict = {}
-    begin = False
+    results = {}
+    model = None
     for line in lines:
         if line == "\n":
             continue
-        if 'K47' in line:
-            begin = True
-            continue
         if line.startswith('Calcuation'):
             continue
-        if begin:
+        # 比例行为 成分: xx.xx%，其他包含模型名称的行为该模型结果的开始
+        if '%' not in line:
+            names = [name for name in models if name in line]
+            if names:
+                model = names[0]
+                results[model] = {}
+            continue
+        if model is not None:
             line = line.strip()
             line = line.split(': ')
-            ances_dict[line[0].replace('-', '_')] = float(line[1].replace('%', ''))
+            results[model][line[0].replace('-', '_')] = float(line[1].replace('%', ''))
+
+    return results
 
-    return ances_dict
+def ensure_admixture_result_table(conn):
+    conn.execute(ADMIXTURE_RESULT_SQL)
 
-# 结果导入数据库
-def import_result_to_db(ances_dict, rpt_id, db_path):
+# 结果导入数据库，已有的同一报告同一模型的结果会被替换
+def import_result_to_db(results, rpt_id, db_path):
+    """
+    :param results: {模型: {祖源成分: 比例}}
+    """
     db_path = os.path.abspath(db_path)
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    conn = connect(db_path)
+    try:
+        ensure_admixture_result_table(conn)
+        with conn:
+            for model, ances_dict in results.items():
+                conn.execute("DELETE FROM admixture_result WHERE report_id = ? AND model = ?", (rpt_id, model))
+                conn.executemany(
+                    "INSERT INTO admixture_result (report_id, model, component, value) VALUES (?, ?, ?, ?)",
+                    [(rpt_id, model, component, value) for component, value in ances_dict.items()]
+                )
+    finally:
+        conn.close()
 
-    # 获取表结构信息
-    cursor.execute("PRAGMA table_info(admixture)")
-    columns = [column[1] for column in cursor.fetchall()]
-    
-    # 准备SQL语句的列名和占位符部分
-    valid_columns = ['report_id']
-    values = [rpt_id]
-    
-    # 检查每个祖源成分是否在表结构中存在
-    for ances, ratio in ances_dict.items():
-        if ances in columns:
-            valid_columns.append(ances)
-            values.append(ratio)
-        else:
-            print(f"警告: 祖源成分 '{ances}' 在数据表结构中不存在，已忽略")
-    
-    # 构建SQL语句
-    columns_str = ", ".join(valid_columns)
-    placeholders = ", ".join(["?" for _ in valid_columns])
-    
-    # 执行插入
-    sql = f"INSERT INTO admixture ({columns_str}) VALUES ({placeholders})"
-    cursor.execute(sql, values)
-    
-    # 提交并关闭连接
-    conn.commit()
-    conn.close()
+# 运行admix并解析结果，不写入数据库
+# admix遇到不支持的格式或模型时只打印提示并以状态码0退出，缺少模型结果时同样报错
+def compute_admixture(input_file, rpt_id, method, models=ADMIX_MODELS):
+    admix_file = admix_cli(input_file, rpt_id, method, models)
+    try:
+        results = parse_admix_result(admix_file, models)
+        missing = [model for model in models if not results.get(model)]
+        if missing:
+            with open(admix_file, 'r') as f:
+                output = f.read().strip()
+            raise AdmixError(f"admix没有输出模型 {', '.join(missing)} 的结果: {output[-500:]}")
+        return results
+    finally:
+        shutil.rmtree(os.path.dirname(admix_file))
+
+def use_admixture_engine(models=ADMIX_MODELS):
+    return ADMIX_ENGINE == 'inprocess' and admixture_engine_available(models)
 
-# 完整流程
-def data_to_sqlite(input_file, rpt_id, method, db_path, force=False):
+# 报告创建时使用：进程内计算直接读取原始文件，不依赖格式转换；不可用时运行admix
+def compute_report_admixture(input_file, rpt_id, method, models=ADMIX_MODELS):
+    if use_admixture_engine(models):
+        rsids, genotypes = read_raw_genotypes(input_file, method)
+        return compute_admixture_inprocess(rsids, genotypes, models)
+    return compute_admixture(input_file, rpt_id, method, models)
+
+# 完整流程，只计算数据库中还没有结果的模型
+def data_to_sqlite(input_file, rpt_id, method, db_path, force=False, models=ADMIX_MODELS):
     # 检查数据库中是否已经存在该报告的祖源分析结果
     db_path = os.path.abspath(db_path)
     conn = sqlite3.connect(db_path)
+    ensure_admixture_result_table(conn)
     cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM admixture WHERE report_id=?", (rpt_id,))
-    result_count = cursor.fetchone()[0]
+    cursor.execute("SELECT DISTINCT model FROM admixture_result WHERE report_id=?", (rpt_id,))
+    existing = {row[0] for row in cursor.fetchall()}
     conn.close()
 
-    if result_count > 0 and not force:
+    if not force:
+        models = [model for model in models if model not in existing]
+    if not models:
         print(f"报告 {rpt_id} 的祖源分析结果已存在于数据库中，跳过该报告")
         return
     
-    admix_file = admix_cli(input_file, rpt_id, method)
-    ances_dict = parse_admix_result(admix_file)
-    import_result_to_db(ances_dict, rpt_id, db_path)
-    print(f"报告 {rpt_id} 的祖源分析结果已导入数据库")
-    shutil.rmtree(os.path.dirname(admix_file))
+    results = compute_report_admixture(input_file, rpt_id, method, models)
+    import_result_to_db(results, rpt_id, db_path)
+    print(f"报告 {rpt_id} 的祖源分析结果已导入数据库，模型: {', '.join(results)}")
+
+def check_admixture_engine(input_file, method, models=ADMIX_MODELS, tolerance=CHECK_TOLERANCE):
+    """
+    对比进程内计算与admix在同一原始文件上的结果
+    :param input_file: 原始文件
+    :param method: 数据来源
+    :return: 差异超过tolerance的成分列表 [(模型, 成分, admix, 进程内)]
+    """
+    expected = compute_admixture(input_file, 'CHECK', method, models)
+    report = ReportGenotypes(*read_raw_genotypes(input_file, method))
+    mismatches = []
+    for model in models:
+        engine_model = load_admixture_model(model)
+        q, used, iterations = engine_model.fit(report)
+        actual = {population_column(name): round(float(ratio) * 100, 2) for name, ratio in zip(engine_model.populations, q)}
+        reference = {population_column(name): value for name, value in expected.get(model, {}).items()}
+        largest = max((abs(reference[name] - actual[name]) for name in reference if name in actual), default=0)
+        print(f"{model}: 使用 {used}/{len(engine_model.snps)} 个模型位点，迭代 {iterations} 次，最大差异 {largest:.2f}")
+        for component in sorted(set(reference) | set(actual)):
+            if component not in reference or component not in actual \
+                    or abs(reference[component] - actual[component]) > tolerance:
+                mismatches.append((model, component, reference.get(component), actual.get(component)))
+
+    for model, component, reference, actual in mismatches:
+        print(f"不一致 [{model}] {component}: admix {reference}，进程内 {actual}")
+    print(f"检查 {len(models)} 个模型，差异超过 {tolerance} 个百分点的成分 {len(mismatches)} 个")
+    return mismatches
 
 def main():
     parser = argparse.ArgumentParser(description='Process input file and report ID.')
     parser.add_argument('--input', type=str, required=True, help='Path to the input file')
-    parser.add_argument('--rpt_id', type=str, required=True, help='Report ID')
+    parser.add_argument('--rpt_id', type=str, help='Report ID')
     parser.add_argument('--method', type=str, required=True, help='Source of data')
-    parser.add_argument('--db_path', type=str, required=True, help='Path to the SQLite database')
+    parser.add_argument('--db_path', type=str, help='Path to the SQLite database')
+    parser.add_argument('--models', type=str, help='Comma separated admixture models', default=','.join(ADMIX_MODELS))
     parser.add_argument('--force', help='Force overwrite existing results, default=False', default=False)
+    parser.add_argument('--check', action='store_true', help='Compare the in-process engine with admix on --input')
     args = parser.parse_args()
 
-    data_to_sqlite(args.input, args.rpt_id, args.method, args.db_path, args.force)
+    if args.check:
+        sys.exit(1 if check_admixture_engine(args.input, args.method, args.models.split(',')) else 0)
+    if not args.rpt_id or not args.db_path:
+        parser.error('--rpt_id and --db_path are required')
+
+    data_to_sqlite(args.input, args.rpt_id, args.method, args.db_path, args.force, args.models.split(','))
 
 if __name__ == "__main__":
     main()
-
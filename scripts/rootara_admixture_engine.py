@@ -0,0 +1,319 @@
+# coding=utf-8
+# pzw
+# 进程内的祖源分析
+# 每个进程只加载一次admix模型的位点与参考群体等位基因频率矩阵，之后直接使用报告中的基因型计算
+# 不需要为每个报告启动admix命令行，也不需要解析文本输出
+
+"""
+计算方法（与admix相同的模型）：
+- 模型文件 <模型>.alleles 每行为 位点 次要等位基因 主要等位基因，<模型>.<群体数>.F 为各参考群体的主要等位基因频率
+- 每个位点统计报告基因型中主要、次要等位基因的个数 g_major、g_minor
+- 对祖源比例q（非负、和为1）最大化 Σ g_major·log(F·q) + g_minor·log((1-F)·q)
+- 使用EM迭代求解，每次迭代为两次矩阵向量乘法，并用SQUAREM外推加速收敛
+
+与admix使用相同的位点：
+- 基因型从原始文件读取（rootara_parsers解析），不经过核心库匹配
+- 与admix读取原始文件的规则相同：只使用最后一个字符为A/C/G/T的基因型，同一位点编号出现多次时保留最后一次，
+  基因型的第一个和最后一个字符各计一个等位基因（单碱基的半合子基因型计两次）
+- admix使用SLSQP（tol=1e-3）求解，这里求解到对数似然收敛，两者结果的差异见 rootara_admixture.CHECK_TOLERANCE，
+  用 python rootara_admixture.py --input 原始文件 --method 来源 --check 对比
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import functools
+import importlib.util
+import numpy as np
+import pandas as pd
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_columnar import load_columns
+    from scripts.rootara_genotype_store import open_packed_genotypes
+    from scripts.rootara_db import connect, attach_report
+    from scripts.rootara_parsers import iter_records
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_columnar import load_columns
+    from scripts.rootara_genotype_store import open_packed_genotypes
+    from scripts.rootara_db import connect, attach_report
+    from scripts.rootara_parsers import iter_records
+
+ADMIX_MODEL = 'K47'
+
+# 每个报告计算的模型，逗号分隔，所有模型共用一次基因型读取与位点对齐
+ADMIX_MODELS = [model.strip() for model in os.environ.get('ROOTARA_ADMIX_MODELS', ADMIX_MODEL).split(',') if model.strip()]
+
+# 模型数据目录，默认使用已安装的admix包中的data目录
+ADMIX_DATA_DIR = os.environ.get('ROOTARA_ADMIX_DATA', '')
+
+# EM迭代的收敛条件：对数似然的增加小于TOLERANCE，或达到最大迭代次数
+TOLERANCE = 1e-6
+MAX_ITERATIONS = 5000
+
+# SQUAREM外推后祖源比例的下限
+MIN_PROPORTION = 1e-12
+
+# 频率取值范围，避免log(0)
+FREQUENCY_EPSILON = 1e-6
+
+class AdmixtureDataError(Exception):
+    """模型文件不存在或无法解析"""
+    pass
+
+def admix_package_dir():
+    spec = importlib.util.find_spec('admix')
+    if spec is None or spec.origin is None:
+        raise AdmixtureDataError("未安装admix，且未设置ROOTARA_ADMIX_DATA")
+    return os.path.dirname(spec.origin)
+
+def admix_data_dir():
+    if ADMIX_DATA_DIR:
+        return ADMIX_DATA_DIR
+    return os.path.join(admix_package_dir(), 'data')
+
+# 群体名称写入数据库时作为列名，非字母数字替换为下划线
+def population_column(name):
+    return re.sub(r'[^0-9A-Za-z]+', '_', name.strip()).strip('_')
+
+def model_populations(model):
+    """
+    使用admix中定义的群体名称与顺序
+    :return: 群体名称列表，与频率矩阵的列一致
+    """
+    try:
+        from admix import admix_models
+    except ImportError as e:
+        raise AdmixtureDataError(f"无法读取模型 {model} 的群体名称: {str(e)}")
+    populations = admix_models.populations(model)
+    # 可能为 [(英文, 中文), ...] 或 ([英文...], [中文...])
+    if len(populations) == 2 and not isinstance(populations[0], str) and len(populations[0]) != 2:
+        populations = populations[0]
+    return [name[0] if isinstance(name, (list, tuple)) else name for name in populations]
+
+def find_frequency_file(data_dir, model, n_populations):
+    frequency_file = os.path.join(data_dir, f'{model}.{n_populations}.F')
+    if os.path.exists(frequency_file):
+        return frequency_file
+    # 群体数与文件名不一致时，查找唯一的频率文件
+    candidates = [name for name in os.listdir(data_dir) if re.fullmatch(rf'{re.escape(model)}\.\d+\.F', name)]
+    if len(candidates) != 1:
+        raise AdmixtureDataError(f"找不到模型 {model} 的频率文件: {frequency_file}")
+    return os.path.join(data_dir, candidates[0])
+
+# admix只读取最后一个字符为这些碱基的基因型
+CALLED_ALLELES = ['A', 'C', 'G', 'T']
+
+class ReportGenotypes:
+    """
+    报告的基因型，按位点编号建立索引，多个模型共用
+    与admix读取原始文件的规则相同：丢弃最后一个字符不是A/C/G/T的基因型，同一位点出现多次时保留最后一次
+    """
+    def __init__(self, rsids, genotypes):
+        rsids = pd.Index(rsids).astype(str)
+        genotypes = pd.Series(np.asarray(genotypes, dtype=object)).fillna('').astype(str).str.upper()
+        called = genotypes.str[-1:].isin(CALLED_ALLELES).to_numpy()
+        rsids = rsids[called]
+        genotypes = genotypes[called]
+        unique = ~rsids.duplicated(keep='last')
+        self.rsids = rsids[unique]
+        genotypes = genotypes[unique]
+        self.first = genotypes.str[:1].to_numpy(dtype='U1')
+        self.second = genotypes.str[-1:].to_numpy(dtype='U1')
+
+class AdmixtureModel:
+    def __init__(self, model, data_dir):
+        self.model = model
+        self.populations = model_populations(model)
+
+        alleles_file = os.path.join(data_dir, f'{model}.alleles')
+        if not os.path.exists(alleles_file):
+            raise AdmixtureDataError(f"找不到模型 {model} 的位点文件: {alleles_file}")
+        alleles = pd.read_csv(alleles_file, sep=r'\s+', header=None, usecols=[0, 1, 2],
+                              names=['snp', 'minor', 'major'], dtype=str)
+        frequency_file = find_frequency_file(data_dir, model, len(self.populations))
+        frequency = np.loadtxt(frequency_file, dtype=np.float64, ndmin=2)
+
+        if frequency.shape != (len(alleles), len(self.populations)):
+            raise AdmixtureDataError(
+                f"模型 {model} 的频率矩阵大小 {frequency.shape} 与位点数 {len(alleles)}、群体数 {len(self.populations)} 不一致"
+            )
+        self.snps = pd.Index(alleles['snp'])
+        self.minor = alleles['minor'].str.upper().to_numpy(dtype='U1')
+        self.major = alleles['major'].str.upper().to_numpy(dtype='U1')
+        self.frequency = np.ascontiguousarray(np.clip(frequency, FREQUENCY_EPSILON, 1 - FREQUENCY_EPSILON))
+
+    def allele_counts(self, report):
+        """
+        统计每个模型位点上主要、次要等位基因的个数
+        :param report: ReportGenotypes
+        :return: (模型位点下标, g_major, g_minor)，只包含有计数的位点
+        """
+        rows = report.rsids.get_indexer(self.snps)
+        index = np.flatnonzero(rows >= 0)
+        rows = rows[index]
+        first, second = report.first[rows], report.second[rows]
+
+        major, minor = self.major[index], self.minor[index]
+        g_major = (first == major).astype(np.float64) + (second == major)
+        g_minor = (first == minor).astype(np.float64) + (second == minor)
+        keep = (g_major + g_minor) > 0
+        return index[keep], g_major[keep], g_minor[keep]
+
+    def fit(self, report, tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+        """
+        :param report: ReportGenotypes
+        :return: (祖源比例数组, 使用的位点数, 迭代次数)
+        """
+        index, g_major, g_minor = self.allele_counts(report)
+        if len(index) == 0:
+            raise ValueError(f"报告中没有模型 {self.model} 使用的位点")
+        f = self.frequency[index]
+        total = g_major.sum() + g_minor.sum()
+
+        def log_likelihood(q):
+            fq = f @ q
+            return g_major @ np.log(fq) + g_minor @ np.log(1 - fq)
+
+        # EM更新：每个等位基因来自各群体的后验概率之和
+        # (1-F)ᵀ·w = Σw - Fᵀ·w，每次更新只需要两次矩阵向量乘法
+        def em_step(q):
+            fq = f @ q
+            minor_weight = g_minor / (1 - fq)
+            q = q * (f.T @ (g_major / fq - minor_weight) + minor_weight.sum()) / total
+            return q / q.sum()
+
+        # SQUAREM加速：由连续两次EM更新外推，外推结果似然下降时退回普通EM
+        k = f.shape[1]
+        q = np.full(k, 1.0 / k)
+        last = log_likelihood(q)
+        iteration = 0
+        while iteration < max_iterations:
+            q1 = em_step(q)
+            q2 = em_step(q1)
+            iteration += 2
+            r = q1 - q
+            v = q2 - q1 - r
+            v_norm = np.linalg.norm(v)
+            candidate = q2
+            if v_norm > 0:
+                alpha = min(-np.linalg.norm(r) / v_norm, -1.0)
+                # 比例保留一个极小的正值，EM为乘性更新，为0的成分无法再恢复
+                extrapolated = np.maximum(q - 2 * alpha * r + alpha * alpha * v, MIN_PROPORTION)
+                extrapolated = em_step(extrapolated / extrapolated.sum())
+                iteration += 1
+                if log_likelihood(extrapolated) >= log_likelihood(q2):
+                    candidate = extrapolated
+            q = candidate
+            likelihood = log_likelihood(q)
+            if likelihood - last < tolerance:
+                break
+            last = likelihood
+        return q, len(index), iteration
+
+    def admixture(self, report):
+        """
+        :param report: ReportGenotypes
+        :return: {群体列名: 百分比}，与admix输出一样保留两位小数
+        """
+        q, _, _ = self.fit(report)
+        return {population_column(name): round(float(ratio) * 100, 2) for name, ratio in zip(self.populations, q)}
+
+@functools.lru_cache(maxsize=None)
+def load_admixture_model(model=ADMIX_MODEL, data_dir=None):
+    """每个进程只加载一次"""
+    start = time.perf_counter()
+    result = AdmixtureModel(model, data_dir or admix_data_dir())
+    print(f"祖源模型 {model} 加载完成，耗时 {time.perf_counter() - start:.2f} 秒")
+    return result
+
+def admixture_engine_available(models=ADMIX_MODELS):
+    """所有模型文件都能加载时返回True"""
+    try:
+        for model in models:
+            load_admixture_model(model)
+        return True
+    except (OSError, ValueError, AdmixtureDataError) as e:
+        print(f"进程内祖源分析不可用: {str(e)}")
+        return False
+
+# 从原始文件中读取位点编号与基因型，admix读取的也是原始文件
+def read_raw_genotypes(input_file, method=None):
+    """
+    :param method: 数据来源，为空或'auto'时根据文件内容识别
+    :return: (位点编号数组, 基因型数组)
+    """
+    rsids, genotypes = [], []
+    for records in iter_records(input_file, method):
+        rsids.append(records['RSID'].to_numpy())
+        genotypes.append(records['Genotype'].to_numpy())
+    if not rsids:
+        return np.array([], dtype=object), np.array([], dtype=object)
+    return np.concatenate(rsids), np.concatenate(genotypes)
+
+# 从转换结果中读取位点编号与基因型，只有与核心库匹配上的位点
+def read_converted_genotypes(rootara_data):
+    if os.path.isdir(rootara_data):
+        columns, _ = load_columns(rootara_data)
+        return columns['RSID'].decode(), columns['Genotype'].decode()
+    df = pd.read_csv(rootara_data, sep=',', header=0, usecols=['RSID', 'Genotype'], dtype=str, low_memory=False)
+    return df['RSID'].fillna('').to_numpy(), df['Genotype'].fillna('').to_numpy()
+
+# 读取报告的位点编号与基因型，优先使用压缩的基因型，不存在时读取报告表
+def read_report_genotypes(report_id, db_file):
+    packed = open_packed_genotypes(report_id)
+    if packed is not None:
+        return packed.rsid_genotypes()
+
+    conn = connect(db_file)
+    try:
+        attach_report(conn, report_id)
+        df = pd.read_sql_query(f'SELECT rsid, genotype FROM "{report_id}" WHERE rsid IS NOT NULL', conn)
+    finally:
+        conn.close()
+    return df['rsid'].to_numpy(), df['genotype'].fillna('').to_numpy()
+
+def compute_admixture_inprocess(rsids, genotypes, models=ADMIX_MODELS):
+    """
+    基因型只建立一次索引，每个模型只需要对齐位点并求解
+    :return: {模型: {群体列名: 百分比}}
+    """
+    report = ReportGenotypes(rsids, genotypes)
+    return {model: load_admixture_model(model).admixture(report) for model in models}
+
+def main():
+    parser = argparse.ArgumentParser(description='进程内祖源分析')
+    parser.add_argument('--input', type=str, help='原始数据文件')
+    parser.add_argument('--method', type=str, help='原始数据的来源，默认根据文件内容识别', default='auto')
+    parser.add_argument('--converted', type=str, help='转换结果的列存储目录或CSV文件，只使用与核心库匹配上的位点')
+    parser.add_argument('--id', type=str, help='报告编号，与--db一起使用时从报告表读取基因型')
+    parser.add_argument('--db', type=str, help='数据库文件')
+    parser.add_argument('--models', type=str, help='祖源模型，逗号分隔', default=','.join(ADMIX_MODELS))
+    args = parser.parse_args()
+
+    if args.input:
+        rsids, genotypes = read_raw_genotypes(args.input, args.method)
+    elif args.converted:
+        rsids, genotypes = read_converted_genotypes(args.converted)
+    elif args.id and args.db:
+        rsids, genotypes = read_report_genotypes(args.id, args.db)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+    start = time.perf_counter()
+    results = compute_admixture_inprocess(rsids, genotypes, args.models.split(','))
+    for model, result in results.items():
+        print(f"{model}:")
+        for name, ratio in sorted(result.items(), key=lambda item: -item[1]):
+            if ratio > 0:
+                print(f"{name}: {ratio:.2f}%")
+    print(f"计算耗时 {time.perf_counter() - start:.2f} 秒")
+
+if __name__ == '__main__':
+    main()
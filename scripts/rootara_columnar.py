@@ -0,0 +1,283 @@
+# coding=utf-8
+# pzw
+# 二进制列存储
+# 一个目录保存一张表：meta.json 记录行数和各列的类型，每一列是若干个小端序的原始二进制文件
+# 读取时使用numpy.memmap映射，不需要解析文本；格式足够简单，Go程序也可以直接映射读取
+
+"""
+列的类型：
+- array: 数值列，一个 <name>.bin 文件
+- plain: 字符串列，<name>.offsets.bin (int64, 行数+1) 和 <name>.data.bin (utf-8字节)
+- dict:  字典编码的字符串列，<name>.codes.bin (uint32, 每行一个编码) 加上字符串表
+         <name>.offsets.bin 和 <name>.data.bin，适合取值重复较多的列
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+FORMAT_NAME = 'rootara-columnar'
+FORMAT_VERSION = 1
+
+# 字符串列，codes为None时每一行对应字符串表中的同一位置
+class StringColumn:
+    def __init__(self, offsets, data, codes=None):
+        self.offsets = offsets
+        self.data = data
+        self.codes = codes
+
+    def __len__(self):
+        if self.codes is not None:
+            return len(self.codes)
+        return len(self.offsets) - 1
+
+    @property
+    def kind(self):
+        return 'plain' if self.codes is None else 'dict'
+
+    # 字符串表中的第i个字符串
+    def table_value(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def decode(self, rows=None, empty=''):
+        """
+        解码为字符串数组，只解码用到的字符串
+        :param rows: 行号数组，默认全部行
+        :param empty: 空字符串替换为的值
+        :return: dtype为object的numpy数组
+        """
+        if self.codes is None and rows is None:
+            # 整列解码时一次复制字符串表，避免逐个切片内存映射
+            return self._decode_table(np.arange(len(self)), empty)
+        if self.codes is not None:
+            table_rows = np.asarray(self.codes if rows is None else self.codes[rows])
+        else:
+            table_rows = np.asarray(rows)
+        if len(table_rows) == 0:
+            return np.array([], dtype=object)
+        table_size = len(self.offsets) - 1
+        if table_size <= len(table_rows):
+            # 字符串表不大于行数时直接解码整个字符串表
+            return self._decode_table(np.arange(table_size), empty)[table_rows]
+        unique, inverse = np.unique(table_rows, return_inverse=True)
+        if len(unique) * 8 > table_size:
+            values = self._decode_table(unique, empty)
+        else:
+            values = np.array([self.table_value(i) for i in unique], dtype=object)
+            if empty != '':
+                values[values == ''] = empty
+        return values[inverse.reshape(-1)]
+
+    def _decode_table(self, index, empty=''):
+        raw = bytes(self.data)
+        offsets = np.asarray(self.offsets)
+        starts = offsets[index].tolist()
+        ends = offsets[np.asarray(index) + 1].tolist()
+        values = np.empty(len(starts), dtype=object)
+        values[:] = [raw[start:end].decode('utf-8') for start, end in zip(starts, ends)]
+        if empty != '':
+            values[offsets[np.asarray(index) + 1] == offsets[index]] = empty
+        return values
+
+    def isin(self, values, rows=None):
+        """
+        每一行的字符串是否在values中，按相同长度的字节批量比较，不需要解码
+        :param values: 字符串集合
+        :param rows: 行号数组，默认全部行
+        :return: 布尔数组
+        """
+        if self.codes is not None:
+            table = StringColumn(self.offsets, self.data).isin(values)
+            return table[np.asarray(self.codes if rows is None else self.codes[rows])]
+        index = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        offsets = np.asarray(self.offsets)
+        starts = offsets[index]
+        lengths = offsets[index + 1] - starts
+        wanted = {}
+        for value in set(values):
+            encoded = value.encode('utf-8')
+            wanted.setdefault(len(encoded), []).append(encoded)
+        mask = np.zeros(len(index), dtype=bool)
+        for length, items in wanted.items():
+            hit = np.flatnonzero(lengths == length)
+            if length == 0 or len(hit) == 0:
+                mask[hit] = length == 0
+                continue
+            raw = np.asarray(self.data)[starts[hit][:, None] + np.arange(length)]
+            mask[hit] = np.isin(raw.view(f'S{length}').reshape(-1), np.array(items, dtype=f'S{length}'))
+        return mask
+
+    def take(self, rows):
+        """
+        按行号取子集，返回紧凑的新字符串列
+        字典编码的列只保留用到的字符串
+        """
+        rows = np.asarray(rows)
+        if self.codes is not None:
+            unique, inverse = np.unique(self.codes[rows], return_inverse=True)
+            offsets, data = _gather_strings(self.offsets, self.data, unique)
+            return StringColumn(offsets, data, inverse.reshape(-1).astype(np.uint32))
+        offsets, data = _gather_strings(self.offsets, self.data, rows)
+        return StringColumn(offsets, data)
+
+# 按下标从字符串表中取出若干字符串，重新拼接为新的字符串表
+def _gather_strings(offsets, data, index):
+    offsets = np.asarray(offsets)
+    starts = offsets[:-1][index]
+    lengths = offsets[1:][index] - starts
+    new_offsets = np.zeros(len(index) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    total = int(new_offsets[-1])
+    if total == 0:
+        return new_offsets, np.zeros(0, dtype=np.uint8)
+    positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(total, dtype=np.int64)
+    return new_offsets, np.asarray(data)[positions]
+
+# 字符串列表拼接为字符串表
+def _build_table(values):
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, data
+
+def encode_strings(values, dictionary=True):
+    """
+    将字符串序列编码为字符串列
+    :param values: 字符串序列，空值按空字符串处理
+    :param dictionary: 是否使用字典编码
+    :return: StringColumn
+    """
+    values = pd.Series(values, dtype=object).fillna('').astype(str)
+    if dictionary:
+        codes, uniques = pd.factorize(values, sort=False)
+        offsets, data = _build_table(list(uniques))
+        return StringColumn(offsets, data, codes.astype(np.uint32))
+    offsets, data = _build_table(values.tolist())
+    return StringColumn(offsets, data)
+
+def concat_string_columns(columns):
+    """
+    合并多个不使用字典编码的字符串列
+    """
+    if not columns:
+        return StringColumn(np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.uint8))
+    offsets = [np.zeros(1, dtype=np.int64)]
+    base = 0
+    for column in columns:
+        offsets.append(np.asarray(column.offsets[1:]) + base)
+        base += int(column.offsets[-1])
+    data = np.concatenate([np.asarray(column.data) for column in columns])
+    return StringColumn(np.concatenate(offsets), data)
+
+def _write_array(path, array, dtype):
+    np.ascontiguousarray(array, dtype=dtype).tofile(path)
+
+def save_columns(out_dir, columns, attrs=None):
+    """
+    保存一张表
+    :param out_dir: 输出目录
+    :param columns: 有序字典 {列名: numpy数组或StringColumn}，各列行数必须相同
+    :param attrs: 额外写入meta.json的信息
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rows = None
+    meta_columns = {}
+    for name, column in columns.items():
+        if rows is None:
+            rows = len(column)
+        elif len(column) != rows:
+            raise ValueError(f"列 {name} 的行数 {len(column)} 与其他列 {rows} 不一致")
+
+        if isinstance(column, StringColumn):
+            info = {'kind': column.kind, 'offsets': f'{name}.offsets.bin', 'data': f'{name}.data.bin',
+                    'size': len(column.offsets) - 1}
+            _write_array(os.path.join(out_dir, info['offsets']), column.offsets, '<i8')
+            _write_array(os.path.join(out_dir, info['data']), column.data, 'u1')
+            if column.codes is not None:
+                info['codes'] = f'{name}.codes.bin'
+                _write_array(os.path.join(out_dir, info['codes']), column.codes, '<u4')
+        else:
+            array = np.asarray(column)
+            dtype = array.dtype.newbyteorder('<') if array.dtype.byteorder not in ('|', '<') else array.dtype
+            info = {'kind': 'array', 'dtype': dtype.str, 'file': f'{name}.bin'}
+            _write_array(os.path.join(out_dir, info['file']), array, dtype)
+        meta_columns[name] = info
+
+    meta = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'rows': rows or 0,
+        'columns': meta_columns,
+        'attrs': attrs or {}
+    }
+    # meta.json最后写入，存在即表示数据完整
+    temp_meta = os.path.join(out_dir, 'meta.json.tmp')
+    with open(temp_meta, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(temp_meta, os.path.join(out_dir, 'meta.json'))
+
+def read_meta(in_dir):
+    with open(os.path.join(in_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT_NAME:
+        raise ValueError(f"不是有效的列存储目录: {in_dir}")
+    return meta
+
+def _map_array(path, dtype, count, mmap):
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+    return np.fromfile(path, dtype=dtype, count=count)
+
+def load_columns(in_dir, mmap=True):
+    """
+    读取一张表
+    :param in_dir: 列存储目录
+    :param mmap: 是否使用内存映射
+    :return: (列字典, meta信息)
+    """
+    meta = read_meta(in_dir)
+    rows = meta['rows']
+    columns = {}
+    for name, info in meta['columns'].items():
+        if info['kind'] == 'array':
+            columns[name] = _map_array(os.path.join(in_dir, info['file']), np.dtype(info['dtype']), rows, mmap)
+            continue
+        offsets = _map_array(os.path.join(in_dir, info['offsets']), np.dtype('<i8'), info['size'] + 1, mmap)
+        data = _map_array(os.path.join(in_dir, info['data']), np.dtype('u1'), int(offsets[-1]), mmap)
+        codes = None
+        if info['kind'] == 'dict':
+            codes = _map_array(os.path.join(in_dir, info['codes']), np.dtype('<u4'), rows, mmap)
+        columns[name] = StringColumn(offsets, data, codes)
+    return columns, meta
+
+def save_dataframe(out_dir, df, dictionary_columns=(), attrs=None):
+    """
+    按列保存DataFrame，数值列保存为数组，其余列保存为字符串列
+    :param dictionary_columns: 使用字典编码的列名
+    """
+    columns = {}
+    for name in df.columns:
+        series = df[name]
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            columns[name] = series.to_numpy()
+        else:
+            columns[name] = encode_strings(series, dictionary=name in dictionary_columns)
+    save_columns(out_dir, columns, attrs)
+
+def load_dataframe(in_dir, columns=None, mmap=True, empty=''):
+    """
+    读取为DataFrame，字符串列解码为Python字符串
+    :param columns: 需要读取的列名，默认全部列
+    :param empty: 字符串列中的空字符串替换为的值
+    """
+    data, meta = load_columns(in_dir, mmap)
+    names = list(columns) if columns is not None else list(data)
+    frame = {}
+    for name in names:
+        column = data[name]
+        frame[name] = column.decode(empty=empty) if isinstance(column, StringColumn) else np.asarray(column)
+    return pd.DataFrame(frame, columns=names)
@@ -0,0 +1,262 @@
+# coding=utf-8
+# pzw
+# 常驻格式转换服务
+# 服务进程启动时加载一次核心库，之后通过本地Unix socket接收转换任务，每次转换只需要匹配位点
+# API进程负责启动服务并监控，服务退出后自动重启；服务不可用时调用方回退到一次性运行Go转换程序
+# 服务只使用最新的核心库二进制索引，结果与Go转换程序一致；索引不存在或已过期时服务启动前先构建
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+import traceback
+from multiprocessing.connection import Listener, Client
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_reader import convert_result, save_converted
+    from scripts.rootara_core_index import find_core_index, build_core_index, load_core_index
+    from scripts.rootara_parsers import PARSERS
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_reader import convert_result, save_converted
+    from scripts.rootara_core_index import find_core_index, build_core_index, load_core_index
+    from scripts.rootara_parsers import PARSERS
+
+ROOTARA_CORE = '/app/database/Rootara.core.202404.txt.gz'
+SOCKET_PATH = os.environ.get('ROOTARA_CONVERTER_SOCKET', '/data/temp/rootara_converter.sock')
+
+# 转换模式：service 使用常驻服务，oneshot 每次启动Go转换程序
+CONVERTER_MODE = os.environ.get('ROOTARA_CONVERTER', 'service')
+
+# 单次转换的最长等待时间（秒）
+CONVERT_TIMEOUT = int(os.environ.get('ROOTARA_CONVERTER_TIMEOUT', '600'))
+
+# 服务连续异常退出时的重启间隔（秒），每次翻倍，最长60秒
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+
+class ConverterUnavailable(Exception):
+    """转换服务未启动或在转换过程中退出"""
+    pass
+
+# 服务进程：处理一个连接上的请求
+def _handle_connection(conn, rootara_df):
+    with conn:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+            try:
+                if request.get('cmd') == 'ping':
+                    conn.send({'ok': True})
+                    continue
+                start = time.perf_counter()
+                df_merge = convert_result(request['input'], request['method'], rootara_df)
+                save_converted(df_merge, request['output'])
+                conn.send({'ok': True, 'rows': len(df_merge), 'seconds': time.perf_counter() - start})
+            except Exception as e:
+                traceback.print_exc()
+                conn.send({'ok': False, 'error': str(e)})
+
+def service_core_index(rootara_core=ROOTARA_CORE):
+    """
+    服务使用的核心库索引，不存在或已过期时构建
+    不回退到文本核心库，构建失败时服务不启动，调用方回退到Go转换程序
+    :param rootara_core: 核心库文件路径
+    :return: CoreIndex
+    """
+    index_path = find_core_index(rootara_core)
+    if index_path is None:
+        if not os.path.exists(rootara_core):
+            raise FileNotFoundError(f"核心数据文件不存在，且没有可用的索引: {rootara_core}")
+        index_path = build_core_index(rootara_core)
+    return load_core_index(index_path)
+
+def serve(socket_path=SOCKET_PATH, rootara_core=ROOTARA_CORE):
+    """
+    运行转换服务，直到进程被终止
+    :param socket_path: Unix socket路径
+    :param rootara_core: 核心库文件路径，使用其最新的二进制索引
+    """
+    start = time.perf_counter()
+    rootara_df = service_core_index(rootara_core)
+    print(f"转换服务加载核心库完成，耗时 {time.perf_counter() - start:.2f} 秒")
+
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    # 先在临时路径上监听，设置好权限后再改名，客户端看到socket时服务已可用
+    temp_path = socket_path + '.starting'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    listener = Listener(temp_path, family='AF_UNIX')
+    os.chmod(temp_path, 0o600)
+    os.replace(temp_path, socket_path)
+    print(f"转换服务已启动: {socket_path}")
+
+    with listener:
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=_handle_connection, args=(conn, rootara_df), daemon=True).start()
+
+def _connect(socket_path):
+    if not os.path.exists(socket_path):
+        raise ConverterUnavailable(f"转换服务未启动: {socket_path}")
+    try:
+        return Client(socket_path, family='AF_UNIX')
+    except OSError as e:
+        raise ConverterUnavailable(f"无法连接转换服务: {str(e)}")
+
+def convert_with_service(input_file, output_dir, method, socket_path=SOCKET_PATH, timeout=CONVERT_TIMEOUT):
+    """
+    通过常驻服务转换文件，结果以列存储格式保存
+    :param input_file: 原始数据文件路径
+    :param output_dir: 输出目录
+    :param method: 文件来源，见rootara_parsers.PARSERS，auto时根据文件内容识别
+    :return: 转换后的位点数
+    """
+    conn = _connect(socket_path)
+    with conn:
+        try:
+            conn.send({'cmd': 'convert', 'input': input_file, 'output': output_dir, 'method': method})
+            if not conn.poll(timeout):
+                raise ConverterUnavailable(f"转换服务超过 {timeout} 秒未返回结果")
+            response = conn.recv()
+        except (EOFError, OSError) as e:
+            raise ConverterUnavailable(f"转换服务连接中断: {str(e)}")
+    if not response['ok']:
+        raise Exception(f"转换服务转换失败: {response['error']}")
+    return response['rows']
+
+def ping_service(socket_path=SOCKET_PATH, timeout=5):
+    try:
+        with _connect(socket_path) as conn:
+            conn.send({'cmd': 'ping'})
+            return conn.poll(timeout) and conn.recv().get('ok', False)
+    except (ConverterUnavailable, EOFError, OSError):
+        return False
+
+# API进程中运行的服务管理，启动服务进程并在其退出后重启
+class ConverterService:
+    def __init__(self, socket_path=SOCKET_PATH, rootara_core=ROOTARA_CORE):
+        self.socket_path = socket_path
+        self.rootara_core = rootara_core
+        self.process = None
+        self.restarts = 0
+        self._stopping = threading.Event()
+        self._watchdog = None
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        cmd = [sys.executable, os.path.abspath(__file__), '--serve',
+               '--socket', self.socket_path, '--rootara', self.rootara_core]
+        self.process = subprocess.Popen(cmd)
+        print(f"转换服务进程已启动，PID: {self.process.pid}")
+
+    def _watch(self):
+        delay = RESTART_DELAY
+        while not self._stopping.wait(1):
+            with self._lock:
+                code = self.process.poll()
+            if code is None:
+                # 重启后的服务可以响应时恢复重启间隔
+                if delay != RESTART_DELAY and ping_service(self.socket_path):
+                    delay = RESTART_DELAY
+                continue
+            print(f"转换服务进程退出，返回状态码: {code}，{delay} 秒后重启")
+            if self._stopping.wait(delay):
+                return
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+            with self._lock:
+                self._spawn()
+                self.restarts += 1
+
+    def start(self):
+        with self._lock:
+            if self.process is not None:
+                return
+            self._stopping.clear()
+            self._spawn()
+        self._watchdog = threading.Thread(target=self._watch, name='rootara_converter_watchdog', daemon=True)
+        self._watchdog.start()
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+        with self._lock:
+            if self.process is not None and self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+            self.process = None
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def status(self):
+        with self._lock:
+            running = self.process is not None and self.process.poll() is None
+            pid = self.process.pid if running else None
+        return {
+            'mode': CONVERTER_MODE,
+            'running': running,
+            'ready': running and ping_service(self.socket_path),
+            'pid': pid,
+            'restarts': self.restarts,
+            'socket': self.socket_path
+        }
+
+_service = None
+
+def start_converter_service():
+    """在API进程启动时调用，oneshot模式下不启动服务"""
+    global _service
+    if CONVERTER_MODE != 'service':
+        return None
+    if _service is None:
+        _service = ConverterService()
+    _service.start()
+    return _service
+
+def stop_converter_service():
+    global _service
+    if _service is not None:
+        _service.stop()
+        _service = None
+
+def converter_status():
+    if _service is None:
+        return {'mode': CONVERTER_MODE, 'running': False, 'ready': False, 'pid': None, 'restarts': 0, 'socket': SOCKET_PATH}
+    return _service.status()
+
+def main():
+    parser = argparse.ArgumentParser(description='Rootara常驻格式转换服务')
+    parser.add_argument('--serve', action='store_true', help='运行转换服务')
+    parser.add_argument('--socket', type=str, help='Unix socket路径', default=SOCKET_PATH)
+    parser.add_argument('--rootara', type=str, help='Rootara核心库文件路径', default=ROOTARA_CORE)
+    parser.add_argument('--input', type=str, help='通过服务转换的输入文件路径')
+    parser.add_argument('--output', type=str, help='输出目录')
+    parser.add_argument('--method', type=str, choices=['auto'] + list(PARSERS), help='文件来源，auto时根据文件内容识别', default='auto')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.socket, args.rootara)
+    elif args.input and args.output:
+        rows = convert_with_service(args.input, args.output, args.method, args.socket)
+        print(f"转换完成，位点数: {rows}")
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
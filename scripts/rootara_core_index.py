@@ -0,0 +1,342 @@
+# coding=utf-8
+# pzw
+# Rootara核心库的二进制索引
+# 一次性把 Rootara.core.*.txt.gz 转换为按(染色体, 位置)排序的列存储，转换时直接内存映射读取
+# 不再每次上传都解压、解析约1GB的文本
+# 索引记录核心库文件的sha256，核心库更新后需要重新构建
+
+"""
+索引内容（列存储格式见 rootara_columnar.py）：
+- key: int64，染色体编码 << 32 | 位置，升序
+- ref / alt: uint8，插入缺失已调整为I/D，MNV已去除
+- Gene / CLNSIG / CLNDN: 字典编码的字符串
+- RSID / gnomAD_AF: 字符串
+attrs 中记录 chroms（染色体编码对应的名称）以及核心库文件的 sha256、大小和修改时间
+
+同一(染色体, 位置)有多条记录时保留最后一条，所有列按字符串读取，与Go转换程序和 rootara_reader.read_rootara_core 一致
+
+python rootara_core_index.py --core /app/database/Rootara.core.202404.txt.gz
+"""
+
+import os
+import sys
+import gzip
+import hashlib
+import argparse
+import functools
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_columnar import StringColumn, save_columns, load_columns, read_meta, concat_string_columns, encode_strings
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_columnar import StringColumn, save_columns, load_columns, read_meta, concat_string_columns, encode_strings
+
+# 常见染色体的编码顺序，其余染色体按出现顺序追加
+CHROM_ORDER = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+
+# 字典编码的注释列，其余为普通字符串列
+DICT_COLUMNS = ['Gene', 'CLNSIG', 'CLNDN']
+PLAIN_COLUMNS = ['RSID', 'gnomAD_AF']
+
+def default_index_path(core_path):
+    """
+    核心库对应的索引目录，如 Rootara.core.202404.txt.gz -> Rootara.core.202404.idx
+    """
+    base = core_path
+    for suffix in ('.gz', '.txt'):
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+    return base + '.idx'
+
+# 计算文件的sha256，作为核心库的版本
+def file_checksum(file_path, chunk_size=4 * 1024 * 1024):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# 字典编码器，跨数据块保持同一个字符串表
+class _DictEncoder:
+    def __init__(self, initial=()):
+        self.mapping = {}
+        self.values = []
+        for value in initial:
+            self.add(value)
+
+    def add(self, value):
+        if value not in self.mapping:
+            self.mapping[value] = len(self.values)
+            self.values.append(value)
+        return self.mapping[value]
+
+    def encode(self, series):
+        for value in pd.unique(series):
+            self.add(value)
+        return series.map(self.mapping).to_numpy(dtype=np.uint32)
+
+    def column(self, codes):
+        table = encode_strings(self.values, dictionary=False)
+        return StringColumn(table.offsets, table.data, codes)
+
+# 染色体名称和插入缺失的调整，规则与 rootara_reader.read_rootara_core 相同
+def _normalize_chunk(df):
+    df['Chrom'] = df['Chrom'].str.replace('chrM', 'MT').str.replace('chr', '')
+
+    ref_len = df['Ref'].str.len()
+    alt_len = df['Alt'].str.len()
+    same_len = ref_len == alt_len
+    single = same_len & (ref_len == 1)
+    deletion = (ref_len > alt_len) | (single & (df['Alt'] == '-'))
+    insertion = (ref_len < alt_len) | (single & (df['Alt'] != '-') & (df['Ref'] == '-'))
+    mnv = same_len & (ref_len != 1)
+
+    df.loc[deletion, 'Ref'] = 'I'
+    df.loc[deletion, 'Alt'] = 'D'
+    df.loc[insertion, 'Ref'] = 'D'
+    df.loc[insertion, 'Alt'] = 'I'
+    return df[~mnv]
+
+def _allele_codes(series):
+    data = ''.join(series.tolist()).encode('ascii')
+    if len(data) != len(series):
+        raise ValueError("核心库中存在无法编码的Ref/Alt")
+    return np.frombuffer(data, dtype=np.uint8)
+
+def build_core_index(core_path, index_path=None, chunksize=500000):
+    """
+    构建核心库索引
+    :param core_path: 核心库文件路径
+    :param index_path: 索引目录，默认为 default_index_path(core_path)
+    :param chunksize: 每次读取的行数
+    :return: 索引目录
+    """
+    index_path = index_path or default_index_path(core_path)
+    print(f"开始构建核心库索引: {core_path} -> {index_path}")
+
+    chrom_encoder = _DictEncoder(CHROM_ORDER)
+    dict_encoders = {name: _DictEncoder() for name in DICT_COLUMNS}
+    keys, refs, alts = [], [], []
+    dict_codes = {name: [] for name in DICT_COLUMNS}
+    plain_parts = {name: [] for name in PLAIN_COLUMNS}
+
+    columns = ['Chrom', 'Start', 'Ref', 'Alt'] + DICT_COLUMNS + PLAIN_COLUMNS
+    with gzip.open(core_path, 'rt') as f:
+        reader = pd.read_csv(f, sep='\t', header=0, usecols=columns, dtype=str,
+                             keep_default_na=False, chunksize=chunksize)
+        for chunk in reader:
+            chunk = _normalize_chunk(chunk)
+            chrom_codes = chrom_encoder.encode(chunk['Chrom']).astype(np.int64)
+            positions = chunk['Start'].astype(np.int64).to_numpy()
+            keys.append((chrom_codes << 32) | positions)
+            refs.append(_allele_codes(chunk['Ref']))
+            alts.append(_allele_codes(chunk['Alt']))
+            for name in DICT_COLUMNS:
+                dict_codes[name].append(dict_encoders[name].encode(chunk[name]))
+            for name in PLAIN_COLUMNS:
+                plain_parts[name].append(encode_strings(chunk[name], dictionary=False))
+            print(f"已读取 {sum(len(part) for part in keys)} 条记录")
+
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+
+    # 按key排序，相同key保留最后一条
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    keep = np.ones(len(order), dtype=bool)
+    if len(order) > 1:
+        keep[:-1] = sorted_keys[1:] != sorted_keys[:-1]
+    order = order[keep]
+
+    index_columns = {
+        'key': sorted_keys[keep],
+        'ref': np.concatenate(refs)[order] if refs else np.zeros(0, dtype=np.uint8),
+        'alt': np.concatenate(alts)[order] if alts else np.zeros(0, dtype=np.uint8),
+    }
+    for name in DICT_COLUMNS:
+        codes = np.concatenate(dict_codes[name]) if dict_codes[name] else np.zeros(0, dtype=np.uint32)
+        index_columns[name] = dict_encoders[name].column(codes[order])
+    for name in PLAIN_COLUMNS:
+        index_columns[name] = concat_string_columns(plain_parts[name]).take(order)
+
+    stat = os.stat(core_path)
+    attrs = {
+        'chroms': chrom_encoder.values,
+        'core_file': os.path.basename(core_path),
+        'core_sha256': file_checksum(core_path),
+        'core_size': stat.st_size,
+        'core_mtime': int(stat.st_mtime),
+        'built_at': datetime.now().isoformat()
+    }
+
+    # 先写入临时目录，完成后替换，避免读到不完整的索引
+    temp_path = index_path + '.building'
+    if os.path.exists(temp_path):
+        _remove_dir(temp_path)
+    save_columns(temp_path, index_columns, attrs)
+    if os.path.exists(index_path):
+        _remove_dir(index_path)
+    os.replace(temp_path, index_path)
+
+    print(f"核心库索引构建完成，共 {len(index_columns['key'])} 个位点，版本 {attrs['core_sha256'][:12]}")
+    return index_path
+
+def _remove_dir(path):
+    for name in os.listdir(path):
+        os.remove(os.path.join(path, name))
+    os.rmdir(path)
+
+def is_index_fresh(index_path, core_path):
+    """
+    检查索引是否与核心库文件一致
+    文件大小和修改时间都相同时直接认为一致，否则比较sha256
+    """
+    if not os.path.exists(os.path.join(index_path, 'meta.json')):
+        return False
+    attrs = read_meta(index_path)['attrs']
+    if not os.path.exists(core_path):
+        return True
+    stat = os.stat(core_path)
+    if attrs.get('core_size') != stat.st_size:
+        return False
+    if attrs.get('core_mtime') == int(stat.st_mtime):
+        return True
+    return attrs.get('core_sha256') == file_checksum(core_path)
+
+def find_core_index(core_path):
+    """
+    查找核心库对应的可用索引
+    :param core_path: 核心库文件路径，或索引目录
+    :return: 索引目录，不存在或已过期时返回None
+    """
+    if os.path.isdir(core_path) and os.path.exists(os.path.join(core_path, 'meta.json')):
+        return core_path
+    index_path = default_index_path(core_path)
+    if is_index_fresh(index_path, core_path):
+        return index_path
+    return None
+
+@functools.lru_cache(maxsize=8)
+def _core_version(core_path, size, mtime):
+    index_path = find_core_index(core_path)
+    if index_path is not None:
+        return read_meta(index_path)['attrs']['core_sha256']
+    return file_checksum(core_path)
+
+def core_version(core_path):
+    """
+    核心库的版本(sha256)，存在一致的索引时直接读取索引中记录的值
+    文件大小和修改时间不变时使用缓存
+    """
+    stat = os.stat(core_path)
+    return _core_version(core_path, stat.st_size, int(stat.st_mtime))
+
+# 内存映射的核心库索引
+class CoreIndex:
+    def __init__(self, index_path):
+        self.path = index_path
+        self.columns, meta = load_columns(index_path, mmap=True)
+        self.attrs = meta['attrs']
+        self.version = self.attrs['core_sha256']
+        self.chroms = self.attrs['chroms']
+        self.chrom_code = {chrom: code for code, chrom in enumerate(self.chroms)}
+        self.keys = self.columns['key']
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, chroms, positions):
+        """
+        查找位点在索引中的行号
+        :param chroms: 染色体名称序列
+        :param positions: 位置序列
+        :return: int64行号数组，未找到为-1
+        """
+        codes = pd.Series(chroms, dtype=object).astype(str).map(self.chrom_code).to_numpy(dtype=float)
+        positions = pd.to_numeric(pd.Series(positions), errors='coerce').to_numpy(dtype=float)
+        valid = ~np.isnan(codes) & ~np.isnan(positions) & (positions >= 0) & (positions < 2 ** 32)
+
+        rows = np.full(len(codes), -1, dtype=np.int64)
+        if not valid.any() or len(self.keys) == 0:
+            return rows
+        query = (codes[valid].astype(np.int64) << 32) | positions[valid].astype(np.int64)
+        found = np.searchsorted(self.keys, query)
+        found = np.minimum(found, len(self.keys) - 1)
+        hit = np.asarray(self.keys[found]) == query
+        rows[np.flatnonzero(valid)[hit]] = found[hit]
+        return rows
+
+    def chrom_names(self, rows):
+        codes = np.asarray(self.keys[rows]) >> 32
+        return np.array(self.chroms, dtype=object)[codes]
+
+    def positions(self, rows):
+        return np.asarray(self.keys[rows]) & 0xFFFFFFFF
+
+    def alleles(self, rows):
+        """
+        :return: (Ref数组, Alt数组)，dtype为object
+        """
+        ref = np.asarray(self.columns['ref'][rows]).view('S1').astype(str).astype(object)
+        alt = np.asarray(self.columns['alt'][rows]).view('S1').astype(str).astype(object)
+        return ref, alt
+
+    def annotations(self, rows):
+        """
+        取出若干位点的完整注释，列名与转换结果一致
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        ref, alt = self.alleles(rows)
+        return pd.DataFrame({
+            'Chrom': self.chrom_names(rows),
+            'Start': self.positions(rows),
+            'Ref': ref,
+            'Alt': alt,
+            'Gene': self.columns['Gene'].decode(rows),
+            'RSID': self.columns['RSID'].decode(rows),
+            'gnomAD_AF': self.columns['gnomAD_AF'].decode(rows),
+            'CLNSIG': self.columns['CLNSIG'].decode(rows),
+            'CLNDN': self.columns['CLNDN'].decode(rows),
+        })
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+def load_core_index(index_path):
+    """
+    打开索引，同一进程内只映射一次
+    """
+    index_path = os.path.abspath(index_path)
+    with _index_lock:
+        if index_path not in _index_cache:
+            _index_cache[index_path] = CoreIndex(index_path)
+        return _index_cache[index_path]
+
+def main():
+    parser = argparse.ArgumentParser(description='构建Rootara核心库的二进制索引')
+    parser.add_argument('--core', type=str, help='核心库文件路径', default='/app/database/Rootara.core.202404.txt.gz')
+    parser.add_argument('--output', type=str, help='索引目录，默认与核心库同名的.idx目录')
+    parser.add_argument('--force', action='store_true', help='即使索引已是最新也重新构建')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.core):
+        print(f"核心数据文件不存在: {args.core}")
+        sys.exit(1)
+
+    index_path = args.output or default_index_path(args.core)
+    if not args.force and is_index_fresh(index_path, args.core):
+        print(f"核心库索引已是最新: {index_path}")
+        return
+    build_core_index(args.core, index_path)
+
+if __name__ == '__main__':
+    main()
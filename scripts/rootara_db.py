@@ -0,0 +1,289 @@
+# coding=utf-8
+# pzw
+# 数据库访问层
+# 多个报告同时创建时，写入报告表的长事务通过文件锁依次进行，其他连接等待写锁而不是立即报 database is locked
+# 查询接口使用每个线程复用的连接（WAL模式），表是否存在和列名缓存在内存中，数据库结构变化时自动失效
+# file存储方式的报告每个报告一个数据库文件，查询时附加到连接上，通过TEMP中与报告编号同名的视图访问
+# 报告文件只保存 (variant_id, 基因型编码)，注释和基因型在主数据库中所有报告共用的variants、genotype_codes表中
+
+import os
+import fcntl
+import shutil
+import sqlite3
+import threading
+import contextlib
+from collections import OrderedDict
+
+# 连接等待其他连接释放写锁的时间（秒）
+BUSY_TIMEOUT = float(os.environ.get('ROOTARA_DB_BUSY_TIMEOUT', '300'))
+
+# 记录已附加的报告文件的连接
+class Connection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # {报告编号: 文件的inode}，按最近使用的顺序
+        self.attached_reports = OrderedDict()
+
+def connect(db_path, **kwargs):
+    """打开数据库连接，写锁被占用时最多等待BUSY_TIMEOUT秒"""
+    kwargs.setdefault('timeout', BUSY_TIMEOUT)
+    kwargs.setdefault('factory', Connection)
+    return sqlite3.connect(db_path, **kwargs)
+
+# 复用连接的内存映射大小和页缓存大小
+MMAP_SIZE = int(os.environ.get('ROOTARA_DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+CACHE_SIZE_KB = int(os.environ.get('ROOTARA_DB_CACHE_KB', '65536'))
+
+# 每个连接缓存的预编译语句数
+STATEMENT_CACHE = 256
+
+# 复用连接的PRAGMA，只对当前连接生效
+# WAL模式下synchronous=NORMAL不会损坏数据库，只可能丢失断电前最后提交的事务
+POOL_PRAGMAS = [
+    'PRAGMA synchronous = NORMAL',
+    f'PRAGMA cache_size = -{CACHE_SIZE_KB}',
+    f'PRAGMA mmap_size = {MMAP_SIZE}',
+    'PRAGMA temp_store = MEMORY'
+]
+
+_local = threading.local()
+
+# 已切换为WAL模式的数据库
+_wal_enabled = set()
+_wal_lock = threading.Lock()
+
+def enable_wal(conn, db_path):
+    """
+    切换为WAL模式，读取不会阻塞写入，写入也不会阻塞读取
+    journal_mode是数据库文件的持久设置，每个进程只需要设置一次
+    """
+    with _wal_lock:
+        if db_path in _wal_enabled:
+            return
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            _wal_enabled.add(db_path)
+        except sqlite3.OperationalError as e:
+            # 其他连接正在写入时无法切换，下次获取连接时重试
+            print(f"数据库切换为WAL模式失败: {str(e)}")
+
+def get_connection(db_path):
+    """
+    当前线程复用的数据库连接，不要关闭
+    查询之后不需要提交；写入使用transaction，异常时回滚，不会把未完成的事务留在连接中
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = connect(db_path, cached_statements=STATEMENT_CACHE)
+        enable_wal(conn, db_path)
+        for pragma in POOL_PRAGMAS:
+            conn.execute(pragma)
+        connections[db_path] = conn
+    return conn
+
+def close_connections():
+    """关闭当前线程复用的连接"""
+    connections = getattr(_local, 'connections', None) or {}
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
+@contextlib.contextmanager
+def transaction(db_path):
+    """在复用的连接上执行写入，正常结束时提交，异常时回滚"""
+    conn = get_connection(db_path)
+    with conn:
+        yield conn
+
+# 每个连接最多附加的报告文件数，SQLite默认最多附加10个数据库
+ATTACH_LIMIT = int(os.environ.get('ROOTARA_ATTACH_LIMIT', '8'))
+
+# 报告文件中的表，TEMP中的视图名为 报告编号+后缀 (后缀, 表名, 表中除编码外的列)
+REPORT_FILE_TABLES = [('', 'snps', []), ('_clinvar', 'clinvar', ['clnsig_primary', 'snv'])]
+
+# 视图的列，与报告表一致
+REPORT_VIEW_COLUMNS = ['v.chromosome', 'v.position', 'v.ref', 'v.alt', 'v.gene', 'v.rsid', 'v.gnomAD_AF', 'v.clnsig',
+                       'v.clndn', 'c.genotype', 'c.gt']
+
+def report_db_dir(db_path):
+    """file存储方式的报告文件与主数据库在同一目录下的reports目录中"""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), 'reports')
+
+def report_db_path(db_path, report_id):
+    return os.path.join(report_db_dir(db_path), f'{report_id}.db')
+
+# 使用硬链接，不占用额外空间；不支持硬链接时复制
+def link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+    return target
+
+def main_db_path(conn):
+    for _, name, path in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return path
+    return ''
+
+def report_schema(report_id):
+    return f'{report_id}_db'
+
+def _file_id(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+def detach_report(conn, report_id):
+    """
+    分离报告文件，连接上有未完成的事务时无法分离，保留到下次
+    :return: 是否已分离
+    """
+    if report_id not in conn.attached_reports:
+        return True
+    try:
+        conn.execute(f'DETACH DATABASE "{report_schema(report_id)}"')
+    except sqlite3.OperationalError as e:
+        print(f"分离报告文件 {report_id} 失败: {str(e)}")
+        return False
+    for suffix, _, _ in REPORT_FILE_TABLES:
+        conn.execute(f'DROP VIEW IF EXISTS temp."{report_id}{suffix}"')
+    del conn.attached_reports[report_id]
+    return True
+
+def attach_report(conn, report_id, db_path=None):
+    """
+    附加file存储方式的报告文件，之后按报告编号查询，与报告表在主数据库中时一样
+    文件被替换或删除后重新附加或分离；超过ATTACH_LIMIT时分离最久未使用的报告
+    :param conn: rootara_db.connect或get_connection打开的连接
+    :return: 报告文件的schema名，报告不是单独的文件时返回None
+    """
+    path = report_db_path(db_path or main_db_path(conn), report_id)
+    file_id = _file_id(path)
+    attached = conn.attached_reports
+    if report_id in attached:
+        # 文件未变化，或事务中无法分离时继续使用已附加的文件
+        if attached[report_id] == file_id or not detach_report(conn, report_id):
+            attached.move_to_end(report_id)
+            return report_schema(report_id)
+    if file_id is None:
+        return None
+
+    for oldest in list(attached)[:max(0, len(attached) - ATTACH_LIMIT + 1)]:
+        detach_report(conn, oldest)
+    schema = report_schema(report_id)
+    conn.execute(f'ATTACH DATABASE ? AS "{schema}"', (path,))
+    # 早期版本的报告文件保存完整的行，转换前直接读取
+    encoded = any(row[1] == 'variant_id' for row in conn.execute(f'PRAGMA "{schema}".table_info(snps)'))
+    for suffix, table, extra in REPORT_FILE_TABLES:
+        if encoded:
+            columns = ', '.join(REPORT_VIEW_COLUMNS + [f'r.{column}' for column in extra])
+            select = f'''
+                SELECT {columns}
+                FROM "{schema}".{table} r
+                JOIN main.variants v ON v.variant_id = r.variant_id
+                JOIN main.genotype_codes c ON c.code = r.code
+            '''
+        else:
+            select = f'SELECT * FROM "{schema}".{table}'
+        conn.execute(f'CREATE TEMP VIEW IF NOT EXISTS "{report_id}{suffix}" AS {select}')
+    attached[report_id] = file_id
+    return schema
+
+def report_file_id(name):
+    """:return: 表名对应的file存储方式的报告编号，不是报告表名时返回None"""
+    if not name.startswith('RPT_'):
+        return None
+    for suffix, _, _ in REPORT_FILE_TABLES:
+        if suffix and name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+# 表结构缓存 {数据库路径: (schema_version, {名称: 类型}, {名称: 列名列表})}
+# 任何进程创建或删除表、视图后schema_version都会变化，缓存随之失效，报告的创建和删除不需要通知
+_schema_cache = {}
+_schema_lock = threading.Lock()
+
+def _schema(db_path):
+    conn = get_connection(db_path)
+    version = conn.execute('PRAGMA schema_version').fetchone()[0]
+    with _schema_lock:
+        cached = _schema_cache.get(db_path)
+        if cached is not None and cached[0] == version:
+            return cached
+    objects = dict(conn.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view')").fetchall())
+    cached = (version, objects, {})
+    with _schema_lock:
+        _schema_cache[db_path] = cached
+    return cached
+
+def invalidate_schema(db_path=None):
+    """清除表结构缓存，通常不需要调用"""
+    with _schema_lock:
+        if db_path is None:
+            _schema_cache.clear()
+        else:
+            _schema_cache.pop(db_path, None)
+
+def object_type(db_path, name):
+    """:return: 'table'、'view'，file存储方式的报告为'file'，不存在时返回None"""
+    kind = _schema(db_path)[1].get(name)
+    if kind is None and report_file_id(name) is not None:
+        if attach_report(get_connection(db_path), report_file_id(name), db_path) is not None:
+            return 'file'
+    return kind
+
+def table_exists(db_path, name):
+    """表或视图是否存在"""
+    return object_type(db_path, name) is not None
+
+def table_columns(db_path, name):
+    """:return: 表或视图的列名列表，不存在时返回空列表"""
+    _, objects, columns = _schema(db_path)
+    if name not in objects:
+        # 报告文件不在主数据库的结构中，每次附加时检查文件是否仍然存在
+        if object_type(db_path, name) != 'file':
+            return []
+        return [row[1] for row in get_connection(db_path).execute(f'PRAGMA table_info("{name}")')]
+    if name not in columns:
+        conn = get_connection(db_path)
+        columns[name] = [row[1] for row in conn.execute(f'PRAGMA table_info("{name}")')]
+    return columns[name]
+
+def write_lock_path(db_path):
+    return db_path + '.write.lock'
+
+@contextlib.contextmanager
+def write_lock(db_path):
+    """
+    跨进程、跨线程的写锁，用于长时间的写事务
+    每次打开新的文件描述符加锁，同一进程中的不同线程之间同样互斥
+    """
+    with open(write_lock_path(db_path), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+@contextlib.contextmanager
+def try_write_lock(db_path):
+    """
+    不等待的写锁，用于可以推迟的后台维护
+    :return: 是否获得写锁，写锁被占用时为False
+    """
+    with open(write_lock_path(db_path), 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,378 @@
+# coding=utf-8
+# pzw
+# 压缩的基因型存储
+# 每个报告的基因型按核心库索引的行对齐，每个位点2位，保存为列存储目录，读取时内存映射
+# 特征计算、报告的VCF导出和按报告读取基因型的祖源分析直接对数组做向量化运算，不需要从报告表中逐行读取
+# 默认不保存，设置 ROOTARA_PACKED_GENOTYPES=1 启用；未启用或不可用时读取报告表
+
+"""
+编码（每个字节保存4个位点，低位在前）：
+- 0: 未检测
+- 1: WT，两个等位基因都是Ref
+- 2: HET，Ref与Alt各一个
+- 3: HOM，两个等位基因都是Alt
+
+杂合位点还原为 Ref+Alt，原始数据中为 Alt+Ref 的杂合位点在核心库索引中的行号保存在 swapped 子目录中
+特征公式按等位基因的顺序匹配（例如 GA 与 AG 是不同的取值），还原的基因型必须与报告表完全一致
+核心库更新后按旧索引对齐的数组不再可用，open_packed_genotypes返回None，调用方回退到读取报告表
+
+无法按上面的编码还原的位点原样保存在 residual 子目录中（见RESIDUAL_COLUMNS），读取时与编码的位点合并：
+- 核心库索引中找不到的位置
+- Check不是WT/HET/HOM
+- Ref/Alt与核心库索引中该位置的Ref/Alt不同（多等位位点的其他Alt），或RSID不同
+- 基因型不是编码对应的两个等位基因（例如Y、MT上只有一个字母的基因型）
+- 同一位置出现多次时，第一次之后的位点
+因此读取的位点、RSID、Ref/Alt、Check与基因型与报告表一致，用 --check 对比
+没有 swapped 记录的旧版本数据视为不可用，回退到读取报告表
+
+python rootara_genotype_store.py --id RPT_XXXXXXXXXX --input /data/temp/reports/RPT_XXXXXXXXXX/converted
+python rootara_genotype_store.py --id RPT_XXXXXXXXXX --db /data/rootara.db --check
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_columnar import save_columns, save_dataframe, load_columns, load_dataframe, read_meta
+    from scripts.rootara_core_index import find_core_index, load_core_index
+    from scripts.rootara_converter import ROOTARA_CORE
+    from scripts.rootara_db import connect, attach_report, link_file
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_columnar import save_columns, save_dataframe, load_columns, load_dataframe, read_meta
+    from scripts.rootara_core_index import find_core_index, load_core_index
+    from scripts.rootara_converter import ROOTARA_CORE
+    from scripts.rootara_db import connect, attach_report, link_file
+
+GENOTYPE_DIR = '/data/genotypes'
+
+# 是否在导入报告时保存并读取压缩的基因型，默认不启用，特征计算、VCF导出等从报告表读取
+PACKED_GENOTYPES = os.environ.get('ROOTARA_PACKED_GENOTYPES', '0') == '1'
+
+# 转换结果Check列对应的编码，0为未检测
+CHECK_CODES = {'WT': 1, 'HET': 2, 'HOM': 3}
+CHECK_NAMES = np.array(['', 'WT', 'HET', 'HOM'], dtype=object)
+
+SITES_PER_BYTE = 4
+
+# 无法编码的位点保存的子目录与列
+RESIDUAL_DIR = 'residual'
+RESIDUAL_COLUMNS = ['Chrom', 'Start', 'Ref', 'Alt', 'RSID', 'Genotype', 'Check']
+
+# 等位基因顺序为 Alt+Ref 的杂合位点保存的子目录
+SWAPPED_DIR = 'swapped'
+
+# 一个字节解码为4个位点的编码
+_UNPACK_TABLE = np.array([[(byte >> (2 * i)) & 3 for i in range(SITES_PER_BYTE)] for byte in range(256)], dtype=np.uint8)
+
+def genotype_path(report_id, genotype_dir=GENOTYPE_DIR):
+    return os.path.join(genotype_dir, report_id)
+
+def pack_codes(codes):
+    """
+    :param codes: 每个位点一个编码(0-3)的uint8数组
+    :return: 每个字节4个位点的uint8数组
+    """
+    codes = np.asarray(codes, dtype=np.uint8)
+    padded = np.zeros(-(-len(codes) // SITES_PER_BYTE) * SITES_PER_BYTE, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    padded = padded.reshape(-1, SITES_PER_BYTE)
+    return padded[:, 0] | (padded[:, 1] << 2) | (padded[:, 2] << 4) | (padded[:, 3] << 6)
+
+def unpack_codes(packed, start, stop):
+    """:return: 第start到stop-1个位点的编码"""
+    first = start // SITES_PER_BYTE
+    last = -(-stop // SITES_PER_BYTE)
+    codes = _UNPACK_TABLE[np.asarray(packed[first:last])].reshape(-1)
+    offset = start - first * SITES_PER_BYTE
+    return codes[offset:offset + stop - start]
+
+def _text(values):
+    return pd.Series(values, dtype=object).fillna('').astype(str).to_numpy(dtype=object)
+
+def encodable_sites(sites, core_index):
+    """
+    判断每个位点能否编码后按核心库还原
+    :param sites: DataFrame，包含 Chrom、Start、Ref、Alt、RSID、Genotype、Check 列
+    :return: (核心库索引中的行号, 编码, 能否编码的布尔数组, 等位基因顺序为Alt+Ref的布尔数组)
+    """
+    rows = core_index.lookup(sites['Chrom'], sites['Start'])
+    values = pd.Series(_text(sites['Check'])).map(CHECK_CODES).fillna(0).to_numpy(dtype=np.uint8)
+    found = rows >= 0
+    ok = found & (values > 0)
+    swapped = np.zeros(len(rows), dtype=bool)
+    if found.any():
+        hit = np.flatnonzero(found)
+        ref, alt = core_index.alleles(rows[hit])
+        ok[hit] &= (_text(sites['Ref'])[hit] == ref) & (_text(sites['Alt'])[hit] == alt)
+        ok[hit] &= _text(sites['RSID'])[hit] == core_index.columns['RSID'].decode(rows[hit])
+        # 基因型必须是编码对应的两个等位基因，杂合位点可以是Alt+Ref
+        genotype = _text(sites['Genotype'])[hit]
+        code = values[hit]
+        expected = np.where(code == CHECK_CODES['WT'], ref + ref, np.where(code == CHECK_CODES['HOM'], alt + alt, ref + alt))
+        swapped[hit] = (code == CHECK_CODES['HET']) & (genotype == alt + ref) & (ref != alt)
+        ok[hit] &= (genotype == expected) | swapped[hit]
+    # 同一行只编码第一次出现的位点
+    ok &= ~pd.Series(rows).duplicated().to_numpy()
+    return rows, values, ok, swapped & ok
+
+def save_packed_genotypes(report_id, sites, core_index, genotype_dir=GENOTYPE_DIR):
+    """
+    :param sites: DataFrame，包含 Chrom、Start、Ref、Alt、RSID、Genotype、Check 列
+    :return: 保存的目录
+    """
+    rows, values, ok, swapped = encodable_sites(sites, core_index)
+    codes = np.zeros(len(core_index), dtype=np.uint8)
+    codes[rows[ok]] = values[ok]
+    residual = pd.DataFrame({
+        name: pd.to_numeric(sites[name]).to_numpy(dtype=np.int64)[~ok] if name == 'Start' else _text(sites[name])[~ok]
+        for name in RESIDUAL_COLUMNS
+    })
+
+    # 先写入临时目录，完成后替换，读取时不会看到不完整的数据
+    target = genotype_path(report_id, genotype_dir)
+    temp = target + '.building'
+    remove_dir(temp)
+    save_columns(temp, {'packed': pack_codes(codes)}, {
+        'sites': len(codes),
+        'called': int(np.count_nonzero(codes)),
+        'residual': len(residual),
+        'swapped': int(np.count_nonzero(swapped)),
+        'core_sha256': core_index.version
+    })
+    save_dataframe(os.path.join(temp, RESIDUAL_DIR), residual, ['Chrom', 'Ref', 'Alt', 'Check'])
+    save_columns(os.path.join(temp, SWAPPED_DIR), {'rows': np.sort(rows[swapped]).astype(np.int64)})
+    remove_dir(target)
+    os.replace(temp, target)
+    return target
+
+def remove_dir(path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+def store_packed_genotypes(report_id, rootara_data, rootara_core=ROOTARA_CORE, genotype_dir=GENOTYPE_DIR):
+    """
+    从转换结果保存报告的压缩基因型，没有核心库索引或未启用时不保存
+    保存失败不影响报告，分析时回退到读取报告表
+    :param rootara_data: 转换结果的列存储目录
+    :return: 保存的目录，未保存时返回None
+    """
+    if not PACKED_GENOTYPES or not os.path.isdir(rootara_data):
+        return None
+    index_path = find_core_index(rootara_core)
+    if index_path is None:
+        return None
+    try:
+        core_index = load_core_index(index_path)
+        sites = load_dataframe(rootara_data, RESIDUAL_COLUMNS)
+        return save_packed_genotypes(report_id, sites, core_index, genotype_dir)
+    except Exception as e:
+        print(f"保存报告 {report_id} 的压缩基因型失败: {str(e)}")
+        return None
+
+def link_packed_genotypes(source_id, report_id, genotype_dir=GENOTYPE_DIR):
+    """原始数据相同的报告共用压缩基因型，使用硬链接，不支持时复制"""
+    source = genotype_path(source_id, genotype_dir)
+    if not os.path.exists(os.path.join(source, 'meta.json')):
+        return None
+    target = genotype_path(report_id, genotype_dir)
+    temp = target + '.building'
+    remove_dir(temp)
+    shutil.copytree(source, temp, copy_function=link_file)
+    remove_dir(target)
+    os.replace(temp, target)
+    return target
+
+def remove_packed_genotypes(report_id, genotype_dir=GENOTYPE_DIR):
+    remove_dir(genotype_path(report_id, genotype_dir))
+    remove_dir(genotype_path(report_id, genotype_dir) + '.building')
+
+# 内存映射的压缩基因型
+class PackedGenotypes:
+    def __init__(self, path, core_index):
+        columns, meta = load_columns(path, mmap=True)
+        self.packed = columns['packed']
+        self.sites = meta['attrs']['sites']
+        self.core_index = core_index
+        self.residual = load_dataframe(os.path.join(path, RESIDUAL_DIR), RESIDUAL_COLUMNS) \
+            if meta['attrs']['residual'] else pd.DataFrame({name: [] for name in RESIDUAL_COLUMNS})
+        self.swapped = np.asarray(load_columns(os.path.join(path, SWAPPED_DIR), mmap=False)[0]['rows']) \
+            if meta['attrs']['swapped'] else np.zeros(0, dtype=np.int64)
+
+    def chrom_range(self, chrom):
+        """:return: 染色体在核心库索引中的行范围 (start, stop)"""
+        code = self.core_index.chrom_code.get(str(chrom))
+        if code is None:
+            return 0, 0
+        keys = self.core_index.keys
+        return int(np.searchsorted(keys, code << 32)), int(np.searchsorted(keys, (code + 1) << 32))
+
+    def called(self, chroms=None):
+        """
+        :param chroms: 只取这些染色体，默认全部
+        :return: (检测到的位点在核心库索引中的行号, 编码)
+        """
+        ranges = [self.chrom_range(chrom) for chrom in chroms] if chroms is not None else [(0, self.sites)]
+        rows, codes = [], []
+        for start, stop in ranges:
+            part = unpack_codes(self.packed, start, stop)
+            hit = np.flatnonzero(part)
+            rows.append(hit + start)
+            codes.append(part[hit])
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        return np.concatenate(rows).astype(np.int64), np.concatenate(codes)
+
+    def is_swapped(self, rows):
+        """:return: 每个位点是否为Alt+Ref顺序的杂合位点"""
+        if len(self.swapped) == 0:
+            return np.zeros(len(rows), dtype=bool)
+        found = np.minimum(np.searchsorted(self.swapped, rows), len(self.swapped) - 1)
+        return self.swapped[found] == rows
+
+    def alleles(self, rows, codes):
+        """:return: (第一个等位基因, 第二个等位基因)，dtype为U1，与原始数据的顺序一致"""
+        ref = np.asarray(self.core_index.columns['ref'][rows])
+        alt = np.asarray(self.core_index.columns['alt'][rows])
+        swapped = self.is_swapped(rows)
+        first = np.where((codes == CHECK_CODES['HOM']) | swapped, alt, ref)
+        second = np.where((codes == CHECK_CODES['WT']) | swapped, ref, alt)
+        return first.view('S1').astype('U1'), second.view('S1').astype('U1')
+
+    def genotypes(self, rows, codes):
+        """:return: 基因型字符串数组，dtype为object"""
+        first, second = self.alleles(rows, codes)
+        return np.char.add(first, second).astype(object)
+
+    def rsids(self, rows):
+        return self.core_index.columns['RSID'].decode(rows)
+
+    def rsid_genotypes(self, rsids=None):
+        """
+        :param rsids: 只取这些RSID，默认全部，按字节比较后只解码用到的位点
+        :return: (RSID数组, 基因型数组)，包含无法编码的位点
+        """
+        rows, codes = self.called()
+        residual = self.residual
+        if rsids is not None:
+            rsids = set(rsids)
+            keep = self.core_index.columns['RSID'].isin(rsids, rows)
+            rows, codes = rows[keep], codes[keep]
+            residual = residual[residual['RSID'].isin(rsids)]
+        return (np.concatenate([self.rsids(rows), residual['RSID'].to_numpy(dtype=object)]),
+                np.concatenate([self.genotypes(rows, codes), residual['Genotype'].to_numpy(dtype=object)]))
+
+    def dataframe(self, chroms=None, rsid=False, alleles=False):
+        """
+        :param rsid: 是否包含RSID列
+        :param alleles: 是否包含Ref、Alt、Check列
+        :return: 与报告表对应的 Chrom、Start、Genotype 列，包含无法编码的位点
+        """
+        rows, codes = self.called(chroms)
+        df = pd.DataFrame({
+            'Chrom': self.core_index.chrom_names(rows),
+            'Start': self.core_index.positions(rows).astype(np.int64),
+            'Genotype': self.genotypes(rows, codes)
+        })
+        if rsid:
+            df['RSID'] = self.rsids(rows)
+        if alleles:
+            df['Ref'], df['Alt'] = self.core_index.alleles(rows)
+            df['Check'] = CHECK_NAMES[codes]
+        residual = self.residual
+        if chroms is not None:
+            residual = residual[residual['Chrom'].astype(str).isin([str(chrom) for chrom in chroms])]
+        if len(residual):
+            df = pd.concat([df, residual[df.columns]], ignore_index=True)
+        return df
+
+def open_packed_genotypes(report_id, rootara_core=ROOTARA_CORE, genotype_dir=GENOTYPE_DIR):
+    """
+    :return: PackedGenotypes，未启用、不存在或与当前核心库不一致时返回None
+    """
+    path = genotype_path(report_id, genotype_dir)
+    if not PACKED_GENOTYPES or not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+    index_path = find_core_index(rootara_core)
+    if index_path is None:
+        return None
+    core_index = load_core_index(index_path)
+    attrs = read_meta(path)['attrs']
+    if attrs.get('core_sha256') != core_index.version or attrs.get('sites') != len(core_index):
+        return None
+    # 旧版本没有保存无法编码的位点和杂合位点的等位基因顺序
+    if 'residual' not in attrs or 'swapped' not in attrs:
+        return None
+    return PackedGenotypes(path, core_index)
+
+# 对比的列，与报告表的列对应
+CHECK_COLUMNS = ['Chrom', 'Start', 'Ref', 'Alt', 'RSID', 'Genotype', 'Check']
+
+def _site_keys(df):
+    """按位点排序的全部对比列"""
+    return pd.DataFrame({
+        name: pd.to_numeric(df[name]).to_numpy(dtype=np.int64) if name == 'Start' else _text(df[name])
+        for name in CHECK_COLUMNS
+    }).sort_values(CHECK_COLUMNS).reset_index(drop=True)
+
+def check_packed_genotypes(report_id, db_file):
+    """
+    对比压缩基因型还原的位点与报告表，读取压缩基因型的特征计算、VCF导出的输入应当一致
+    :return: 一致返回True，否则返回False
+    """
+    packed = open_packed_genotypes(report_id)
+    if packed is None:
+        print(f"报告 {report_id} 没有可用的压缩基因型")
+        return False
+    conn = connect(db_file)
+    try:
+        attach_report(conn, report_id)
+        table = pd.read_sql_query(f'''
+            SELECT chromosome AS Chrom, position AS Start, ref AS Ref, alt AS Alt, rsid AS RSID, genotype AS Genotype, gt AS "Check"
+            FROM "{report_id}"
+        ''', conn)
+    finally:
+        conn.close()
+    expected = _site_keys(table)
+    actual = _site_keys(packed.dataframe(rsid=True, alleles=True))
+    print(f"报告表 {len(expected)} 个位点，压缩基因型 {len(actual)} 个位点（其中无法编码 {len(packed.residual)} 个）")
+    if expected.equals(actual):
+        print("压缩基因型与报告表一致")
+        return True
+    diff = expected.merge(actual, how='outer', indicator=True)
+    diff = diff[diff['_merge'] != 'both']
+    print(f"不一致的位点 {len(diff)} 个:")
+    print(diff.head(20).to_string(index=False))
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description='从转换结果保存报告的压缩基因型')
+    parser.add_argument('--id', type=str, help='报告编号')
+    parser.add_argument('--input', type=str, help='转换结果的列存储目录')
+    parser.add_argument('--core', type=str, help='核心库文件路径', default=ROOTARA_CORE)
+    parser.add_argument('--db', type=str, help='数据库文件，与--check一起使用')
+    parser.add_argument('--check', action='store_true', help='对比压缩基因型与报告表')
+    args = parser.parse_args()
+
+    if args.check and args.id and args.db:
+        sys.exit(0 if check_packed_genotypes(args.id, args.db) else 1)
+
+    if not all([args.id, args.input]):
+        parser.print_help()
+        sys.exit(1)
+
+    path = store_packed_genotypes(args.id, args.input, args.core)
+    if path is None:
+        print("未保存压缩基因型，需要核心库索引")
+        sys.exit(1)
+    print(f"已保存压缩基因型: {path}")
+
+if __name__ == '__main__':
+    main()
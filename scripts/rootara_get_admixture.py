@@ -1,13 +1,40 @@
 # coding=utf-8
 # 祖源分析结果查询
 
-import sqlite3
+import os
+import sys
 
-def get_admixture_info(report_id, db_path):
-    # 连接到数据库
-    conn = sqlite3.connect(db_path)
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import get_connection, table_exists
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import get_connection, table_exists
+
+# 早期版本只计算K47，结果按列保存在admixture表中
+LEGACY_MODEL = 'K47'
+
+def get_admixture_info(report_id, db_path, model=LEGACY_MODEL):
+    # 使用当前线程复用的连接
+    conn = get_connection(db_path)
     cursor = conn.cursor()
 
+    # 查询admixture_result表中该模型的结果
+    if table_exists(db_path, 'admixture_result'):
+        cursor.execute(
+            "SELECT component, value FROM admixture_result WHERE report_id=? AND model=?",
+            (report_id, model)
+        )
+        rows = cursor.fetchall()
+        if rows:
+            return {component: value for component, value in rows}
+
+    # 没有结果时，K47模型查询旧的admixture表
+    if model != LEGACY_MODEL:
+        return {}
+
     # 检查report_id是否存在于admixture表中
     cursor.execute("SELECT COUNT(*) FROM admixture WHERE report_id=?", (report_id,))
     if cursor.fetchone()[0] == 0:
@@ -17,20 +44,32 @@ def get_admixture_info(report_id, db_path):
 
     # 查询admixture表中的数据
     cursor.execute("""
-        SELECT * FROM admixture WHERE report_id=?""", 
+        SELECT * FROM admixture WHERE report_id=?""",
         (report_id,)
     )
     row = cursor.fetchone()
-    
+
     # 获取列名
     column_names = [description[0] for description in cursor.description]
-    
+
     # 将查询结果转换为字典，排除report_id列
     result = {}
     for i, column_name in enumerate(column_names):
         if column_name != 'report_id':
             result[column_name] = row[i]
-    
-    # 关闭数据库连接
-    conn.close()
+
     return result
+
+# 查询报告已有结果的模型
+def get_admixture_models(report_id, db_path):
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    models = []
+    if table_exists(db_path, 'admixture_result'):
+        cursor.execute("SELECT DISTINCT model FROM admixture_result WHERE report_id=? ORDER BY model", (report_id,))
+        models = [row[0] for row in cursor.fetchall()]
+    if LEGACY_MODEL not in models:
+        cursor.execute("SELECT COUNT(*) FROM admixture WHERE report_id=?", (report_id,))
+        if cursor.fetchone()[0] > 0:
+            models.append(LEGACY_MODEL)
+    return models
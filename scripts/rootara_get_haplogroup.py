@@ -2,11 +2,21 @@
 # pzw
 # 查询单倍群信息
 
-import sqlite3
+import os
+import sys
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import get_connection
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import get_connection
 
 def get_haplogroup_info(report_id, db_path):
-    # 连接到数据库
-    conn = sqlite3.connect(db_path)
+    # 使用当前线程复用的连接
+    conn = get_connection(db_path)
     cursor = conn.cursor()
 
     # 检查report_id是否存在于haplogroup表中
@@ -31,7 +41,4 @@ def get_haplogroup_info(report_id, db_path):
     for i, column_name in enumerate(column_names):
         if column_name != 'report_id':
             result[column_name] = row[i]
-    
-    # 关闭数据库连接
-    conn.close()
     return result
@@ -3,22 +3,26 @@
 # 查询用户ID
 # 因为现在只允许一个用户，所以用户ID直接get第一个就好
 
-import sqlite3
+import os
+import sys
 
-def get_user_id(db_path):
-    # 连接到数据库
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import get_connection, table_exists
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import get_connection, table_exists
 
+def get_user_id(db_path):
     # 检查表是否存在
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
-    if not cursor.fetchone():
+    if not table_exists(db_path, 'users'):
         # 表不存在时返回空结果
         return None
 
     # 查询用户ID
-    cursor.execute("SELECT user_id FROM users LIMIT 1")
-    user_id = cursor.fetchone()
+    user_id = get_connection(db_path).execute("SELECT user_id FROM users LIMIT 1").fetchone()
     if user_id:
         return user_id[0]
     else:
@@ -6,16 +6,35 @@
 
 import os
 import sys
+import csv
 import argparse
 import sqlite3
 import tempfile
+import functools
 import pandas as pd
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_2_vcf import trans_rootara_to_haplogroup_vcf
+    from scripts.rootara_db import connect
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_2_vcf import trans_rootara_to_haplogroup_vcf
+    from scripts.rootara_db import connect
+
+HAPLOGROUPER_DIR = '/app/haploGrouper'
+HAPLOGROUPER_DATA = f'{HAPLOGROUPER_DIR}/data'
+Y_TREE = f'{HAPLOGROUPER_DATA}/chrY_isogg2019_tree.txt'
+Y_LOCI = f'{HAPLOGROUPER_DATA}/chrY_isogg2019-decode1_loci_b37.txt'
+MT_TREE = f'{HAPLOGROUPER_DATA}/chrMT_phylotree17_tree.txt'
+MT_LOCI = f'{HAPLOGROUPER_DATA}/chrMT_phylotree17_loci.txt'
 
 def y_haplogroup(vcf_file, output_dir, rpt_id):
-    base_dir = '/app/haploGrouper'
-    data_dir = f'{base_dir}/data'
-    tool = f'{base_dir}/haploGrouper.py'
+    tool = f'{HAPLOGROUPER_DIR}/haploGrouper.py'
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -23,17 +42,15 @@ def y_haplogroup(vcf_file, output_dir, rpt_id):
     cmd = f"""
         python3 {tool} \\
             -v {vcf_file} \\
-            -t {data_dir}/chrY_isogg2019_tree.txt \\
-            -l {data_dir}/chrY_isogg2019-decode1_loci_b37.txt \\
+            -t {Y_TREE} \\
+            -l {Y_LOCI} \\
             -o {output_dir}/{rpt_id}.YHap.txt
     """
 
     os.system(cmd)
 
 def mt_haplogroup(vcf_file, output_dir, rpt_id):
-    base_dir = '/app/haploGrouper'
-    data_dir = f'{base_dir}/data'
-    tool = f'{base_dir}/haploGrouper.py'
+    tool = f'{HAPLOGROUPER_DIR}/haploGrouper.py'
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -41,13 +58,124 @@ def mt_haplogroup(vcf_file, output_dir, rpt_id):
     cmd = f"""
         python3 {tool} \\
             -v {vcf_file} \\
-            -t {data_dir}/chrMT_phylotree17_tree.txt \\
-            -l {data_dir}/chrMT_phylotree17_loci.txt \\
+            -t {MT_TREE} \\
+            -l {MT_LOCI} \\
             -o {output_dir}/{rpt_id}.MTHap.txt
     """
 
     os.system(cmd)
 
+# 位置列可能使用的列名
+POSITION_COLUMNS = ['pos', 'position', 'pos_b37', 'position_b37', 'grch37', 'b37', 'hg19', 'start']
+
+@functools.lru_cache(maxsize=None)
+def read_loci_positions(loci_file):
+    """
+    读取loci文件中的位点位置，每个进程只读取一次
+    优先使用表头中的位置列，没有可识别的表头时使用唯一一个全部为整数的列
+    :return: 位置集合，文件不存在或无法确定位置列时返回None，此时不按位点过滤
+    """
+    if not os.path.exists(loci_file):
+        return None
+    try:
+        df = pd.read_csv(loci_file, sep='\t', header=None, dtype=str, quoting=csv.QUOTE_NONE).dropna(how='all')
+    except Exception as e:
+        print(f"读取loci文件失败，不按位点过滤: {loci_file}，{str(e)}")
+        return None
+    if df.empty:
+        return None
+
+    header = [str(value).strip().lower() for value in df.iloc[0]]
+    column = next((header.index(name) for name in POSITION_COLUMNS if name in header), None)
+    if column is not None:
+        values = df.iloc[1:, column]
+    else:
+        integer_columns = [i for i in df.columns if df[i].str.strip().str.fullmatch(r'\d+').fillna(False).all()]
+        if len(integer_columns) != 1:
+            print(f"无法确定loci文件的位置列，不按位点过滤: {loci_file}")
+            return None
+        values = df[integer_columns[0]]
+
+    positions = pd.to_numeric(values.str.strip(), errors='coerce').dropna().astype('int64')
+    if positions.empty:
+        return None
+    return frozenset(positions.tolist())
+
+# Y、MT单倍群树用到的位点
+def haplogroup_loci():
+    return {'y': read_loci_positions(Y_LOCI), 'mt': read_loci_positions(MT_LOCI)}
+
+def make_haplogroup_vcfs(rootara_data, output_dir, use_loci=True):
+    """
+    从转换结果生成单倍群分析使用的VCF，只包含Y染色体和线粒体的位点
+    :param rootara_data: 转换结果的列存储目录或CSV文件
+    :param output_dir: 输出目录
+    :param use_loci: 是否只保留loci文件中的位点
+    :return: {'y': Y染色体VCF, 'mt': 线粒体VCF}
+    """
+    loci = haplogroup_loci() if use_loci else None
+    return trans_rootara_to_haplogroup_vcf(rootara_data, os.path.join(output_dir, 'haplogroup'), loci)
+
+# 每次分析使用独立的临时目录
+def make_running_dir():
+    # 创建一个固定的临时目录
+    temp_base_dir = '/data/temp'
+    if not os.path.exists(temp_base_dir):
+        os.makedirs(temp_base_dir, exist_ok=True)
+
+    # 使用固定目录创建临时目录
+    return tempfile.mkdtemp(dir=temp_base_dir)
+
+# 解析haploGrouper的结果文件，返回单倍群
+def read_haplogroup_result(result_file):
+    df = pd.read_csv(result_file, sep='\t', header=0)
+    return str(df['Haplogroup'].values[0])
+
+# 在独立的临时目录中运行Y单倍群分析，返回单倍群
+def call_y_haplogroup(vcf_file, rpt_id):
+    running_dir = make_running_dir()
+    try:
+        y_haplogroup(vcf_file, running_dir, rpt_id)
+        return read_haplogroup_result(f"{running_dir}/{rpt_id}.YHap.txt")
+    finally:
+        shutil.rmtree(running_dir)
+
+# 在独立的临时目录中运行MT单倍群分析，返回单倍群
+def call_mt_haplogroup(vcf_file, rpt_id):
+    running_dir = make_running_dir()
+    try:
+        mt_haplogroup(vcf_file, running_dir, rpt_id)
+        return read_haplogroup_result(f"{running_dir}/{rpt_id}.MTHap.txt")
+    finally:
+        shutil.rmtree(running_dir)
+
+# 使用haploGrouper分别分析Y、MT单倍群，两个进程同时运行
+def call_haplogrouper(vcf_files, rpt_id):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        y_future = executor.submit(call_y_haplogroup, vcf_files['y'], rpt_id)
+        mt_future = executor.submit(call_mt_haplogroup, vcf_files['mt'], rpt_id)
+        return y_future.result(), mt_future.result()
+
+def call_report_haplogroups(rpt_id, rootara_data):
+    """
+    分析转换结果的Y、MT单倍群：生成只包含Y、MT位点的VCF，运行haploGrouper
+    :param rootara_data: 转换结果的列存储目录
+    :return: (Y单倍群, MT单倍群)
+    """
+    running_dir = make_running_dir()
+    try:
+        return call_haplogrouper(make_haplogroup_vcfs(rootara_data, running_dir), rpt_id)
+    finally:
+        shutil.rmtree(running_dir)
+
+# 插入结果到数据库
+def import_haplogroup_to_db(rpt_id, y_hap, mt_hap, db_file):
+    conn = connect(db_file)
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO haplogroup (report_id, y_hap, mt_hap) VALUES (?, ?, ?)", (rpt_id, y_hap, mt_hap))
+    conn.commit()
+    conn.close()
+
 # 查询数据库中这个编号的报告是否已存在结果，如已存在，不重新分析
 def insert_haplogroup_to_db(rpt_id, vcf_file, db_file, force=False):
     conn = sqlite3.connect(db_file)
@@ -56,39 +184,24 @@ def insert_haplogroup_to_db(rpt_id, vcf_file, db_file, force=False):
     # 检查是否已存在结果
     cursor.execute("SELECT COUNT(*) FROM haplogroup WHERE report_id = ?", (rpt_id,))
     count = cursor.fetchone()[0]
+    conn.close()
 
     if count > 0 and not force:
         print(f"报告 {rpt_id} 已存在结果，跳过分析。")
         return
 
-    # 创建一个固定的临时目录
-    temp_base_dir = '/data/temp'
-    if not os.path.exists(temp_base_dir):
-        os.makedirs(temp_base_dir, exist_ok=True)
-    
-    # 使用固定目录创建临时目录
-    running_dir = tempfile.mkdtemp(dir=temp_base_dir)
-    
-    y_haplogroup(vcf_file, running_dir, rpt_id)
-    mt_haplogroup(vcf_file, running_dir, rpt_id)
-    y_haplogroup_result = f"{running_dir}/{rpt_id}.YHap.txt"
-    mt_haplogroup_result = f"{running_dir}/{rpt_id}.MTHap.txt"
-
-    # 对结果进行解析
-    df_y = pd.read_csv(y_haplogroup_result, sep='\t', header=0)
-    df_mt = pd.read_csv(mt_haplogroup_result, sep='\t', header=0)
-
-    y_hap = df_y['Haplogroup'].values[0]
-    mt_hap = df_mt['Haplogroup'].values[0]
-
-    # 插入结果到数据库
-    cursor.execute("INSERT INTO haplogroup (report_id, y_hap, mt_hap) VALUES (?, ?, ?)", (rpt_id, y_hap, mt_hap))
-    conn.commit()
-    shutil.rmtree(running_dir)
+    # vcf_file可以是全基因组VCF，也可以是make_haplogroup_vcfs生成的Y、MT两个VCF
+    if isinstance(vcf_file, dict):
+        y_vcf, mt_vcf = vcf_file['y'], vcf_file['mt']
+    else:
+        y_vcf = mt_vcf = vcf_file
+    y_hap = call_y_haplogroup(y_vcf, rpt_id)
+    mt_hap = call_mt_haplogroup(mt_vcf, rpt_id)
+    import_haplogroup_to_db(rpt_id, y_hap, mt_hap, db_file)
 
 def main():
     parser = argparse.ArgumentParser(description='分析单倍型')
-    parser.add_argument('--input', type=str, help='输入VCF文件')
+    parser.add_argument('--input', type=str, help='输入VCF文件，或转换结果的列存储目录')
     parser.add_argument('--id', type=str, help='输入报告编号')
     parser.add_argument('--db', type=str, help='数据数据库文件')
     parser.add_argument('--force', type=bool, help='是否强制执行，默认False', default=False)
@@ -100,6 +213,15 @@ def main():
         sys.exit(1)
 
     try:
+        # 输入为转换结果时，先生成只包含Y、MT位点的VCF
+        if args.input and os.path.isdir(args.input):
+            running_dir = make_running_dir()
+            try:
+                vcf_files = make_haplogroup_vcfs(args.input, running_dir)
+                insert_haplogroup_to_db(args.id, vcf_files, args.db, args.force)
+            finally:
+                shutil.rmtree(running_dir)
+            return
         insert_haplogroup_to_db(args.id, args.input, args.db, args.force)
     except Exception as e:
         print(f"Error: {e}")
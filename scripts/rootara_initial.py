@@ -14,10 +14,14 @@ if __name__ == "__main__":
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     from scripts.rootara_report_create import create_new_report
     from scripts.rootara_traits import json_to_trait_table
+    from scripts.rootara_snp_2_db import report_data_exists, drop_report_data
+    from scripts.rootara_db import connect, attach_report
 else:
     # 作为模块导入时使用相对导入
     from scripts.rootara_report_create import create_new_report
     from scripts.rootara_traits import json_to_trait_table
+    from scripts.rootara_snp_2_db import report_data_exists, drop_report_data
+    from scripts.rootara_db import connect, attach_report
 
 def generate_random_id():
     """
@@ -46,6 +50,10 @@ def init_sqlite_db(db_path):
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
 
+        # 新数据库使用增量自动清理，删除报告后空闲的页由后台维护线程分批回收（见rootara_maintenance）
+        # 只在创建第一张表之前生效，已有的数据库由rootara_maintenance转换
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
         # 创建用户表 || 这个表暂时是摆设，没有用
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -69,6 +77,9 @@ def init_sqlite_db(db_path):
             select_default boolean,
             total_snps INTEGER,
             upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            content_hash TEXT DEFAULT null,
+            data_ref TEXT DEFAULT null,
+            rawdata_path TEXT DEFAULT null,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
         ''')
@@ -154,6 +165,17 @@ def init_sqlite_db(db_path):
         )
         ''')
 
+        # 创建祖源分析结果表，每个模型的每个成分一行
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admixture_result (
+            report_id TEXT NOT NULL,
+            model TEXT NOT NULL,
+            component TEXT NOT NULL,
+            value REAL DEFAULT 0.00,
+            PRIMARY KEY (report_id, model, component)
+        )
+        ''')
+
         # 提交事务
         conn.commit()
 
@@ -229,9 +251,8 @@ def generate_template_data(name, email, db_path, force=False):
         # 强制重新创建SNP表
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (template_id,))
-        if cursor.fetchone():
-            cursor.execute(f'DROP TABLE {template_id}')
+        if report_data_exists(conn, template_id):
+            drop_report_data(conn, template_id)
             conn.commit()
             print("强制删除现有SNP表")
         conn.close()
@@ -290,10 +311,9 @@ def generate_template_data(name, email, db_path, force=False):
         conn.close()
 
         # 检查并创建SNP表
-        conn = sqlite3.connect(db_path)
+        conn = connect(db_path)
         cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (template_id,))
-        table_exists = cursor.fetchone()
+        table_exists = report_data_exists(conn, template_id)
 
         if not table_exists:
             conn.close()
@@ -301,6 +321,7 @@ def generate_template_data(name, email, db_path, force=False):
             print("创建SNP表")
         else:
             # 表存在，但检查是否有数据
+            attach_report(conn, template_id)
             cursor.execute(f"SELECT COUNT(*) FROM {template_id}")
             row_count = cursor.fetchone()[0]
             conn.close()
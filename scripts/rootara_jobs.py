@@ -0,0 +1,145 @@
+# coding=utf-8
+# pzw
+# 后台任务队列
+# 创建报告需要运行格式转换、祖源分析、单倍群分析等耗时步骤，不能在事件循环中同步执行
+# 任务提交到有界的后台线程池后立即返回任务ID，通过任务ID查询状态和当前运行的阶段
+
+import os
+import uuid
+import threading
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# 同时运行的任务数和允许排队的任务数，可通过环境变量调整
+MAX_WORKERS = int(os.environ.get('ROOTARA_JOB_WORKERS', '2'))
+MAX_PENDING = int(os.environ.get('ROOTARA_JOB_QUEUE_SIZE', '16'))
+
+# 内存中最多保留的已结束任务数
+MAX_FINISHED = 200
+
+_executor = None
+_jobs = {}
+_lock = threading.Lock()
+
+class JobQueueFull(Exception):
+    """排队任务已达上限"""
+    pass
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='rootara_job')
+    return _executor
+
+def _now():
+    return datetime.now().isoformat()
+
+# 清理最早结束的任务，避免任务记录无限增长
+def _prune_finished():
+    finished = [job for job in _jobs.values() if job['status'] in ('finished', 'failed')]
+    if len(finished) <= MAX_FINISHED:
+        return
+    finished.sort(key=lambda job: job['finished_at'])
+    for job in finished[:len(finished) - MAX_FINISHED]:
+        del _jobs[job['job_id']]
+
+# 生成阶段回调函数，由任务函数在阶段开始、结束时调用
+def _make_progress_callback(job_id):
+    def progress_callback(stage, status='running'):
+        with _lock:
+            job = _jobs.get(job_id)
+            if job is None:
+                return
+            job['stages'][stage] = status
+            running = [name for name, value in job['stages'].items() if value == 'running']
+            job['stage'] = running[-1] if running else stage
+            done = sum(1 for value in job['stages'].values() if value == 'done')
+            job['progress'] = round(100 * done / len(job['stages']), 1) if job['stages'] else 0
+    return progress_callback
+
+def _run_job(job_id, func, args, kwargs):
+    with _lock:
+        job = _jobs[job_id]
+        job['status'] = 'running'
+        job['started_at'] = _now()
+
+    try:
+        result = func(*args, progress_callback=_make_progress_callback(job_id), **kwargs)
+        with _lock:
+            job['status'] = 'finished'
+            job['progress'] = 100
+            job['result'] = result
+    except Exception as e:
+        traceback.print_exc()
+        with _lock:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+    finally:
+        with _lock:
+            job['finished_at'] = _now()
+            _prune_finished()
+
+def submit_job(job_type, func, *args, stages=None, **kwargs):
+    """
+    提交后台任务
+    :param job_type: 任务类型，如 report_create
+    :param func: 任务函数，需要接受 progress_callback 关键字参数
+    :param stages: 任务包含的阶段名称列表，用于计算进度
+    :return: 任务ID
+    """
+    with _lock:
+        pending = sum(1 for job in _jobs.values() if job['status'] in ('queued', 'running'))
+        if pending >= MAX_WORKERS + MAX_PENDING:
+            raise JobQueueFull(f"任务队列已满，当前排队任务数: {pending}")
+
+        job_id = 'JOB_' + uuid.uuid4().hex[:16].upper()
+        _jobs[job_id] = {
+            'job_id': job_id,
+            'type': job_type,
+            'status': 'queued',
+            'stage': None,
+            'stages': {stage: 'pending' for stage in (stages or [])},
+            'progress': 0,
+            'result': None,
+            'error': None,
+            'created_at': _now(),
+            'started_at': None,
+            'finished_at': None
+        }
+
+    _get_executor().submit(_run_job, job_id, func, args, kwargs)
+    return job_id
+
+# 查询任务状态，任务不存在时返回None
+def get_job(job_id):
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        job = dict(job)
+        job['stages'] = dict(job['stages'])
+        return job
+
+# 查询任务进度
+def get_job_progress(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return None
+    return {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'progress': job['progress'],
+        'stages': job['stages']
+    }
+
+# 列出所有任务
+def list_jobs():
+    with _lock:
+        return [dict(job, stages=dict(job['stages'])) for job in _jobs.values()]
+
+# 正在排队或运行的任务数
+def active_job_count():
+    with _lock:
+        return sum(1 for job in _jobs.values() if job['status'] in ('queued', 'running'))
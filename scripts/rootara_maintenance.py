@@ -0,0 +1,289 @@
+# coding=utf-8
+# pzw
+# 数据库的后台维护
+# 删除报告表后空闲的页留在数据库文件中，数据库只会变大；完整的VACUUM需要锁住数据库几分钟
+# 数据库使用增量自动清理（auto_vacuum = INCREMENTAL），空闲时分批回收空闲页，每批在写锁内运行，限制运行时间
+# 定时运行ANALYZE更新查询优化器的统计信息；维护的进度和回收的空间通过状态接口查询
+
+"""
+python rootara_maintenance.py --db /data/rootara.db --status
+python rootara_maintenance.py --db /data/rootara.db --enable-auto-vacuum
+"""
+
+import os
+import sys
+import time
+import json
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import connect, write_lock, try_write_lock
+    from scripts.rootara_jobs import active_job_count
+    from scripts.rootara_snp_2_db import ANALYSIS_LIMIT
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import connect, write_lock, try_write_lock
+    from scripts.rootara_jobs import active_job_count
+    from scripts.rootara_snp_2_db import ANALYSIS_LIMIT
+
+# 维护线程检查的间隔（秒）
+MAINTENANCE_INTERVAL = int(os.environ.get('ROOTARA_MAINTENANCE_INTERVAL', '60'))
+
+# 每批回收的页数，以及每次检查时回收空闲页的最长时间（秒），超过后等下次检查再继续
+VACUUM_BATCH_PAGES = int(os.environ.get('ROOTARA_VACUUM_BATCH_PAGES', '1000'))
+VACUUM_TIME_BUDGET = float(os.environ.get('ROOTARA_VACUUM_TIME_BUDGET', '2'))
+
+# 运行ANALYZE的间隔（小时）
+ANALYZE_INTERVAL_HOURS = float(os.environ.get('ROOTARA_ANALYZE_INTERVAL_HOURS', '24'))
+
+# 已有的数据库转换为增量自动清理需要运行一次完整的VACUUM，只自动转换不超过这个大小（MB）的数据库
+# 更大的数据库在停机维护时运行 --enable-auto-vacuum
+AUTO_VACUUM_CONVERT_MB = float(os.environ.get('ROOTARA_AUTO_VACUUM_CONVERT_MB', '256'))
+
+# 后台维护获取连接时等待其他连接释放写锁的时间（秒），超时后推迟到下次
+BUSY_TIMEOUT = 1
+
+# auto_vacuum的取值
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+def _now():
+    return datetime.now().isoformat()
+
+def database_space(db_path):
+    """
+    :return: 数据库文件的页数、空闲页数和大小
+    """
+    conn = connect(db_path, timeout=BUSY_TIMEOUT)
+    try:
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        'auto_vacuum': AUTO_VACUUM_MODES.get(auto_vacuum, str(auto_vacuum)),
+        'page_size': page_size,
+        'page_count': page_count,
+        'freelist_count': freelist_count,
+        'free_bytes': freelist_count * page_size,
+        'file_bytes': os.path.getsize(db_path),
+        'wal_bytes': os.path.getsize(db_path + '-wal') if os.path.exists(db_path + '-wal') else 0
+    }
+
+def enable_auto_vacuum(db_path):
+    """
+    已有的数据库切换为增量自动清理，需要运行一次完整的VACUUM，期间其他写入等待写锁
+    :return: 是否进行了转换
+    """
+    with write_lock(db_path):
+        conn = connect(db_path, isolation_level=None)
+        try:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                return False
+            start = time.perf_counter()
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        finally:
+            conn.close()
+    print(f"数据库 {db_path} 切换为增量自动清理，耗时 {time.perf_counter() - start:.2f} 秒")
+    return True
+
+def incremental_vacuum(db_path, batch_pages=VACUUM_BATCH_PAGES, time_budget=VACUUM_TIME_BUDGET, should_stop=None):
+    """
+    分批回收空闲页，每批在写锁内单独提交，写锁被占用、有新任务或超过时间限制时停止
+    :param should_stop: 返回True时停止，每批之前调用
+    :return: (回收的页数, 页大小)
+    """
+    start = time.perf_counter()
+    reclaimed = 0
+    page_size = 0
+    conn = connect(db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        while time.perf_counter() - start < time_budget:
+            if should_stop is not None and should_stop():
+                break
+            with try_write_lock(db_path) as locked:
+                if not locked:
+                    break
+                before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if before == 0:
+                    break
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                except sqlite3.OperationalError:
+                    # 其他连接正在写入，推迟到下次
+                    break
+                try:
+                    # 每回收一页返回一行，需要读取全部结果才会执行完
+                    conn.execute(f'PRAGMA incremental_vacuum({batch_pages})').fetchall()
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                reclaimed += before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if reclaimed:
+            # WAL模式下检查点之后文件才会变小，PASSIVE不等待正在读取的连接
+            conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+    finally:
+        conn.close()
+    return reclaimed, page_size
+
+def analyze_database(db_path):
+    """更新整个数据库的统计信息，analysis_limit限制每个索引采样的行数"""
+    with write_lock(db_path):
+        conn = connect(db_path, isolation_level=None)
+        try:
+            conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+            conn.execute('ANALYZE')
+        finally:
+            conn.close()
+
+# API进程中的维护线程
+class DatabaseMaintenance:
+    def __init__(self, db_path, interval=MAINTENANCE_INTERVAL):
+        self.db_path = db_path
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._state = {
+            'running': False,
+            'busy_skips': 0,
+            'reclaimed_pages': 0,
+            'reclaimed_bytes': 0,
+            'last_vacuum_at': None,
+            'last_vacuum_pages': 0,
+            'last_vacuum_seconds': 0,
+            'auto_vacuum_converted_at': None,
+            'last_analyze_at': None,
+            'next_analyze_at': None,
+            'last_error': None
+        }
+        self._next_analyze = 0
+
+    def _update(self, **kwargs):
+        with self._lock:
+            self._state.update(kwargs)
+
+    def _busy(self):
+        """有排队或运行中的任务时不维护"""
+        return self._stopping.is_set() or active_job_count() > 0
+
+    def run_once(self):
+        """检查一次：需要时转换自动清理方式、回收空闲页、运行ANALYZE"""
+        if self._busy():
+            with self._lock:
+                self._state['busy_skips'] += 1
+            return
+        space = database_space(self.db_path)
+        if space['auto_vacuum'] != 'incremental' and space['file_bytes'] <= AUTO_VACUUM_CONVERT_MB * 1024 * 1024:
+            if enable_auto_vacuum(self.db_path):
+                self._update(auto_vacuum_converted_at=_now())
+                space = database_space(self.db_path)
+
+        if space['auto_vacuum'] == 'incremental' and space['freelist_count'] > 0:
+            start = time.perf_counter()
+            pages, page_size = incremental_vacuum(self.db_path, should_stop=self._busy)
+            if pages:
+                seconds = time.perf_counter() - start
+                with self._lock:
+                    self._state['reclaimed_pages'] += pages
+                    self._state['reclaimed_bytes'] += pages * page_size
+                    self._state.update(last_vacuum_at=_now(), last_vacuum_pages=pages, last_vacuum_seconds=round(seconds, 3))
+                print(f"回收数据库空闲页 {pages} 页（{pages * page_size / 1024 / 1024:.1f} MB），耗时 {seconds:.2f} 秒")
+
+        if time.time() >= self._next_analyze and not self._busy():
+            analyze_database(self.db_path)
+            self._next_analyze = time.time() + ANALYZE_INTERVAL_HOURS * 3600
+            self._update(last_analyze_at=_now(), next_analyze_at=datetime.fromtimestamp(self._next_analyze).isoformat())
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self._update(running=True)
+            try:
+                self.run_once()
+                self._update(last_error=None)
+            except Exception as e:
+                self._update(last_error=str(e))
+                print(f"数据库维护失败: {str(e)}")
+            finally:
+                self._update(running=False)
+
+    def status(self):
+        with self._lock:
+            state = dict(self._state)
+        state['interval'] = self.interval
+        return state
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='rootara_maintenance', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+_maintenance = None
+
+def start_maintenance(db_path):
+    """在API进程启动时调用，启动后台维护线程"""
+    global _maintenance
+    if not os.path.exists(db_path):
+        return None
+    if _maintenance is None:
+        _maintenance = DatabaseMaintenance(db_path)
+    _maintenance.start()
+    return _maintenance
+
+def stop_maintenance():
+    global _maintenance
+    if _maintenance is not None:
+        _maintenance.stop()
+        _maintenance = None
+
+def maintenance_status(db_path):
+    """
+    :return: 数据库的空间占用与维护进度，维护线程未启动时只有空间占用
+    """
+    status = {'enabled': _maintenance is not None}
+    if os.path.exists(db_path):
+        status.update(database_space(db_path))
+    if _maintenance is not None:
+        status.update(_maintenance.status())
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description='数据库维护：回收空闲页、更新统计信息')
+    parser.add_argument('--db', type=str, help='数据库文件')
+    parser.add_argument('--status', action='store_true', help='只输出数据库的空间占用')
+    parser.add_argument('--enable-auto-vacuum', action='store_true', help='已有的数据库切换为增量自动清理（运行一次完整的VACUUM）')
+    args = parser.parse_args()
+
+    if not args.db:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.enable_auto_vacuum:
+        enable_auto_vacuum(args.db)
+    elif not args.status:
+        pages, page_size = incremental_vacuum(args.db, time_budget=float('inf'))
+        print(f"回收数据库空闲页 {pages} 页（{pages * page_size / 1024 / 1024:.1f} MB）")
+        analyze_database(args.db)
+    print(json.dumps(database_space(args.db), ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+# coding=utf-8
+# pzw
+# 原始数据解析器
+# 根据文件开头的内容识别厂商和基因组版本，每个厂商一个解析器，新的格式注册解析器即可支持
+# 解析器按块读取文件，每块输出统一的 RSID, Chrom, Start, Genotype 四列，内存占用只与块大小有关
+
+"""
+已支持：
+- 23andMe
+- AncestryDNA
+- MyHeritage
+- FamilyTreeDNA
+- VCF（单样本或多样本中的第一个样本，只保留单碱基位点）
+- WeGene及其他 rsid/chromosome/position/genotype 四列格式
+"""
+
+import re
+import gzip
+import numpy as np
+import pandas as pd
+
+# 识别格式时读取的文件开头字节数
+SNIFF_BYTES = 64 * 1024
+
+# 每块读取的行数
+CHUNK_ROWS = 200000
+
+# 解析结果的列
+RECORD_COLUMNS = ['RSID', 'Chrom', 'Start', 'Genotype']
+
+# 核心库的基因组版本，位点按位置匹配，其他版本的原始数据无法转换
+CORE_BUILD = '37'
+
+# 注释中的基因组版本
+BUILD_PATTERNS = [
+    (re.compile(r'GRCh\s*(3[678])', re.I), {}),
+    (re.compile(r'\bhg(18|19|38)\b', re.I), {'18': '36', '19': '37', '38': '38'}),
+    (re.compile(r'build\s*(3[678])', re.I), {}),
+]
+
+class RawDataFormatError(Exception):
+    """无法识别原始数据的格式，或基因组版本与核心库不一致"""
+    pass
+
+def is_gzip(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+def open_text(file_path):
+    """打开文本文件，支持gzip压缩，忽略UTF-8 BOM"""
+    if is_gzip(file_path):
+        return gzip.open(file_path, 'rt', encoding='utf-8-sig', errors='replace')
+    return open(file_path, 'r', encoding='utf-8-sig', errors='replace')
+
+def read_header(file_path, size=SNIFF_BYTES):
+    """
+    :return: 文件开头的行，最后一行可能不完整，丢弃
+    """
+    with open_text(file_path) as f:
+        text = f.read(size)
+    lines = text.splitlines()
+    if len(text) == size and len(lines) > 1:
+        lines = lines[:-1]
+    return lines
+
+def first_data_line(lines):
+    for line in lines:
+        if line.strip() and not line.startswith('#'):
+            return line
+    return ''
+
+def skip_comments(f):
+    """跳过文件开头的注释和空行，返回时文件位置在第一行数据（或列名）"""
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line:
+            return f
+        if line.strip() and not line.startswith('#'):
+            f.seek(position)
+            return f
+
+def detect_build(lines):
+    """
+    从注释中查找基因组版本
+    :return: '36'/'37'/'38'，未找到时返回None
+    """
+    comments = '\n'.join(line for line in lines if line.startswith('#'))
+    for pattern, mapping in BUILD_PATTERNS:
+        match = pattern.search(comments)
+        if match:
+            return mapping.get(match.group(1), match.group(1))
+    return None
+
+# 染色体名称统一为 1-22, X, Y, MT
+def normalize_chrom(chrom):
+    chrom = chrom.astype(str).str.strip().str.replace(r'^chr', '', regex=True, case=False)
+    return chrom.where(~chrom.isin(['M', 'm', 'MT', 'mt']), 'MT')
+
+def finalize_records(df):
+    """位置转为整数，丢弃无法解析的行，基因型缺失记为'--'"""
+    start = pd.to_numeric(df['Start'], errors='coerce')
+    df = df.assign(Start=start)[start.notna()]
+    return pd.DataFrame({
+        'RSID': df['RSID'].astype(str).to_numpy(dtype=object),
+        'Chrom': normalize_chrom(df['Chrom']).to_numpy(dtype=object),
+        'Start': df['Start'].astype(np.int64).to_numpy(),
+        'Genotype': df['Genotype'].fillna('--').astype(str).str.upper().to_numpy(dtype=object),
+    })
+
+class RawDataParser:
+    """
+    原始数据解析器的基类
+    子类设置name，实现sniff和read_chunks，需要时覆盖detect_build和normalize
+    """
+    name = None
+
+    def sniff(self, lines):
+        """:param lines: 文件开头的行；:return: 是否为该格式"""
+        raise NotImplementedError
+
+    def detect_build(self, lines):
+        return detect_build(lines)
+
+    def read_chunks(self, f, chunk_rows):
+        """按块读取，返回pandas DataFrame的迭代器"""
+        raise NotImplementedError
+
+    def normalize(self, df):
+        """转换为RECORD_COLUMNS，Start可以是字符串"""
+        return df
+
+    def iter_records(self, file_path, chunk_rows=CHUNK_ROWS):
+        with open_text(file_path) as f:
+            for chunk in self.read_chunks(skip_comments(f), chunk_rows):
+                records = finalize_records(self.normalize(chunk))
+                if len(records):
+                    yield records
+
+# 解析器按注册顺序识别格式，通用格式最后注册
+PARSERS = {}
+
+def register_parser(cls):
+    """注册解析器的类装饰器"""
+    PARSERS[cls.name] = cls()
+    return cls
+
+def get_parser(source_from):
+    if source_from not in PARSERS:
+        raise RawDataFormatError(f"不支持的数据来源: {source_from}")
+    return PARSERS[source_from]
+
+@register_parser
+class VcfParser(RawDataParser):
+    name = 'vcf'
+
+    def sniff(self, lines):
+        return bool(lines) and lines[0].startswith('##fileformat=VCF')
+
+    def detect_build(self, lines):
+        build = detect_build([line for line in lines if line.startswith('##reference') or line.startswith('##assembly')])
+        if build is not None:
+            return build
+        # 按1号染色体的长度判断
+        for line in lines:
+            if re.match(r'##contig=<ID=(chr)?1,', line):
+                if 'length=249250621' in line:
+                    return '37'
+                if 'length=248956422' in line:
+                    return '38'
+        return detect_build(lines)
+
+    def read_chunks(self, f, chunk_rows):
+        # 位置、编号、参考和变异碱基、FORMAT、第一个样本
+        return pd.read_csv(f, sep='\t', header=None, usecols=[0, 1, 2, 3, 4, 8, 9],
+                           names=['Chrom', 'Start', 'RSID', 'Ref', 'Alt', 'Format', 'Sample'],
+                           dtype=str, chunksize=chunk_rows)
+
+    def normalize(self, df):
+        if df['Sample'].isna().all():
+            raise RawDataFormatError("VCF文件中没有样本的基因型")
+        # FORMAT的第一个字段为GT，单倍体（Y、MT）只有一个等位基因
+        gt = df['Sample'].fillna('.').str.split(':', n=1).str[0].str.split(r'[/|]', regex=True)
+        first = gt.str[0]
+        second = gt.str[1].fillna(first)
+        ref = df['Ref'].fillna('')
+        alt = df['Alt'].fillna('').str.split(',').str[0]
+
+        # 只保留单碱基位点，等位基因只能是参考或第一个变异碱基
+        valid = (ref.str.len() == 1) & first.isin(['0', '1']) & second.isin(['0', '1'])
+        valid &= ((first == '0') & (second == '0')) | (alt.str.len() == 1)
+        allele1 = np.where(first == '0', ref, alt)
+        allele2 = np.where(second == '0', ref, alt)
+        genotype = pd.Series(allele1, index=df.index) + pd.Series(allele2, index=df.index)
+        return df.assign(Genotype=genotype.where(valid, '--'))[valid]
+
+@register_parser
+class AncestryParser(RawDataParser):
+    name = 'ancestry'
+
+    def sniff(self, lines):
+        header = first_data_line(lines).lower().split()
+        return header[:5] == ['rsid', 'chromosome', 'position', 'allele1', 'allele2'] or any('AncestryDNA' in line for line in lines[:20])
+
+    def read_chunks(self, f, chunk_rows):
+        return pd.read_csv(f, sep='\t', header=0, dtype=str, chunksize=chunk_rows)
+
+    # 23指chrX | 24指chrY | 25指chrY的PAR区 | 26指MT，不需要PAR区
+    def normalize(self, df):
+        df = df[df['chromosome'] != '25']
+        chrom = df['chromosome'].replace({'23': 'X', '24': 'Y', '26': 'MT'})
+        return pd.DataFrame({'RSID': df['rsid'], 'Chrom': chrom, 'Start': df['position'],
+                             'Genotype': df['allele1'] + df['allele2']})
+
+# MyHeritage与FamilyTreeDNA都是带引号的CSV，列为RSID,CHROMOSOME,POSITION,RESULT
+class CsvParser(RawDataParser):
+    def read_chunks(self, f, chunk_rows):
+        return pd.read_csv(f, sep=',', header=0, names=RECORD_COLUMNS, dtype=str, chunksize=chunk_rows)
+
+    @staticmethod
+    def csv_header(lines):
+        return first_data_line(lines).replace('"', '').strip().lower().startswith('rsid,chromosome,position,result')
+
+@register_parser
+class MyHeritageParser(CsvParser):
+    name = 'myheritage'
+
+    def sniff(self, lines):
+        return self.csv_header(lines) and any('MyHeritage' in line for line in lines if line.startswith('#'))
+
+@register_parser
+class FtdnaParser(CsvParser):
+    name = 'ftdna'
+
+    def sniff(self, lines):
+        return self.csv_header(lines)
+
+# 23andme的X、Y、MT只回报了单个碱基，补全为两个
+@register_parser
+class TwentyThreeAndMeParser(RawDataParser):
+    name = '23andme'
+
+    def sniff(self, lines):
+        return any('23andMe' in line for line in lines if line.startswith('#'))
+
+    def read_chunks(self, f, chunk_rows):
+        return pd.read_csv(f, sep='\t', header=None, names=RECORD_COLUMNS, dtype=str, chunksize=chunk_rows)
+
+    def normalize(self, df):
+        genotype = df['Genotype']
+        return df.assign(Genotype=genotype.where(genotype.str.len() != 1, genotype + genotype))
+
+# wegene，通用格式
+@register_parser
+class UniParser(RawDataParser):
+    name = 'wegene'
+
+    def sniff(self, lines):
+        fields = first_data_line(lines).split('\t')
+        return len(fields) == 4 and fields[2].strip().isdigit()
+
+    def read_chunks(self, f, chunk_rows):
+        return pd.read_csv(f, sep='\t', header=None, names=RECORD_COLUMNS, dtype=str, chunksize=chunk_rows)
+
+def sniff_source(file_path):
+    """
+    识别原始数据的厂商和基因组版本
+    :return: (数据来源, 基因组版本)，注释中没有版本信息时版本为None
+    """
+    lines = read_header(file_path)
+    for name, parser in PARSERS.items():
+        if parser.sniff(lines):
+            return name, parser.detect_build(lines)
+    raise RawDataFormatError("无法识别原始数据的格式")
+
+def resolve_source(file_path, source_from=None):
+    """
+    确定原始数据的来源，并检查基因组版本与核心库一致
+    :param source_from: 调用方指定的来源，为空或'auto'时自动识别
+    :return: 数据来源
+    """
+    if source_from in (None, '', 'auto'):
+        source_from, build = sniff_source(file_path)
+        print(f"识别原始数据格式: {source_from}，基因组版本: {build or '未知'}")
+    else:
+        build = get_parser(source_from).detect_build(read_header(file_path))
+    if build is not None and build != CORE_BUILD:
+        raise RawDataFormatError(f"原始数据的基因组版本为GRCh{build}，核心库为GRCh{CORE_BUILD}，无法转换")
+    return source_from
+
+def iter_records(file_path, source_from=None, chunk_rows=CHUNK_ROWS):
+    """
+    按块解析原始数据
+    :param source_from: 数据来源，为空或'auto'时自动识别
+    :return: DataFrame的迭代器，列为RECORD_COLUMNS
+    """
+    if source_from in (None, '', 'auto'):
+        source_from = sniff_source(file_path)[0]
+    return get_parser(source_from).iter_records(file_path, chunk_rows)
@@ -0,0 +1,118 @@
+# coding=utf-8
+# pzw
+# 报告创建流程的依赖图调度
+# 每个阶段声明自己依赖的阶段，依赖都完成后立即提交到进程池运行
+# 互不依赖的阶段（例如祖源分析与单倍群分析）可以并行，记录每个阶段的耗时
+
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# 进程池大小，可通过环境变量调整
+MAX_WORKERS = int(os.environ.get('ROOTARA_PIPELINE_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+_pool = None
+
+def get_process_pool():
+    """
+    获取共享进程池
+    使用spawn方式创建子进程，避免在多线程的API进程中fork
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=MAX_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _pool
+
+def shutdown_process_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+# 在子进程中运行阶段函数并计时
+def _timed_call(func, args, kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def _check_stages(stages):
+    for name, stage in stages.items():
+        for dep in stage.get('deps', []):
+            if dep not in stages:
+                raise ValueError(f"阶段 {name} 依赖的阶段 {dep} 不存在")
+
+    # 检查是否存在循环依赖
+    visited = {}
+    def visit(name):
+        if visited.get(name) == 'visiting':
+            raise ValueError(f"阶段 {name} 存在循环依赖")
+        if visited.get(name) == 'done':
+            return
+        visited[name] = 'visiting'
+        for dep in stages[name].get('deps', []):
+            visit(dep)
+        visited[name] = 'done'
+    for name in stages:
+        visit(name)
+
+def run_stages(stages, progress_callback=None, pool=None, completed=None, result_callback=None):
+    """
+    按依赖关系运行各阶段
+    :param stages: 字典 {阶段名: {'func': 函数, 'args': 参数元组, 'deps': 依赖阶段列表}}
+                   依赖阶段的结果以 阶段名=结果 的关键字参数传给函数，函数需要定义在模块顶层
+    :param progress_callback: 阶段状态回调 progress_callback(stage, status)
+    :param pool: 进程池，默认使用共享进程池
+    :param completed: 已完成阶段的结果 {阶段名: 结果}，这些阶段不再运行
+    :param result_callback: 阶段完成时在当前进程中调用 result_callback(stage, result)，用于保存检查点
+    :return: (结果字典, 耗时字典)，耗时字典中 total 为总的墙钟时间
+    """
+    _check_stages(stages)
+    pool = pool or get_process_pool()
+
+    results = {name: result for name, result in (completed or {}).items() if name in stages}
+    timings = {}
+    for name in results:
+        timings[name] = 0.0
+        if progress_callback is not None:
+            progress_callback(name, 'done')
+    running = {}
+    start = time.perf_counter()
+
+    try:
+        while len(results) < len(stages):
+            # 提交所有依赖已满足的阶段
+            for name, stage in stages.items():
+                if name in results or name in running.values():
+                    continue
+                deps = stage.get('deps', [])
+                if all(dep in results for dep in deps):
+                    kwargs = {dep: results[dep] for dep in deps}
+                    future = pool.submit(_timed_call, stage['func'], stage.get('args', ()), kwargs)
+                    running[future] = name
+                    if progress_callback is not None:
+                        progress_callback(name, 'running')
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name], timings[name] = future.result()
+                except Exception as e:
+                    if progress_callback is not None:
+                        progress_callback(name, 'failed')
+                    raise Exception(f"阶段 {name} 运行失败: {str(e)}") from e
+                if result_callback is not None:
+                    result_callback(name, results[name])
+                if progress_callback is not None:
+                    progress_callback(name, 'done')
+    finally:
+        # 出错时取消尚未开始的阶段
+        for future in running:
+            future.cancel()
+
+    timings['total'] = time.perf_counter() - start
+    return results, timings
@@ -0,0 +1,135 @@
+# coding=utf-8
+# pzw
+# 原始数据存储
+# 原始数据以gzip压缩保存在RAWDATA_DIR中，文件路径记录在reports表的rawdata_path列，导出时不需要扫描目录
+# 早期未压缩、未记录路径的原始数据在首次查询时补充路径，也可以通过命令行统一压缩
+
+import os
+import sys
+import gzip
+import shutil
+import argparse
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import connect
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import connect
+
+RAWDATA_DIR = '/data/rawdata'
+
+# gzip压缩级别，1最快，9压缩率最高
+GZIP_LEVEL = int(os.environ.get('ROOTARA_RAWDATA_GZIP_LEVEL', '6'))
+
+# 压缩、复制时每次读取的字节数
+CHUNK_SIZE = 1024 * 1024
+
+def ensure_rawdata_column(conn):
+    """已有数据库的reports表中增加rawdata_path列"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(reports)")}
+    if 'rawdata_path' not in columns:
+        conn.execute("ALTER TABLE reports ADD COLUMN rawdata_path TEXT")
+        conn.commit()
+
+def rawdata_id(report_id):
+    return report_id.replace('RPT_', 'RDT_')
+
+def rawdata_target(report_id, source_from, extend_name='txt', rawdata_dir=RAWDATA_DIR):
+    return os.path.join(rawdata_dir, f'{rawdata_id(report_id)}.{source_from}.{extend_name}.gz')
+
+def compress_file(source, target, level=GZIP_LEVEL):
+    """压缩到临时文件后改名，中断时不会留下不完整的压缩文件"""
+    temp = target + '.part'
+    with open(source, 'rb') as fin, gzip.open(temp, 'wb', compresslevel=level) as fout:
+        shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+    os.replace(temp, target)
+    return target
+
+def store_rawdata(input_file, report_id, source_from, extend_name='txt', rawdata_dir=RAWDATA_DIR):
+    """
+    压缩保存报告的原始数据，完成后删除输入文件
+    重试时输入文件可能已经压缩保存，此时直接返回已保存的文件
+    :return: 压缩文件路径
+    """
+    os.makedirs(rawdata_dir, exist_ok=True)
+    target = rawdata_target(report_id, source_from, extend_name, rawdata_dir)
+    if os.path.exists(input_file):
+        compress_file(input_file, target)
+        os.remove(input_file)
+    elif not os.path.exists(target):
+        raise FileNotFoundError(f"原始数据文件不存在: {input_file}")
+    return target
+
+# 早期的原始数据没有记录路径，按报告编号在目录中查找
+def scan_rawdata(report_id, rawdata_dir=RAWDATA_DIR):
+    prefix = rawdata_id(report_id) + '.'
+    if os.path.exists(rawdata_dir):
+        for name in sorted(os.listdir(rawdata_dir)):
+            if name.startswith(prefix) and not name.endswith('.part'):
+                return os.path.join(rawdata_dir, name)
+    return None
+
+def find_rawdata(conn, report_id, rawdata_dir=RAWDATA_DIR):
+    """
+    报告的原始数据文件，优先使用reports表中记录的路径
+    没有记录时扫描目录，找到后补充记录
+    :return: 文件路径，不存在时返回None
+    """
+    ensure_rawdata_column(conn)
+    row = conn.execute("SELECT rawdata_path FROM reports WHERE report_id = ?", (report_id,)).fetchone()
+    if row is not None and row[0] and os.path.exists(row[0]):
+        return row[0]
+    path = scan_rawdata(report_id, rawdata_dir)
+    if path is not None and row is not None:
+        with conn:
+            conn.execute("UPDATE reports SET rawdata_path = ? WHERE report_id = ?", (path, report_id))
+    return path
+
+def rawdata_path(db_path, report_id):
+    conn = connect(db_path)
+    try:
+        return find_rawdata(conn, report_id)
+    finally:
+        conn.close()
+
+def compress_legacy_rawdata(db_path, rawdata_dir=RAWDATA_DIR):
+    """
+    压缩早期未压缩保存的原始数据并记录路径
+    同一文件有多个硬链接（内容相同的报告）时分别压缩
+    :return: 压缩的文件数
+    """
+    conn = connect(db_path)
+    count = 0
+    try:
+        report_ids = [row[0] for row in conn.execute("SELECT report_id FROM reports")]
+        for report_id in report_ids:
+            path = find_rawdata(conn, report_id, rawdata_dir)
+            if path is None or path.endswith('.gz'):
+                continue
+            target = compress_file(path, path + '.gz')
+            with conn:
+                conn.execute("UPDATE reports SET rawdata_path = ? WHERE report_id = ?", (target, report_id))
+            os.remove(path)
+            count += 1
+            print(f"已压缩原始数据: {target}")
+    finally:
+        conn.close()
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description='压缩早期未压缩保存的原始数据')
+    parser.add_argument('--db_path', type=str, help='数据库路径')
+    args = parser.parse_args()
+
+    if not args.db_path:
+        parser.print_help()
+        sys.exit(1)
+
+    count = compress_legacy_rawdata(args.db_path)
+    print(f"共压缩 {count} 个原始数据文件")
+
+if __name__ == '__main__':
+    main()
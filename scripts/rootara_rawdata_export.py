@@ -1,31 +1,143 @@
 # coding=utf-8
 # 原始数据导出
+# 按块读取文件，不把整个文件读入内存
+# 客户端接受gzip时直接发送压缩文件（Content-Encoding: gzip），支持Range请求断点续传；否则边读边解压
 
 import os
+import sys
+import gzip
 
-def export_rawdata(report_id):
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_rawdata import rawdata_path, CHUNK_SIZE
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_rawdata import rawdata_path, CHUNK_SIZE
+
+class RangeNotSatisfiable(Exception):
+    """Range请求的范围超出文件大小"""
+    pass
+
+def open_rawdata(report_id, db_path):
+    """
+    :return: {'path', 'filename', 'compressed', 'size'}，模板报告或文件不存在时返回None
+    """
     if report_id == 'RPT_TEMPLATE01':
         print('模板报告，无法导出!')
-        return None, None
-    
-    rawdata_id = report_id.replace('RPT_', 'RDT_')
-    rawdata_path = '/data/rawdata'
-    
-    if os.path.exists(rawdata_path):
-        for file in os.listdir(rawdata_path):
-            if file.startswith(rawdata_id) and len(rawdata_id) == 14:
-                rawdata_file = os.path.join(rawdata_path, file)
-                
-                # 获取文件名和扩展名
-                filename = os.path.basename(rawdata_file)
-                
-                # 读取文件内容
+        return None
+    path = rawdata_path(db_path, report_id)
+    if path is None:
+        return None
+    compressed = path.endswith('.gz')
+    filename = os.path.basename(path)
+    return {
+        'path': path,
+        # 下载的文件名不带.gz，浏览器按Content-Encoding解压后保存
+        'filename': filename[:-len('.gz')] if compressed else filename,
+        'compressed': compressed,
+        'size': os.path.getsize(path)
+    }
+
+def accepts_gzip(accept_encoding):
+    """Accept-Encoding中包含gzip且q不为0"""
+    for item in (accept_encoding or '').split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if parts[0].lower() not in ('gzip', '*'):
+            continue
+        for param in parts[1:]:
+            if param.startswith('q='):
                 try:
-                    with open(rawdata_file, 'r', encoding='utf-8') as f:
-                        file_content = f.read()
-                    return filename, file_content
-                except Exception as e:
-                    print(f"读取文件失败: {str(e)}")
-                    return None, None
-    
-    return None, None
+                    return float(param[2:]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def parse_range(range_header, size):
+    """
+    解析单个范围的Range请求头，只支持bytes
+    :return: (起始字节, 结束字节)，包含结束字节；请求头为空、多个范围或无法解析时返回None，发送整个文件
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    start, sep, end = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if start == '':
+            # bytes=-N 表示最后N个字节
+            length = int(end)
+            if length <= 0:
+                raise RangeNotSatisfiable(range_header)
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise RangeNotSatisfiable(range_header)
+    return start, min(end, size - 1)
+
+def iter_file_range(path, start, end, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def iter_decompressed(path, chunk_size=CHUNK_SIZE):
+    with gzip.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def rawdata_response(rawdata, accept_encoding=None, range_header=None):
+    """
+    导出响应的状态码、响应头和内容
+    发送文件原始字节时支持Range，边解压边发送时长度未知，忽略Range
+    :param rawdata: open_rawdata的返回值
+    :return: (状态码, 响应头, 内容迭代器)；范围无法满足时抛出RangeNotSatisfiable
+    """
+    headers = {'Content-Disposition': f"attachment; filename={rawdata['filename']}", 'Vary': 'Accept-Encoding'}
+    if rawdata['compressed'] and not accepts_gzip(accept_encoding):
+        headers['Accept-Ranges'] = 'none'
+        return 200, headers, iter_decompressed(rawdata['path'])
+
+    if rawdata['compressed']:
+        headers['Content-Encoding'] = 'gzip'
+    headers['Accept-Ranges'] = 'bytes'
+    size = rawdata['size']
+    byte_range = parse_range(range_header, size) if size > 0 else None
+    if byte_range is None:
+        headers['Content-Length'] = str(size)
+        return 200, headers, iter_file_range(rawdata['path'], 0, size - 1)
+    start, end = byte_range
+    headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    headers['Content-Length'] = str(end - start + 1)
+    return 206, headers, iter_file_range(rawdata['path'], start, end)
+
+def export_rawdata(report_id, db_path):
+    """
+    读取整个原始数据文件，压缩保存的文件解压后返回
+    :return: (文件名, 文件内容)，无法读取时返回(None, None)
+    """
+    rawdata = open_rawdata(report_id, db_path)
+    if rawdata is None:
+        return None, None
+    try:
+        content = b''.join(iter_decompressed(rawdata['path']) if rawdata['compressed'] else iter_file_range(rawdata['path'], 0, rawdata['size'] - 1))
+        return rawdata['filename'], content.decode('utf-8')
+    except Exception as e:
+        print(f"读取文件失败: {str(e)}")
+        return None, None
@@ -11,8 +11,11 @@ package main
 
 import (
 	"bufio"
+	"bytes"
 	"compress/gzip"
+	"encoding/binary"
 	"encoding/csv"
+	"encoding/json"
 	"flag"
 	"fmt"
 	"io"
@@ -20,7 +23,11 @@ import (
 	"path/filepath"
 	"runtime"
 	"runtime/debug"
+	"sort"
+	"strconv"
 	"strings"
+	"syscall"
+	"unsafe"
 )
 
 // 定义数据结构
@@ -38,8 +45,217 @@ type RootaraRecord struct {
 	Check     string
 }
 
+// 核心库查找接口，可以是读取文本得到的map，也可以是内存映射的二进制索引
+type CoreLookup interface {
+	Lookup(chrom, start string) (RootaraRecord, bool)
+}
+
+// 按染色体、位置组织的核心库记录
+type CoreMap map[string]map[string]RootaraRecord
+
+func (m CoreMap) Lookup(chrom, start string) (RootaraRecord, bool) {
+	chromRecords, exists := m[chrom]
+	if !exists {
+		return RootaraRecord{}, false
+	}
+	record, exists := chromRecords[start]
+	return record, exists
+}
+
+// 二进制核心库索引，由 rootara_core_index.py 生成，格式见 rootara_columnar.py
+// 每列是小端序的原始二进制文件，直接内存映射，不需要解压和解析文本
+type indexColumnMeta struct {
+	Kind    string `json:"kind"`
+	Dtype   string `json:"dtype,omitempty"`
+	File    string `json:"file,omitempty"`
+	Offsets string `json:"offsets,omitempty"`
+	Data    string `json:"data,omitempty"`
+	Codes   string `json:"codes,omitempty"`
+	Size    int    `json:"size"`
+}
+
+type indexMeta struct {
+	Format  string                     `json:"format"`
+	Rows    int                        `json:"rows"`
+	Columns map[string]indexColumnMeta `json:"columns"`
+	Attrs   struct {
+		Chroms []string `json:"chroms"`
+	} `json:"attrs"`
+}
+
+// 字符串列，codes为nil时每一行对应字符串表中的同一位置
+type indexStringColumn struct {
+	offsets []int64
+	data    []byte
+	codes   []uint32
+}
+
+func (c indexStringColumn) get(row int) string {
+	i := row
+	if c.codes != nil {
+		i = int(c.codes[row])
+	}
+	return string(c.data[c.offsets[i]:c.offsets[i+1]])
+}
+
+type CoreIndex struct {
+	keys      []int64
+	ref       []byte
+	alt       []byte
+	chromCode map[string]int64
+	columns   map[string]indexStringColumn
+	mapped    [][]byte
+}
+
+// 内存映射一个文件
+func (idx *CoreIndex) mapFile(path string) ([]byte, error) {
+	file, err := os.Open(path)
+	if err != nil {
+		return nil, fmt.Errorf("无法打开文件: %v", err)
+	}
+	defer file.Close()
+
+	info, err := file.Stat()
+	if err != nil {
+		return nil, fmt.Errorf("无法读取文件信息: %v", err)
+	}
+	if info.Size() == 0 {
+		return []byte{}, nil
+	}
+	data, err := syscall.Mmap(int(file.Fd()), 0, int(info.Size()), syscall.PROT_READ, syscall.MAP_SHARED)
+	if err != nil {
+		return nil, fmt.Errorf("内存映射失败: %v", err)
+	}
+	idx.mapped = append(idx.mapped, data)
+	return data, nil
+}
+
+func bytesToInt64(b []byte) []int64 {
+	if len(b) == 0 {
+		return nil
+	}
+	return unsafe.Slice((*int64)(unsafe.Pointer(&b[0])), len(b)/8)
+}
+
+func bytesToUint32(b []byte) []uint32 {
+	if len(b) == 0 {
+		return nil
+	}
+	return unsafe.Slice((*uint32)(unsafe.Pointer(&b[0])), len(b)/4)
+}
+
+// 打开二进制核心库索引
+func openCoreIndex(dir string) (*CoreIndex, error) {
+	metaBytes, err := os.ReadFile(filepath.Join(dir, "meta.json"))
+	if err != nil {
+		return nil, fmt.Errorf("无法读取索引信息: %v", err)
+	}
+	var meta indexMeta
+	if err := json.Unmarshal(metaBytes, &meta); err != nil {
+		return nil, fmt.Errorf("无法解析索引信息: %v", err)
+	}
+	if meta.Format != "rootara-columnar" {
+		return nil, fmt.Errorf("不是有效的索引目录: %s", dir)
+	}
+
+	idx := &CoreIndex{
+		chromCode: make(map[string]int64),
+		columns:   make(map[string]indexStringColumn),
+	}
+	for code, chrom := range meta.Attrs.Chroms {
+		idx.chromCode[chrom] = int64(code)
+	}
+
+	for _, name := range []string{"key", "ref", "alt"} {
+		column, exists := meta.Columns[name]
+		if !exists {
+			idx.Close()
+			return nil, fmt.Errorf("索引缺少列: %s", name)
+		}
+		data, err := idx.mapFile(filepath.Join(dir, column.File))
+		if err != nil {
+			idx.Close()
+			return nil, err
+		}
+		switch name {
+		case "key":
+			idx.keys = bytesToInt64(data)
+		case "ref":
+			idx.ref = data
+		case "alt":
+			idx.alt = data
+		}
+	}
+
+	for _, name := range []string{"Gene", "RSID", "gnomAD_AF", "CLNSIG", "CLNDN"} {
+		column, exists := meta.Columns[name]
+		if !exists {
+			idx.Close()
+			return nil, fmt.Errorf("索引缺少列: %s", name)
+		}
+		offsets, err := idx.mapFile(filepath.Join(dir, column.Offsets))
+		if err != nil {
+			idx.Close()
+			return nil, err
+		}
+		data, err := idx.mapFile(filepath.Join(dir, column.Data))
+		if err != nil {
+			idx.Close()
+			return nil, err
+		}
+		stringColumn := indexStringColumn{offsets: bytesToInt64(offsets), data: data}
+		if column.Kind == "dict" {
+			codes, err := idx.mapFile(filepath.Join(dir, column.Codes))
+			if err != nil {
+				idx.Close()
+				return nil, err
+			}
+			stringColumn.codes = bytesToUint32(codes)
+		}
+		idx.columns[name] = stringColumn
+	}
+
+	return idx, nil
+}
+
+func (idx *CoreIndex) Close() {
+	for _, data := range idx.mapped {
+		syscall.Munmap(data)
+	}
+	idx.mapped = nil
+}
+
+// 二分查找(染色体, 位置)
+func (idx *CoreIndex) Lookup(chrom, start string) (RootaraRecord, bool) {
+	code, exists := idx.chromCode[chrom]
+	if !exists {
+		return RootaraRecord{}, false
+	}
+	pos, err := strconv.ParseInt(start, 10, 64)
+	if err != nil || pos < 0 || pos >= 1<<32 {
+		return RootaraRecord{}, false
+	}
+	key := code<<32 | pos
+	row := sort.Search(len(idx.keys), func(i int) bool { return idx.keys[i] >= key })
+	if row >= len(idx.keys) || idx.keys[row] != key {
+		return RootaraRecord{}, false
+	}
+
+	return RootaraRecord{
+		Chrom:     chrom,
+		Start:     start,
+		Ref:       string(idx.ref[row : row+1]),
+		Alt:       string(idx.alt[row : row+1]),
+		Gene:      idx.columns["Gene"].get(row),
+		RSID:      idx.columns["RSID"].get(row),
+		GnomAD_AF: idx.columns["gnomAD_AF"].get(row),
+		CLNSIG:    idx.columns["CLNSIG"].get(row),
+		CLNDN:     idx.columns["CLNDN"].get(row),
+	}, true
+}
+
 // 读取rootara核心库 - 优化版本
-func readRootaraCore(filePath string) (map[string]map[string]RootaraRecord, error) {
+func readRootaraCore(filePath string) (CoreMap, error) {
 	// 打开gzip压缩文件
 	file, err := os.Open(filePath)
 	if err != nil {
@@ -79,7 +295,7 @@ func readRootaraCore(filePath string) (map[string]map[string]RootaraRecord, erro
 	}
 
 	// 创建数据结构存储记录，使用染色体和位置作为键
-	records := make(map[string]map[string]RootaraRecord)
+	records := make(CoreMap)
 
 	// 设置缓冲区大小，控制内存使用
 	batchSize := 50000
@@ -159,7 +375,7 @@ func readRootaraCore(filePath string) (map[string]map[string]RootaraRecord, erro
 }
 
 // 合并数据框架 - 优化版本
-func mergeDataFrames(inputRecords [][]string, rootaraRecords map[string]map[string]RootaraRecord, colIndex map[string]int) []RootaraRecord {
+func mergeDataFrames(inputRecords [][]string, rootaraRecords CoreLookup, colIndex map[string]int) []RootaraRecord {
 	// 预分配合理大小的切片，避免频繁扩容
 	estimatedSize := len(inputRecords) / 10 // 假设约10%的记录会匹配
 	mergedRecords := make([]RootaraRecord, 0, estimatedSize)
@@ -170,40 +386,38 @@ func mergeDataFrames(inputRecords [][]string, rootaraRecords map[string]map[stri
 		genotype := row[colIndex["Genotype"]]
 
 		// 检查染色体和位置是否存在于rootara记录中
-		if chromRecords, exists := rootaraRecords[chrom]; exists {
-			if record, exists := chromRecords[start]; exists {
-				// 检查基因型是否匹配
-				ref := record.Ref
-				alt := record.Alt
-
-				// 创建所有可能的基因型组合 - 减少内存分配
-				refref := ref + ref
-				refalt := ref + alt
-				altalt := alt + alt
-				altref := alt + ref
-
-				// 直接比较而不是创建map
-				matched := genotype == refref || genotype == refalt || genotype == altalt || genotype == altref
-
-				if matched && genotype != "--" {
-					// 基因型转换
-					check := "NA"
-					refCount := strings.Count(genotype, ref)
-					if refCount == 2 {
-						check = "WT"
-					} else if refCount == 1 {
-						check = "HET"
-					} else if refCount == 0 {
-						check = "HOM"
-					}
-
-					if check != "NA" {
-						// 创建新记录而不是修改原记录
-						newRecord := record // 复制结构体
-						newRecord.Genotype = genotype
-						newRecord.Check = check
-						mergedRecords = append(mergedRecords, newRecord)
-					}
+		if record, exists := rootaraRecords.Lookup(chrom, start); exists {
+			// 检查基因型是否匹配
+			ref := record.Ref
+			alt := record.Alt
+
+			// 创建所有可能的基因型组合 - 减少内存分配
+			refref := ref + ref
+			refalt := ref + alt
+			altalt := alt + alt
+			altref := alt + ref
+
+			// 直接比较而不是创建map
+			matched := genotype == refref || genotype == refalt || genotype == altalt || genotype == altref
+
+			if matched && genotype != "--" {
+				// 基因型转换
+				check := "NA"
+				refCount := strings.Count(genotype, ref)
+				if refCount == 2 {
+					check = "WT"
+				} else if refCount == 1 {
+					check = "HET"
+				} else if refCount == 0 {
+					check = "HOM"
+				}
+
+				if check != "NA" {
+					// 创建新记录而不是修改原记录
+					newRecord := record // 复制结构体
+					newRecord.Genotype = genotype
+					newRecord.Check = check
+					mergedRecords = append(mergedRecords, newRecord)
 				}
 			}
 		}
@@ -213,7 +427,7 @@ func mergeDataFrames(inputRecords [][]string, rootaraRecords map[string]map[stri
 }
 
 // 读取通用格式结果 - 修复版本
-func readUniResult(filePath string, rootaraRecords map[string]map[string]RootaraRecord) ([]RootaraRecord, error) {
+func readUniResult(filePath string, rootaraRecords CoreLookup) ([]RootaraRecord, error) {
 	// 打开文件
 	file, err := os.Open(filePath)
 	if err != nil {
@@ -294,7 +508,7 @@ func readUniResult(filePath string, rootaraRecords map[string]map[string]Rootara
 }
 
 // 读取23andme结果 - 修复版本
-func read23andmeResult(filePath string, rootaraRecords map[string]map[string]RootaraRecord) ([]RootaraRecord, error) {
+func read23andmeResult(filePath string, rootaraRecords CoreLookup) ([]RootaraRecord, error) {
 	// 打开文件
 	file, err := os.Open(filePath)
 	if err != nil {
@@ -379,7 +593,7 @@ func read23andmeResult(filePath string, rootaraRecords map[string]map[string]Roo
 }
 
 // 读取AncestryDNA结果
-func readAncestryResult(filePath string, rootaraRecords map[string]map[string]RootaraRecord) ([]RootaraRecord, error) {
+func readAncestryResult(filePath string, rootaraRecords CoreLookup) ([]RootaraRecord, error) {
 	// 打开文件
 	file, err := os.Open(filePath)
 	if err != nil {
@@ -470,11 +684,158 @@ func readAncestryResult(filePath string, rootaraRecords map[string]map[string]Ro
 }
 
 // 创建CSV文件
-func csvCreate(inputPath, outputPath, method, rootaraCorePath string) error {
-	// 读取rootara核心库
-	rootaraRecords, err := readRootaraCore(rootaraCorePath)
+// 写入小端序的二进制文件
+func writeBinary(path string, data interface{}) error {
+	file, err := os.Create(path)
 	if err != nil {
-		return fmt.Errorf("读取Rootara核心库失败: %v", err)
+		return fmt.Errorf("创建文件失败: %v", err)
+	}
+	defer file.Close()
+
+	writer := bufio.NewWriterSize(file, 1024*1024)
+	if err := binary.Write(writer, binary.LittleEndian, data); err != nil {
+		return fmt.Errorf("写入文件失败: %v", err)
+	}
+	return writer.Flush()
+}
+
+// 写入字符串列，dict为true时使用字典编码
+func writeStringColumn(outDir, name string, values []string, dict bool) (indexColumnMeta, error) {
+	column := indexColumnMeta{
+		Kind:    "plain",
+		Offsets: name + ".offsets.bin",
+		Data:    name + ".data.bin",
+	}
+
+	table := values
+	var codes []uint32
+	if dict {
+		column.Kind = "dict"
+		column.Codes = name + ".codes.bin"
+		table = nil
+		codes = make([]uint32, len(values))
+		seen := make(map[string]uint32)
+		for i, value := range values {
+			code, exists := seen[value]
+			if !exists {
+				code = uint32(len(table))
+				seen[value] = code
+				table = append(table, value)
+			}
+			codes[i] = code
+		}
+		if err := writeBinary(filepath.Join(outDir, column.Codes), codes); err != nil {
+			return column, err
+		}
+	}
+
+	offsets := make([]int64, len(table)+1)
+	var data bytes.Buffer
+	for i, value := range table {
+		data.WriteString(value)
+		offsets[i+1] = int64(data.Len())
+	}
+	column.Size = len(table)
+	if err := writeBinary(filepath.Join(outDir, column.Offsets), offsets); err != nil {
+		return column, err
+	}
+	if err := os.WriteFile(filepath.Join(outDir, column.Data), data.Bytes(), 0644); err != nil {
+		return column, fmt.Errorf("写入文件失败: %v", err)
+	}
+	return column, nil
+}
+
+// 以列存储格式输出转换结果，格式与 rootara_columnar.py 一致，后续步骤直接映射读取，不再解析CSV
+func writeColumnar(outDir string, records []RootaraRecord) error {
+	if err := os.MkdirAll(outDir, 0755); err != nil {
+		return fmt.Errorf("创建输出目录失败: %v", err)
+	}
+
+	starts := make([]int64, len(records))
+	for i, record := range records {
+		start, err := strconv.ParseInt(record.Start, 10, 64)
+		if err != nil {
+			return fmt.Errorf("位置不是整数: %s", record.Start)
+		}
+		starts[i] = start
+	}
+
+	// 与CSV输出的列顺序一致，RSID几乎不重复，不使用字典编码
+	stringColumns := []struct {
+		name  string
+		dict  bool
+		value func(RootaraRecord) string
+	}{
+		{"Chrom", true, func(r RootaraRecord) string { return r.Chrom }},
+		{"Start", false, nil},
+		{"Ref", true, func(r RootaraRecord) string { return r.Ref }},
+		{"Alt", true, func(r RootaraRecord) string { return r.Alt }},
+		{"Gene", true, func(r RootaraRecord) string { return r.Gene }},
+		{"RSID", false, func(r RootaraRecord) string { return r.RSID }},
+		{"gnomAD_AF", true, func(r RootaraRecord) string { return r.GnomAD_AF }},
+		{"CLNSIG", true, func(r RootaraRecord) string { return r.CLNSIG }},
+		{"CLNDN", true, func(r RootaraRecord) string { return r.CLNDN }},
+		{"Genotype", true, func(r RootaraRecord) string { return r.Genotype }},
+		{"Check", true, func(r RootaraRecord) string { return r.Check }},
+	}
+
+	// meta.json中的列需要保持顺序，逐列拼接
+	var columnsJSON bytes.Buffer
+	for i, column := range stringColumns {
+		var meta indexColumnMeta
+		if column.value == nil {
+			meta = indexColumnMeta{Kind: "array", Dtype: "<i8", File: column.name + ".bin"}
+			if err := writeBinary(filepath.Join(outDir, meta.File), starts); err != nil {
+				return err
+			}
+		} else {
+			values := make([]string, len(records))
+			for j, record := range records {
+				values[j] = column.value(record)
+			}
+			var err error
+			meta, err = writeStringColumn(outDir, column.name, values, column.dict)
+			if err != nil {
+				return err
+			}
+		}
+		name, _ := json.Marshal(column.name)
+		value, _ := json.Marshal(meta)
+		if i > 0 {
+			columnsJSON.WriteString(", ")
+		}
+		columnsJSON.Write(name)
+		columnsJSON.WriteString(": ")
+		columnsJSON.Write(value)
+	}
+
+	// meta.json最后写入，存在即表示数据完整
+	meta := fmt.Sprintf(`{"format": "rootara-columnar", "version": 1, "rows": %d, "columns": {%s}, "attrs": {}}`,
+		len(records), columnsJSON.String())
+	tempMeta := filepath.Join(outDir, "meta.json.tmp")
+	if err := os.WriteFile(tempMeta, []byte(meta), 0644); err != nil {
+		return fmt.Errorf("写入列存储信息失败: %v", err)
+	}
+	return os.Rename(tempMeta, filepath.Join(outDir, "meta.json"))
+}
+
+func csvCreate(inputPath, outputPath, method, rootaraCorePath, indexPath, format string) error {
+	// 读取rootara核心库，提供了二进制索引时直接映射索引
+	var rootaraRecords CoreLookup
+	var err error
+	if indexPath != "" {
+		var index *CoreIndex
+		index, err = openCoreIndex(indexPath)
+		if err != nil {
+			return fmt.Errorf("打开Rootara核心库索引失败: %v", err)
+		}
+		defer index.Close()
+		rootaraRecords = index
+	} else {
+		rootaraRecords, err = readRootaraCore(rootaraCorePath)
+		if err != nil {
+			return fmt.Errorf("读取Rootara核心库失败: %v", err)
+		}
 	}
 
 	var mergedRecords []RootaraRecord
@@ -495,6 +856,10 @@ func csvCreate(inputPath, outputPath, method, rootaraCorePath string) error {
 		return fmt.Errorf("读取输入文件失败: %v", err)
 	}
 
+	if format == "columnar" {
+		return writeColumnar(outputPath, mergedRecords)
+	}
+
 	// 创建输出文件
 	outputFile, err := os.Create(outputPath)
 	if err != nil {
@@ -541,6 +906,8 @@ func main() {
 	outputPtr := flag.String("output", "", "输出文件路径")
 	methodPtr := flag.String("method", "23andme", "文件来源 (23andme/ancestry/wegene)")
 	rootaraPtr := flag.String("rootara", "/app/database/Rootara.core.202404.txt.gz", "Rootara核心库文件路径")
+	indexPtr := flag.String("index", "", "Rootara核心库二进制索引目录，提供时不再读取核心库文本")
+	formatPtr := flag.String("format", "csv", "输出格式 (csv/columnar)，columnar时输出路径为目录")
 	memLimitPtr := flag.Int("memlimit", 200, "内存使用限制(MB)")
 
 	flag.Parse()
@@ -565,6 +932,11 @@ func main() {
 		flag.Usage()
 		os.Exit(1)
 	}
+	if *formatPtr != "csv" && *formatPtr != "columnar" {
+		fmt.Printf("不支持的输出格式: %s\n", *formatPtr)
+		flag.Usage()
+		os.Exit(1)
+	}
 
 	// 确保输出目录存在
 	outputDir := filepath.Dir(*outputPtr)
@@ -574,7 +946,7 @@ func main() {
 	}
 
 	// 创建CSV文件
-	if err := csvCreate(*inputPtr, *outputPtr, *methodPtr, *rootaraPtr); err != nil {
+	if err := csvCreate(*inputPtr, *outputPtr, *methodPtr, *rootaraPtr, *indexPtr, *formatPtr); err != nil {
 		fmt.Printf("处理失败: %v\n", err)
 		os.Exit(1)
 	}
@@ -4,10 +4,7 @@
 # 这个脚本用于转换不同的厂商提供的结果文件，并储存到数据库中
 
 """
-已支持：
-- 23andMeV5
-- Wegene
-- AncestryDNA
+已支持的格式见 rootara_parsers，新的格式在其中注册解析器
 """
 
 """
@@ -27,17 +24,35 @@ df_clinvar.to_excel('pzw_wegene_clinvar.xlsx', index = False)
 https://my.pgp-hms.org/public_genetic_data?data_type=23andMe
 """
 
+import os
 import sys
 import gzip
+import time
+import numpy as np
 import pandas as pd
 import argparse
 
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_core_index import CoreIndex, find_core_index, load_core_index
+    from scripts.rootara_columnar import save_dataframe
+    from scripts.rootara_parsers import PARSERS, CHUNK_ROWS, RawDataFormatError, iter_records
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_core_index import CoreIndex, find_core_index, load_core_index
+    from scripts.rootara_columnar import save_dataframe
+    from scripts.rootara_parsers import PARSERS, CHUNK_ROWS, RawDataFormatError, iter_records
+
 # 读取rootara核心库
-def read_rootara_core(file_path):
+def read_rootara_core(file_path, vectorized=True):
     """
     读取gzip压缩的文本文件，第一行为标题行
+    与Go转换程序和核心库索引（rootara_core_index）的规则相同：
+    所有列按字符串读取（'NA'、空值不转换为缺失值），同一(染色体, 位置)有多条记录时保留最后一条
     :param file_path: 文件路径
-    :param columns: 可选，列名列表。如果为None则使用文件第一行作为列名
+    :param vectorized: 是否使用向量化方式处理，结果与逐行处理一致
     :return: pandas DataFrame
     """
     with gzip.open(file_path, 'rt') as f:
@@ -45,12 +60,22 @@ def read_rootara_core(file_path):
             f,
             sep = '\t',
             header = 0,
-            low_memory=False
+            dtype = str,
+            keep_default_na = False
         )
+    df['Start'] = df['Start'].astype(np.int64)
     df.loc[:, 'Chrom'] = df['Chrom'].str.replace('chrM', 'MT')
     df.loc[:, 'Chrom'] = df['Chrom'].str.replace('chr', '')
 
-    # 调整插入缺失
+    if vectorized:
+        df = modify_indel_vectorized(df)
+    else:
+        df = modify_indel_rowwise(df)
+    # 多等位位点在核心库中有多条记录，merge时每条都会匹配，去重后与索引一致
+    return df.drop_duplicates(subset=['Chrom', 'Start'], keep='last')
+
+# 调整插入缺失 || 逐行处理
+def modify_indel_rowwise(df):
     def modify_indel(row):
         ref = row['Ref']
         alt = row['Alt']
@@ -81,11 +106,51 @@ def read_rootara_core(file_path):
     df = df[df['Alt'] != 'NA']
     return df
 
+# 调整插入缺失 || 向量化处理
+def modify_indel_vectorized(df):
+    ref_len = df['Ref'].str.len()
+    alt_len = df['Alt'].str.len()
+    same_len = ref_len == alt_len
+    single = same_len & (ref_len == 1)
+
+    # 缺失记为I/D，插入记为D/I，等长的单碱基用'-'表示插入缺失
+    deletion = (ref_len > alt_len) | (single & (df['Alt'] == '-'))
+    insertion = (ref_len < alt_len) | (single & (df['Alt'] != '-') & (df['Ref'] == '-'))
+
+    # MNV || 难以处理，这种位点可以过滤掉 || 芯片测序结果中无此信息
+    mnv = same_len & (ref_len != 1)
+
+    df = df.copy()
+    df.loc[deletion, 'Ref'] = 'I'
+    df.loc[deletion, 'Alt'] = 'D'
+    df.loc[insertion, 'Ref'] = 'D'
+    df.loc[insertion, 'Alt'] = 'I'
+    df = df[~mnv]
+    df = df[df['Ref'] != 'NA']
+    df = df[df['Alt'] != 'NA']
+    return df
+
 # 不用pandas的merge了，自行处理
-def merge_dataframes(input_df, rootara_df):
+def merge_dataframes(input_df, rootara_df, vectorized=True):
+    # 使用二进制索引时直接二分查找
+    if isinstance(rootara_df, CoreIndex):
+        return merge_with_core_index(input_df, rootara_df)
+
     # 进行第一次merge，确认Ref
     df_merge = pd.merge(rootara_df, input_df, on=['Chrom', 'Start'], how='right')
 
+    if vectorized:
+        df_merge = match_genotype_vectorized(df_merge)
+    else:
+        df_merge = match_genotype_rowwise(df_merge)
+
+    col_need = ['Chrom', 'Start', 'Ref', 'Alt', 'Gene', 'RSID_x', 'gnomAD_AF', 'CLNSIG', 'CLNDN', 'Genotype', 'Check']
+    df_merge = df_merge[col_need]
+    df_merge.rename(columns={'RSID_x': 'RSID'}, inplace=True)
+    return df_merge
+
+# 基因型匹配与转换 || 逐行处理
+def match_genotype_rowwise(df_merge):
     # 然后对合并后的结果进行过滤 对Ref Alt进一步匹配
     def ref_alt_match(row):
         all_type_list = [
@@ -120,127 +185,153 @@ def merge_dataframes(input_df, rootara_df):
     df_merge['Check'] = 'NA'
     df_merge.loc[:, 'Check'] = df_merge.apply(convert_genotype, axis=1)
     df_merge = df_merge[df_merge['Check'] != 'NA']
-    col_need = ['Chrom', 'Start', 'Ref', 'Alt', 'Gene', 'RSID_x', 'gnomAD_AF', 'CLNSIG', 'CLNDN', 'Genotype', 'Check']
-    df_merge = df_merge[col_need]
-    df_merge.rename(columns={'RSID_x': 'RSID'}, inplace=True)
     return df_merge
 
-# wegene，通用格式
-def read_uni_result(file_path, rootara_df):
-    # 定义列名
-    columns = ['RSID', 'Chrom', 'Start', 'Genotype']
-    
-    # 读取文件，跳过#开头的行和空行
-    df = pd.read_csv(
-        file_path, 
-        sep = '\t',
-        comment = '#',
-        skip_blank_lines = True,
-        names = columns,
-        low_memory = False
+# 基因型匹配与转换 || 向量化处理
+def match_genotype_vectorized(df_merge):
+    ref = df_merge['Ref']
+    alt = df_merge['Alt']
+    genotype = df_merge['Genotype']
+
+    # 未匹配到核心库的位点Ref为空，基因型必须是Ref/Alt的组合之一
+    matched = ref.notna() & alt.notna() & genotype.notna() & (
+        (genotype == ref + ref) | (genotype == ref + alt) |
+        (genotype == alt + alt) | (genotype == alt + ref)
     )
-    before_count = df.shape[0]
-    df_merge = merge_dataframes(df, rootara_df)
-    after_count = df_merge.shape[0]
+    df_merge = df_merge[matched & (genotype != '--')].copy()
 
-    trans_rate = after_count / before_count
-    print('转换率：', "%.2f" % (trans_rate * 100) + '%')
-    print('转换前数量：', before_count)
-    print('转换后数量：', after_count)
+    # 基因型转换，按基因型中Ref出现的次数判断
+    ref_count = np.char.count(
+        df_merge['Genotype'].to_numpy(dtype=str),
+        df_merge['Ref'].to_numpy(dtype=str)
+    )
+    df_merge['Check'] = np.select([ref_count == 2, ref_count == 1, ref_count == 0], ['WT', 'HET', 'HOM'], 'NA')
+    df_merge = df_merge[df_merge['Check'] != 'NA']
     return df_merge
 
-# 23andme的X、Y、MT只回报了单个碱基，特殊处理
-def read_23andme_result(file_path, rootara_df):
-    # 定义列名
-    columns = ['RSID', 'Chrom', 'Start', 'Genotype']
-    
-    # 读取文件，跳过#开头的行和空行
-    df = pd.read_csv(
-        file_path, 
-        sep = '\t',
-        comment = '#',
-        skip_blank_lines = True,
-        names = columns,
-        low_memory = False
+# 在核心库索引中查找位点，只解码匹配上的注释，结果与Go转换程序一致
+def merge_with_core_index(input_df, core_index):
+    rows = core_index.lookup(input_df['Chrom'], input_df['Start'])
+    found = rows >= 0
+    rows = rows[found]
+    genotype = input_df['Genotype'][found].reset_index(drop=True)
+
+    ref, alt = core_index.alleles(rows)
+    ref = pd.Series(ref)
+    alt = pd.Series(alt)
+    matched = genotype.notna() & (genotype != '--') & (
+        (genotype == ref + ref) | (genotype == ref + alt) |
+        (genotype == alt + alt) | (genotype == alt + ref)
     )
+    matched = matched.to_numpy()
 
-    # 处理X、Y、MT
-    df.loc[:, 'Genotype'] = df.apply(
-        lambda x:
-            x['Genotype'] + x['Genotype'] if len(x['Genotype']) == 1 else x['Genotype'],
-        axis = 1
+    df_merge = core_index.annotations(rows[matched])
+    df_merge['Genotype'] = genotype[matched].to_numpy(dtype=object)
+    ref_count = np.char.count(
+        df_merge['Genotype'].to_numpy(dtype=str),
+        df_merge['Ref'].to_numpy(dtype=str)
     )
+    df_merge['Check'] = np.select([ref_count == 2, ref_count == 1, ref_count == 0], ['WT', 'HET', 'HOM'], 'NA')
+    return df_merge[df_merge['Check'] != 'NA']
 
-    before_count = df.shape[0]
-    df_merge = merge_dataframes(df, rootara_df)
-    after_count = df_merge.shape[0]
+# 读取核心库，存在最新的二进制索引时直接映射索引
+def load_rootara_core(rootara_core, vectorized=True, use_index=True):
+    if use_index:
+        index_path = find_core_index(rootara_core)
+        if index_path is not None:
+            return load_core_index(index_path)
+    return read_rootara_core(rootara_core, vectorized)
 
+# 打印转换率
+def print_trans_rate(before_count, after_count):
     trans_rate = after_count / before_count
     print('转换率：', "%.2f" % (trans_rate * 100) + '%')
     print('转换前数量：', before_count)
     print('转换后数量：', after_count)
+
+# 按块解析原始数据并匹配核心库，内存占用与块大小有关，与文件大小无关
+def convert_result(file_path, method, rootara_df, vectorized=True, chunk_rows=CHUNK_ROWS):
+    """
+    :param method: 数据来源，为'auto'时根据文件内容识别
+    :return: 匹配结果
+    """
+    before_count = 0
+    merged = []
+    for records in iter_records(file_path, method, chunk_rows):
+        before_count += len(records)
+        merged.append(merge_dataframes(records, rootara_df, vectorized))
+    if not merged:
+        raise RawDataFormatError(f"原始数据中没有可以解析的位点: {file_path}")
+    df_merge = pd.concat(merged, ignore_index=True)
+    print_trans_rate(before_count, df_merge.shape[0])
     return df_merge
 
-# AncestryDNA，23指chrX | 24指chrY | 25指chrY的PAR区 | 26指MT
-def read_ancestry_result(file_path, rootara_df):
-    # 读取文件，跳过#开头的行和空行
-    df = pd.read_csv(
-        file_path, 
-        sep = '\t',
-        comment = '#',
-        skip_blank_lines = True,
-        header = 0,
-        low_memory = False
-    )
+def csv_create(file_path, output_csv, method='auto', rootara_core='Rootara.core.202404.txt.gz', vectorized=True, use_index=True):
+    rootara_df = load_rootara_core(rootara_core, vectorized, use_index)
+    df_merge = convert_result(file_path, method, rootara_df, vectorized)
+    df_merge.to_csv(output_csv, index = False)
 
-    # 调整列名
-    df.rename(columns={'rsid': 'RSID', 'chromosome': 'Chrom', 'position': 'Start'}, inplace=True)
+# 列存储输出中使用字典编码的列，RSID几乎不重复，不使用字典编码
+CONVERTED_DICT_COLUMNS = ['Chrom', 'Ref', 'Alt', 'Gene', 'gnomAD_AF', 'CLNSIG', 'CLNDN', 'Genotype', 'Check']
 
-    # 形成Genotype便于处理
-    df.loc[:, 'Genotype'] = df.apply(lambda x: x['allele1'] + x['allele2'], axis = 1)
+# 以列存储格式保存转换结果，数据库和VCF直接映射读取，与Go转换程序的 -format columnar 输出一致
+def save_converted(df_merge, output_dir):
+    df_merge = df_merge.assign(Start=pd.to_numeric(df_merge['Start']).astype(np.int64))
+    save_dataframe(output_dir, df_merge, CONVERTED_DICT_COLUMNS)
 
-    # 处理X、Y、MT || 不需要PAR区
-    df = df[df['Chrom'] != 25]
-    df.loc[:, 'Chrom'] = df['Chrom'].astype(str)
-    df.loc[:, 'Chrom'] = df['Chrom'].str.replace('23', 'X')
-    df.loc[:, 'Chrom'] = df['Chrom'].str.replace('24', 'Y')
-    df.loc[:, 'Chrom'] = df['Chrom'].str.replace('26', 'MT')
+def columnar_create(file_path, output_dir, method='auto', rootara_core='Rootara.core.202404.txt.gz', vectorized=True, use_index=True):
+    rootara_df = load_rootara_core(rootara_core, vectorized, use_index)
+    df_merge = convert_result(file_path, method, rootara_df, vectorized)
+    save_converted(df_merge, output_dir)
 
-    before_count = df.shape[0]
-    df_merge = merge_dataframes(df, rootara_df)
-    after_count = df_merge.shape[0]
+# 对比向量化与逐行处理的结果，输出的CSV需要完全一致
+def check_vectorized(file_path, method='auto', rootara_core='Rootara.core.202404.txt.gz'):
+    """
+    :return: 一致返回True，否则返回False
+    """
+    start = time.perf_counter()
+    rowwise_csv = convert_result(file_path, method, read_rootara_core(rootara_core, False), False).to_csv(index = False)
+    rowwise_time = time.perf_counter() - start
 
-    trans_rate = after_count / before_count
-    print('转换率：', "%.2f" % (trans_rate * 100) + '%')
-    print('转换前数量：', before_count)
-    print('转换后数量：', after_count)
-    return df_merge
+    start = time.perf_counter()
+    vectorized_csv = convert_result(file_path, method, read_rootara_core(rootara_core, True), True).to_csv(index = False)
+    vectorized_time = time.perf_counter() - start
 
-def csv_create(file_path, output_csv, method='23andme', rootara_core='Rootara.core.202404.txt.gz'):
-    rootara_df = read_rootara_core(rootara_core)
-    df_merge = pd.DataFrame()
-    if method == '23andme':
-        df_merge = read_23andme_result(file_path, rootara_df)
-    elif method == 'ancestry':
-        df_merge = read_ancestry_result(file_path, rootara_df)
-    elif method == 'wegene':
-        df_merge = read_uni_result(file_path, rootara_df)
-    df_merge.to_csv(output_csv, index = False)
+    print('逐行处理耗时：', "%.2f" % rowwise_time, '秒')
+    print('向量化处理耗时：', "%.2f" % vectorized_time, '秒')
+    if rowwise_csv != vectorized_csv:
+        print('结果不一致！')
+        return False
+    print('结果一致')
+    return True
 
 def main():
     parser = argparse.ArgumentParser(description='转换不同厂商的基因检测结果文件')
     parser.add_argument('--input', type=str, help='输入文件路径')
     parser.add_argument('--output', type=str, help='输出文件路径')
-    parser.add_argument('--method', type=str, choices=['23andme', 'ancestry', 'wegene'], help='文件来源 (23andme/ancestry/wegene)', default='23andme')
+    parser.add_argument('--method', type=str, choices=['auto'] + list(PARSERS), help='文件来源，auto时根据文件内容识别', default='auto')
     parser.add_argument('--rootara', type=str, help='Rootara核心库文件路径')
+    parser.add_argument('--rowwise', action='store_true', help='使用逐行处理，默认使用向量化处理')
+    parser.add_argument('--check', action='store_true', help='对比向量化与逐行处理的结果，不输出文件')
+    parser.add_argument('--no-index', action='store_true', help='不使用核心库的二进制索引')
+    parser.add_argument('--format', type=str, choices=['csv', 'columnar'], help='输出格式，columnar时输出路径为目录', default='csv')
     args = parser.parse_args()
 
+    if args.check:
+        if not all([args.input, args.method, args.rootara]):
+            parser.print_help()
+            sys.exit(1)
+        sys.exit(0 if check_vectorized(args.input, args.method, args.rootara) else 1)
+
     # 检查是否提供了所有必需参数
     if not all([args.input, args.output, args.method, args.rootara]):
         parser.print_help()
         sys.exit(1)
 
-    csv_create(args.input, args.output, args.method, args.rootara)
+    if args.format == 'columnar':
+        columnar_create(args.input, args.output, args.method, args.rootara, not args.rowwise, not args.no_index)
+    else:
+        csv_create(args.input, args.output, args.method, args.rootara, not args.rowwise, not args.no_index)
 
 if __name__ == '__main__':
     main()
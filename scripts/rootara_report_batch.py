@@ -0,0 +1,154 @@
+# coding=utf-8
+# pzw
+# 批量导入原始数据
+# 输入目录或文件列表，每个文件创建一个报告，最多同时创建concurrency个
+# 输入只能是导入目录（ROOTARA_IMPORT_DIR）中的文件或目录，解析符号链接后位于导入目录之外的路径会被拒绝
+# 各报告的格式转换、祖源分析等阶段在共享进程池中运行，报告表的写入通过写锁依次进行
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_report_create import create_new_report
+    from scripts.rootara_parsers import PARSERS
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_report_create import create_new_report
+    from scripts.rootara_parsers import PARSERS
+
+# 同时创建的报告数的默认值和上限，可通过环境变量调整，每个报告占用一个线程并运行完整的报告创建
+BATCH_CONCURRENCY = int(os.environ.get('ROOTARA_BATCH_CONCURRENCY', '4'))
+
+# 批量导入的原始数据只能放在这个目录中，相对路径相对于这个目录
+BATCH_IMPORT_DIR = os.environ.get('ROOTARA_IMPORT_DIR', '/data/import')
+
+# auto时根据每个文件的内容识别厂商
+SOURCES = ['auto'] + list(PARSERS)
+
+class ImportPathError(ValueError):
+    """输入路径不在导入目录中"""
+    pass
+
+def resolve_import_path(path, import_dir=BATCH_IMPORT_DIR):
+    """
+    :return: 解析符号链接后的绝对路径，不在导入目录中时报错
+    """
+    root = os.path.realpath(import_dir)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ImportPathError(f"路径不在导入目录 {import_dir} 中: {path}")
+    return resolved
+
+def list_batch_files(inputs, import_dir=BATCH_IMPORT_DIR):
+    """
+    展开输入的目录，目录中的文件按名称排序，忽略隐藏文件
+    :param inputs: 导入目录中的文件或目录路径列表，绝对路径或相对于导入目录的路径
+    :param import_dir: 导入目录
+    :return: 文件路径列表（解析符号链接后的绝对路径）
+    """
+    files = []
+    for path in inputs:
+        resolved = resolve_import_path(path, import_dir)
+        if os.path.isdir(resolved):
+            for name in sorted(os.listdir(resolved)):
+                if name.startswith('.'):
+                    continue
+                # 目录中的符号链接同样不能指向导入目录之外
+                file_path = resolve_import_path(os.path.join(resolved, name), import_dir)
+                if os.path.isfile(file_path):
+                    files.append(file_path)
+        elif os.path.isfile(resolved):
+            files.append(resolved)
+        else:
+            raise FileNotFoundError(f"文件或目录不存在: {path}")
+    return files
+
+# 报告名称默认使用文件名
+def default_report_name(file_path):
+    name = os.path.basename(file_path)
+    for suffix in ('.gz', '.zip', '.txt', '.csv', '.tsv'):
+        if name.lower().endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+def _create_one(user_id, file_path, source_from, db_path):
+    start = time.perf_counter()
+    try:
+        result = create_new_report(user_id, file_path, source_from, default_report_name(file_path), db_path)
+        return {'file': file_path, 'status': 'finished', 'report_id': result['report_id'], 'error': None,
+                'seconds': round(time.perf_counter() - start, 2)}
+    except Exception as e:
+        return {'file': file_path, 'status': 'failed', 'report_id': None, 'error': str(e),
+                'seconds': round(time.perf_counter() - start, 2)}
+
+def batch_create_reports(user_id, inputs, source_from, db_path, concurrency=BATCH_CONCURRENCY, progress_callback=None,
+                         import_dir=BATCH_IMPORT_DIR):
+    """
+    批量创建报告，单个文件失败不影响其他文件
+    失败的报告保留检查点，可以通过重试接口继续
+    :param inputs: 导入目录中的文件或目录路径列表
+    :param source_from: 数据来源，见SOURCES
+    :param concurrency: 同时创建的报告数，不超过BATCH_CONCURRENCY
+    :param progress_callback: 每个文件状态变化时调用 progress_callback(文件路径, 状态)
+    :param import_dir: 导入目录，输入不在其中时报错
+    :return: {'total', 'finished', 'failed', 'seconds', 'results': [每个文件的结果]}，结果顺序与输入一致
+    """
+    if source_from not in SOURCES:
+        raise ValueError(f"不支持的数据来源: {source_from}")
+    files = list_batch_files(inputs, import_dir)
+    start = time.perf_counter()
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(max(1, concurrency), BATCH_CONCURRENCY), thread_name_prefix='rootara_batch') as pool:
+        futures = {}
+        for file_path in files:
+            futures[pool.submit(_create_one, user_id, file_path, source_from, db_path)] = file_path
+            if progress_callback is not None:
+                progress_callback(file_path, 'running')
+        for future in as_completed(futures):
+            file_path = futures[future]
+            results[file_path] = future.result()
+            print(f"批量导入 {file_path}: {results[file_path]['status']}")
+            if progress_callback is not None:
+                progress_callback(file_path, 'done' if results[file_path]['status'] == 'finished' else 'failed')
+
+    ordered = [results[file_path] for file_path in files]
+    finished = sum(1 for result in ordered if result['status'] == 'finished')
+    return {
+        'total': len(ordered),
+        'finished': finished,
+        'failed': len(ordered) - finished,
+        'seconds': round(time.perf_counter() - start, 2),
+        'results': ordered
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='批量导入原始数据并创建报告')
+    parser.add_argument('--user_id', type=str, help='用户ID')
+    parser.add_argument('--inputs', type=str, nargs='+', help='导入目录中的原始数据文件或目录，可以有多个')
+    parser.add_argument('--import_dir', type=str, help='导入目录', default=BATCH_IMPORT_DIR)
+    parser.add_argument('--source_from', type=str, choices=SOURCES, help='数据来源，auto时根据文件内容识别', default='auto')
+    parser.add_argument('--db_path', type=str, help='数据库路径')
+    parser.add_argument('--concurrency', type=int, help=f'同时创建的报告数，最多{BATCH_CONCURRENCY}', default=BATCH_CONCURRENCY)
+    args = parser.parse_args()
+
+    # 检查是否提供了所有必需参数
+    if not all([args.user_id, args.inputs, args.source_from, args.db_path]):
+        parser.print_help()
+        sys.exit(1)
+
+    summary = batch_create_reports(args.user_id, args.inputs, args.source_from, args.db_path, args.concurrency,
+                                   import_dir=args.import_dir)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if summary['failed']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
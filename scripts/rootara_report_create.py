@@ -18,16 +18,40 @@ import subprocess
 if __name__ == "__main__":
     # 将项目根目录添加到模块搜索路径
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from scripts.rootara_admixture import data_to_sqlite as admix_data_to_sqlite
-    from scripts.rootara_snp_2_db import csv_to_sqlite
-    from scripts.rootara_2_vcf import trans_rootara_to_vcf
-    from scripts.rootara_haplogroup import insert_haplogroup_to_db
+    from scripts.rootara_admixture import compute_report_admixture, import_result_to_db as admix_import_result_to_db
+    from scripts.rootara_snp_2_db import csv_to_sqlite, report_data_exists
+    from scripts.rootara_haplogroup import call_report_haplogroups, import_haplogroup_to_db
+    from scripts.rootara_pipeline import run_stages
+    from scripts.rootara_upload import new_spool_path
+    from scripts.rootara_core_index import find_core_index
+    from scripts.rootara_converter import convert_with_service, ConverterUnavailable, CONVERTER_MODE, ROOTARA_CORE
+    from scripts.rootara_report_dedup import DEDUP_ENABLED, content_key, ensure_dedup_columns, find_duplicate, clone_report
+    from scripts.rootara_db import connect, attach_report
+    from scripts.rootara_rawdata import store_rawdata, ensure_rawdata_column
+    from scripts.rootara_parsers import resolve_source, is_gzip
+    from scripts.rootara_reader import columnar_create
+    from scripts.rootara_genotype_store import store_packed_genotypes
+    from scripts.rootara_report_state import (ReportBuildError, build_work_dir, claim_build, release_build, start_build,
+                                              get_build, set_build_status, set_stage_status, finish_build,
+                                              acquire_build, build_heartbeat)
 else:
     # 作为模块导入时使用相对导入
-    from scripts.rootara_admixture import data_to_sqlite as admix_data_to_sqlite
-    from scripts.rootara_snp_2_db import csv_to_sqlite
-    from scripts.rootara_2_vcf import trans_rootara_to_vcf
-    from scripts.rootara_haplogroup import insert_haplogroup_to_db
+    from scripts.rootara_admixture import compute_report_admixture, import_result_to_db as admix_import_result_to_db
+    from scripts.rootara_snp_2_db import csv_to_sqlite, report_data_exists
+    from scripts.rootara_haplogroup import call_report_haplogroups, import_haplogroup_to_db
+    from scripts.rootara_pipeline import run_stages
+    from scripts.rootara_upload import new_spool_path
+    from scripts.rootara_core_index import find_core_index
+    from scripts.rootara_converter import convert_with_service, ConverterUnavailable, CONVERTER_MODE, ROOTARA_CORE
+    from scripts.rootara_report_dedup import DEDUP_ENABLED, content_key, ensure_dedup_columns, find_duplicate, clone_report
+    from scripts.rootara_db import connect, attach_report
+    from scripts.rootara_rawdata import store_rawdata, ensure_rawdata_column
+    from scripts.rootara_parsers import resolve_source, is_gzip
+    from scripts.rootara_reader import columnar_create
+    from scripts.rootara_genotype_store import store_packed_genotypes
+    from scripts.rootara_report_state import (ReportBuildError, build_work_dir, claim_build, release_build, start_build,
+                                              get_build, set_build_status, set_stage_status, finish_build,
+                                              acquire_build, build_heartbeat)
 
 # 已测试1000000次，没有重复
 def generate_random_id():
@@ -41,8 +65,19 @@ def generate_random_id():
     random_id = ''.join(random.choice(chars) for _ in range(10))
     return random_id
 
-# 使用GO脚本进行格式转换
-def format_covert(input_data, source_from):
+# 报告创建的各个阶段，用于后台任务的进度展示
+REPORT_STAGES = ['convert', 'database', 'admixture', 'haplogroup', 'finish']
+
+# 通知阶段状态，未提供回调时不做处理
+def report_progress(progress_callback, stage, status='running'):
+    if progress_callback is not None:
+        progress_callback(stage, status)
+
+# Go转换程序支持的数据来源
+GO_METHODS = ['23andme', 'ancestry', 'wegene']
+
+# 使用GO脚本进行格式转换，output_dir为报告的工作目录，未提供时使用新建的临时目录
+def format_covert(input_data, source_from, output_dir=None):
     rootara_core_path = '/app/database/Rootara.core.202404.txt.gz'
     go_binary = '/app/scripts/rootara_reader'
     
@@ -52,7 +87,11 @@ def format_covert(input_data, source_from):
         os.makedirs(temp_base_dir, exist_ok=True)
     
     # 使用固定目录创建临时目录
-    temp_dir = tempfile.mkdtemp(dir=temp_base_dir)
+    if output_dir is None:
+        temp_dir = tempfile.mkdtemp(dir=temp_base_dir)
+    else:
+        temp_dir = output_dir
+        os.makedirs(temp_dir, exist_ok=True)
     
     # 检查是否是文件路径还是文件内容
     if os.path.exists(input_data) and os.path.isfile(input_data):
@@ -64,8 +103,45 @@ def format_covert(input_data, source_from):
         with open(input_file_path, 'w', encoding='utf-8') as f:
             f.write(input_data)
     
-    output_file = os.path.join(temp_dir, 'output.rootara.csv')
-    
+    # 转换结果以列存储格式保存在目录中，数据库和VCF直接映射读取
+    # 重试时删除上次未完成的转换结果
+    output_file = os.path.join(temp_dir, 'converted')
+    if os.path.exists(output_file):
+        shutil.rmtree(output_file)
+
+    # 优先使用已加载核心库的常驻转换服务，服务不可用时回退到一次性运行Go程序
+    # 每次转换写入新的临时目录，完成后再改名为output_file
+    # 服务超时后可能仍在写入它的临时目录，回退的转换不会与它写入同一个目录
+    if CONVERTER_MODE == 'service':
+        service_output = tempfile.mkdtemp(dir=temp_dir, prefix='converted.service.')
+        try:
+            convert_with_service(input_file_path, service_output, source_from)
+            return publish_converted(service_output, output_file)
+        except ConverterUnavailable as e:
+            print(f"{str(e)}，使用Go程序转换")
+
+    attempt_output = tempfile.mkdtemp(dir=temp_dir, prefix='converted.')
+    try:
+        convert_oneshot(input_file_path, attempt_output, source_from, rootara_core_path, go_binary)
+    except Exception:
+        shutil.rmtree(attempt_output, ignore_errors=True)
+        raise
+    return publish_converted(attempt_output, output_file)
+
+def publish_converted(attempt_output, output_file):
+    """转换完成的临时目录改名为转换结果目录"""
+    if os.path.exists(output_file):
+        shutil.rmtree(output_file)
+    os.replace(attempt_output, output_file)
+    return output_file
+
+# 一次性转换，结果写入output_file
+def convert_oneshot(input_file_path, output_file, source_from, rootara_core_path, go_binary):
+    # Go程序只支持这几种格式，其他格式在当前进程中用Python解析器转换
+    if source_from not in GO_METHODS or is_gzip(input_file_path):
+        columnar_create(input_file_path, output_file, source_from, rootara_core_path)
+        return output_file
+
     # 检查文件是否存在
     if not os.path.exists(go_binary):
         raise Exception(f"Go二进制文件不存在: {go_binary}")
@@ -75,7 +151,11 @@ def format_covert(input_data, source_from):
     try:
         # 使用subprocess.run代替os.system
         cmd = [go_binary, '-input', input_file_path, '-output', output_file, 
-               '-method', source_from, '-rootara', rootara_core_path]
+               '-method', source_from, '-rootara', rootara_core_path, '-format', 'columnar']
+        # 存在与核心库一致的二进制索引时直接映射索引，不再解压解析核心库
+        index_path = find_core_index(rootara_core_path)
+        if index_path is not None:
+            cmd += ['-index', index_path]
         
         # 执行命令
         result = subprocess.run(cmd, capture_output=True, text=True, check=False)
@@ -85,28 +165,64 @@ def format_covert(input_data, source_from):
                           f"标准输出: {result.stdout}，错误输出: {result.stderr}")
         
         # 检查输出文件是否存在
-        if not os.path.exists(output_file):
+        if not os.path.exists(os.path.join(output_file, 'meta.json')):
             raise Exception(f"格式转换后的文件不存在: {output_file}")
             
         return output_file
     except Exception as e:
         raise Exception(f"执行Go程序时出错: {str(e)}")
 
-def create_new_report(user_id, input_data, source_from, report_name, db_path, default_report=False, initail=False):
+# 将原始数据写入唯一的暂存文件，之后各阶段都读取这个文件
+def spool_input(input_data, source_from):
+    """
+    :param input_data: 文件路径或文件内容
+    :param source_from: 数据来源
+    :return: (文件路径, 是否为新建的暂存文件)
+    """
+    if os.path.exists(input_data) and os.path.isfile(input_data):
+        return input_data, False
+    spool_path = new_spool_path(source_from)
+    with open(spool_path, 'w', encoding='utf-8') as f:
+        f.write(input_data)
+    return spool_path, True
+
+# 以下为报告创建的各个阶段，在进程池中运行，需要定义在模块顶层
+# 格式转换，返回转换结果的列存储目录
+def stage_convert(input_file, source_from, work_dir):
+    return format_covert(input_file, source_from, work_dir)
+
+# 写入数据库并保存压缩的基因型，返回SNP总数
+def stage_database(db_path, report_id, convert):
+    rows = csv_to_sqlite(convert, db_path, report_id, force=True)['rows']
+    store_packed_genotypes(report_id, convert)
+    return rows
+
+# 祖源分析，直接读取原始文件，不依赖格式转换，返回各祖源成分的比例
+def stage_admixture(input_file, report_id, source_from):
+    return compute_report_admixture(input_file, report_id, source_from)
+
+# Y、MT单倍群，由转换结果生成Y、MT的VCF并同时运行haploGrouper，返回(Y单倍群, MT单倍群)
+def stage_haplogroup(report_id, convert):
+    return call_report_haplogroups(report_id, convert)
+
+def create_new_report(user_id, input_data, source_from, report_name, db_path, default_report=False, initail=False, progress_callback=None, move_input=False):
+    # move_input为True时，input_data是可以直接移动到原始数据目录的暂存文件
     # 当在初始化模式下，创建新的报告时，需要将default_report设置为True
     if initail:
         # 连接到数据库
-        conn = sqlite3.connect(db_path)
+        conn = connect(db_path)
         cursor = conn.cursor()
         default_report = True
         # 初始化模式下，只需要创建出SNP表即可
         report_id = 'RPT_TEMPLATE01'
         rawdata_id = 'RDT_TEMPLATE01'
-        rootara_csv = format_covert(input_data, source_from)
-        csv_to_sqlite(rootara_csv, db_path, report_id, force=True)
-        shutil.rmtree(os.path.dirname(rootara_csv))
+        converted = format_covert(input_data, source_from)
+        csv_to_sqlite(converted, db_path, report_id, force=True)
+        store_packed_genotypes(report_id, converted)
+        shutil.rmtree(os.path.dirname(converted))
 
         # 查看当前的report_id表的总行数
+        attach_report(conn, report_id)
         cursor.execute('SELECT COUNT(*) FROM ' + report_id)
         total_snp = cursor.fetchone()[0]
 
@@ -128,6 +244,7 @@ def create_new_report(user_id, input_data, source_from, report_name, db_path, de
     # 检查报告的数目
     cursor.execute('SELECT COUNT(*) FROM reports')
     report_count = cursor.fetchone()[0]
+    conn.close()
 
     # 如果这是用户上传的第一个报告，则自动设置为默认报告，因为会存在一个模板报告
     if initail is False and report_count == 1:
@@ -136,81 +253,192 @@ def create_new_report(user_id, input_data, source_from, report_name, db_path, de
     # 生成随机ID
     random_id = generate_random_id()
     report_id = 'RPT_' + random_id
-    rawdata_id = 'RDT_' + random_id
 
-    # 进行格式转换
-    rootara_csv = format_covert(input_data, source_from)
-    csv_to_sqlite(rootara_csv, db_path, report_id, force=True)
+    # 原始数据只落盘一次，保存到报告的工作目录中作为检查点，失败后重试时使用
+    input_file, spooled = spool_input(input_data, source_from)
+    owns_input = spooled or move_input
 
-    # 查看当前的report_id表的总行数
-    cursor.execute('SELECT COUNT(*) FROM ' + report_id)
-    total_snp = cursor.fetchone()[0]
+    # 未指定来源时根据文件开头识别厂商，同时检查基因组版本
+    try:
+        source_from = resolve_source(input_file, source_from)
+    except Exception:
+        if owns_input and os.path.exists(input_file):
+            os.remove(input_file)
+        raise
 
-    # 祖源分析
-    # 检查input_data是否为文件路径
-    # 祖源分析
-    # 检查input_data是否为文件路径
-    temp_base_dir = '/data/temp'
-    if not os.path.exists(temp_base_dir):
-        os.makedirs(temp_base_dir, exist_ok=True)
-    adm_temp_dir = tempfile.mkdtemp(dir=temp_base_dir)
-    if os.path.exists(input_data) and os.path.isfile(input_data):
-        # 如果是文件路径，直接传递
-        admix_data_to_sqlite(input_data, report_id, source_from, db_path, force=True)
+    # 与已有报告的原始数据相同时直接使用已有结果
+    key = report_content_key(input_file, source_from, db_path)
+    duplicate = find_duplicate(db_path, key) if key is not None else None
+    if duplicate is not None:
+        try:
+            result = clone_report(db_path, duplicate, report_id, user_id, source_from, report_name, default_report, key)
+        finally:
+            if owns_input and os.path.exists(input_file):
+                os.remove(input_file)
+        for stage in REPORT_STAGES:
+            report_progress(progress_callback, stage, 'done')
+        return result
+
+    work_dir = build_work_dir(report_id)
+    try:
+        input_file = checkpoint_input(input_file, work_dir, source_from, owns_input)
+    except Exception:
+        if owns_input and os.path.exists(input_file):
+            os.remove(input_file)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    start_build(db_path, report_id, user_id, source_from, report_name, default_report, input_file, work_dir, REPORT_STAGES, key)
+    return run_report_build(report_id, db_path, progress_callback)
+
+# 原始数据的内容键，无法计算（如核心库不存在）或关闭去重时返回None
+def report_content_key(input_file, source_from, db_path):
+    conn = connect(db_path)
+    try:
+        ensure_dedup_columns(conn)
+    finally:
+        conn.close()
+    if not DEDUP_ENABLED:
+        return None
+    try:
+        return content_key(input_file, source_from, ROOTARA_CORE)
+    except OSError as e:
+        print(f"无法计算原始数据的内容键，不进行去重: {str(e)}")
+        return None
+
+def checkpoint_input(input_file, work_dir, source_from, owns_input):
+    os.makedirs(work_dir, exist_ok=True)
+    checkpoint = os.path.join(work_dir, f'input.{source_from}.txt')
+    # 暂存文件直接移动，调用方提供的文件则复制
+    if owns_input:
+        shutil.move(input_file, checkpoint)
     else:
-        # 如果是文件内容，创建临时文件
-        temp_admix_file = os.path.join(adm_temp_dir, f'input_for_admix.{source_from}.txt')
-        with open(temp_admix_file, 'w', encoding='utf-8') as f:
-            f.write(input_data)
-        admix_data_to_sqlite(temp_admix_file, report_id, source_from, db_path, force=True)
-    shutil.rmtree(adm_temp_dir)
-
-    # 单倍群分析
-    temp_dir = os.path.dirname(rootara_csv)
-    vcf_file = os.path.join(temp_dir, 'output.vcf.gz')
-    trans_rootara_to_vcf(rootara_csv, vcf_file)
-    insert_haplogroup_to_db(report_id, vcf_file, db_path, force=True)
-
-    # 原始数据拓展名
-    extend_name = 'txt'
-    if source_from == '23andme':
-        extend_name = 'txt'
-    elif source_from == 'ancestry':
-        extend_name = 'txt'
-    elif source_from == 'wegene':
+        shutil.copy2(input_file, checkpoint)
+    return checkpoint
+
+def report_table_exists(db_path, report_id):
+    conn = sqlite3.connect(db_path)
+    try:
+        return report_data_exists(conn, report_id)
+    finally:
+        conn.close()
+
+# 已完成且检查点仍然有效的阶段，返回 {阶段名: 结果}
+def load_checkpoints(build, db_path):
+    completed = {}
+    for stage, state in build['stages'].items():
+        if state['status'] != 'done' or state['result'] is None:
+            continue
+        if stage == 'convert' and not os.path.exists(os.path.join(state['result'], 'meta.json')):
+            continue
+        if stage == 'database' and not report_table_exists(db_path, build['report_id']):
+            continue
+        completed[stage] = state['result']
+    return completed
+
+def run_report_build(report_id, db_path, progress_callback=None):
+    """
+    运行报告创建的各阶段，已完成的阶段使用检查点中的结果
+    失败时保留已完成阶段的结果，可以通过resume_report从第一个未完成的阶段继续
+    """
+    if not claim_build(report_id):
+        raise ReportBuildError(f"报告 {report_id} 正在创建中")
+    try:
+        if not acquire_build(db_path, report_id):
+            raise ReportBuildError(f"报告 {report_id} 正在其他进程中创建")
+        build = get_build(db_path, report_id)
+        try:
+            with build_heartbeat(db_path, report_id):
+                return _run_report_build(build, db_path, progress_callback)
+        except Exception as e:
+            set_build_status(db_path, report_id, 'failed', str(e))
+            raise
+    finally:
+        release_build(report_id)
+
+def _run_report_build(build, db_path, progress_callback):
+    report_id = build['report_id']
+    user_id = build['user_id']
+    source_from = build['source_from']
+    input_file = build['input_file']
+
+    # 阶段开始、失败时记录状态，完成时保存结果
+    def stage_progress(stage, status='running'):
+        if status in ('running', 'failed'):
+            set_stage_status(db_path, report_id, stage, status)
+        report_progress(progress_callback, stage, status)
+
+    def save_checkpoint(stage, result):
+        set_stage_status(db_path, report_id, stage, 'done', result)
+
+    # 格式转换 -> 写入数据库 / Y、MT单倍群，祖源分析直接读取原始文件，与格式转换同时运行
+    stages = {
+        'convert': {'func': stage_convert, 'args': (input_file, source_from, build['work_dir'])},
+        'database': {'func': stage_database, 'args': (db_path, report_id), 'deps': ['convert']},
+        'admixture': {'func': stage_admixture, 'args': (input_file, report_id, source_from)},
+        'haplogroup': {'func': stage_haplogroup, 'args': (report_id,), 'deps': ['convert']},
+    }
+    completed = load_checkpoints(build, db_path)
+    if completed:
+        print(f"报告 {report_id} 从检查点继续，已完成的阶段: {', '.join(completed)}")
+    results, timings = run_stages(stages, stage_progress, completed=completed, result_callback=save_checkpoint)
+    total_snp = results['database']
+
+    # 祖源分析和单倍群结果在主进程中统一写入数据库，重复写入时替换已有结果
+    stage_progress('finish')
+    try:
+        admix_import_result_to_db(results['admixture'], report_id, db_path)
+        y_hap, mt_hap = results['haplogroup']
+        import_haplogroup_to_db(report_id, y_hap, mt_hap, db_path)
+
+        # 原始数据拓展名
         extend_name = 'txt'
+        if source_from == '23andme':
+            extend_name = 'txt'
+        elif source_from == 'ancestry':
+            extend_name = 'txt'
+        elif source_from == 'wegene':
+            extend_name = 'txt'
 
-    # 将报告信息插入到reports表中
-    cursor.execute('''
-        INSERT INTO reports (report_id, user_id, file_format, data_source, name, select_default, total_snps, upload_date)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (report_id, user_id, extend_name, source_from, report_name, default_report, total_snp, datetime.now().isoformat()))
+        # 将原始数据压缩保存到固定目录中，重试时原始数据可能已经保存
+        raw_file_path = store_rawdata(input_file, report_id, source_from, extend_name)
 
-    if default_report:
-        # 如果设置为默认报告，则将其他报告的select_default设置为False
-        cursor.execute('UPDATE reports SET select_default = 0 WHERE user_id = ? AND report_id != ?', (user_id, report_id))
+        # 将报告信息插入到reports表中，原始数据路径记录在rawdata_path列
+        conn = connect(db_path)
+        ensure_rawdata_column(conn)
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO reports (report_id, user_id, file_format, data_source, name, select_default, total_snps, upload_date, content_hash, rawdata_path)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (report_id, user_id, extend_name, source_from, build['report_name'], build['default_report'], total_snp, datetime.now().isoformat(), build['content_hash'], raw_file_path))
 
-    # 提交更改并关闭连接
-    conn.commit()
-    conn.close()
+        if build['default_report']:
+            # 如果设置为默认报告，则将其他报告的select_default设置为False
+            cursor.execute('UPDATE reports SET select_default = 0 WHERE user_id = ? AND report_id != ?', (user_id, report_id))
 
-    # 将原始数据保存到固定目录中
-    rawdata_dir = '/data/rawdata'
-    if not os.path.exists(rawdata_dir):
-        os.makedirs(rawdata_dir, exist_ok=True)
-    
-    # 检查input_data是否为文件路径
-    if os.path.exists(input_data) and os.path.isfile(input_data):
-        # 如果是文件路径，直接复制
-        shutil.copy2(input_data, os.path.join(rawdata_dir, rawdata_id + '.' + source_from + '.' + extend_name))
-    else:
-        # 如果是文件内容，创建一个新文件
-        raw_file_path = os.path.join(rawdata_dir, rawdata_id + '.' + source_from + '.' + extend_name)
-        with open(raw_file_path, 'w', encoding='utf-8') as f:
-            f.write(input_data)
-    
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
+        # 提交更改并关闭连接
+        conn.commit()
+        conn.close()
+    except Exception:
+        stage_progress('finish', 'failed')
+        raise
+
+    # 删除创建记录和工作目录（包括格式转换结果）
+    finish_build(db_path, report_id)
+    report_progress(progress_callback, 'finish', 'done')
+    print(f"报告 {report_id} 创建完成，各阶段耗时: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    return {'report_id': report_id, 'timings': timings}
+
+def resume_report(report_id, db_path, progress_callback=None):
+    """
+    重试创建失败的报告，从第一个未完成的阶段继续
+    :return: 与create_new_report相同
+    """
+    build = get_build(db_path, report_id)
+    if build is None:
+        raise ReportBuildError(f"报告 {report_id} 的创建记录不存在")
+    if build['active']:
+        raise ReportBuildError(f"报告 {report_id} 正在创建中")
+    return run_report_build(report_id, db_path, progress_callback)
 
 def main():
     parser = argparse.ArgumentParser(description='创建新的报告')
@@ -0,0 +1,180 @@
+# coding=utf-8
+# pzw
+# 原始数据去重
+# 按内容计算原始数据的sha256，与数据来源、核心库版本一起作为报告的内容键
+# 上传的文件与已有报告相同时，新报告直接共用已有报告的报告文件和原始数据，复制祖源、单倍群结果，不重新计算
+# 报告文件导入后不再修改，新报告通过硬链接共用同一个文件
+
+import os
+import sys
+import time
+import hashlib
+import sqlite3
+from datetime import datetime
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_core_index import core_version
+    from scripts.rootara_db import connect, report_db_path, link_file
+    from scripts.rootara_rawdata import RAWDATA_DIR, find_rawdata, ensure_rawdata_column
+    from scripts.rootara_genotype_store import link_packed_genotypes
+    from scripts.rootara_snp_2_db import report_data_exists, drop_report_data, drop_clinvar_data, migrate_report_file
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_core_index import core_version
+    from scripts.rootara_db import connect, report_db_path, link_file
+    from scripts.rootara_rawdata import RAWDATA_DIR, find_rawdata, ensure_rawdata_column
+    from scripts.rootara_genotype_store import link_packed_genotypes
+    from scripts.rootara_snp_2_db import report_data_exists, drop_report_data, drop_clinvar_data, migrate_report_file
+
+# 是否对上传的文件去重，设置为0时每次都重新计算
+DEDUP_ENABLED = os.environ.get('ROOTARA_DEDUP', '1') != '0'
+
+# reports表中用于去重的列
+# content_hash: 内容键；data_ref: 旧报告中通过视图引用的SNP表所属的报告，为空时数据属于报告自己，报告文件不使用
+DEDUP_COLUMNS = [('content_hash', 'TEXT'), ('data_ref', 'TEXT')]
+
+# 从已有报告复制的结果表
+RESULT_TABLES = ['admixture', 'admixture_result', 'haplogroup']
+
+def file_sha256(file_path, chunk_size=4 * 1024 * 1024):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def content_key(file_path, source_from, rootara_core):
+    """
+    :return: 内容键，原始数据、数据来源和核心库版本都相同时一致
+    """
+    key = f'{source_from}:{core_version(rootara_core)}:{file_sha256(file_path)}'
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def ensure_dedup_columns(conn):
+    """已有数据库的reports表中增加去重使用的列"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(reports)")}
+    for name, sql_type in DEDUP_COLUMNS:
+        if name not in columns:
+            conn.execute(f"ALTER TABLE reports ADD COLUMN {name} {sql_type}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_content_hash ON reports (content_hash)")
+    conn.commit()
+
+def find_duplicate(db_path, key):
+    """
+    查找内容键相同且SNP表仍然存在的报告
+    :return: (报告编号, 数据所属的报告编号)，不存在时返回None
+    """
+    conn = connect(db_path)
+    try:
+        ensure_dedup_columns(conn)
+        ensure_rawdata_column(conn)
+        rows = conn.execute(
+            "SELECT report_id, COALESCE(data_ref, report_id) FROM reports WHERE content_hash = ? ORDER BY upload_date",
+            (key,)
+        ).fetchall()
+        for report_id, owner in rows:
+            if report_data_exists(conn, owner) and find_rawdata(conn, report_id) is not None:
+                return report_id, owner
+    finally:
+        conn.close()
+    return None
+
+# 引用原始数据
+def link_rawdata(source, report_id, rawdata_dir=RAWDATA_DIR):
+    name = os.path.basename(source)
+    return link_file(source, os.path.join(rawdata_dir, report_id.replace('RPT_', 'RDT_') + name[name.index('.'):]))
+
+def clone_report(db_path, duplicate, report_id, user_id, source_from, report_name, default_report, key):
+    """
+    用已有报告的结果创建新报告
+    报告文件（包含ClinVar表）与压缩的基因型通过硬链接共用，祖源、单倍群结果按新报告编号复制
+    数据所属的报告是旧报告时先转换为报告文件
+    :param duplicate: find_duplicate的返回值
+    :return: 报告信息，与create_new_report相同
+    """
+    start = time.perf_counter()
+    source_id, owner = duplicate
+    migrate_report_file(db_path, owner)
+
+    conn = connect(db_path)
+    raw_file = None
+    report_file = None
+    try:
+        raw_file = link_rawdata(find_rawdata(conn, source_id), report_id)
+        with conn:
+            report_file = link_file(report_db_path(db_path, owner), report_db_path(db_path, report_id))
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+            for table in RESULT_TABLES:
+                if table not in tables:
+                    continue
+                columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})") if row[1] != 'report_id']
+                column_list = ', '.join(columns)
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {table} (report_id, {column_list}) SELECT ?, {column_list} FROM {table} WHERE report_id = ?",
+                    (report_id, source_id)
+                )
+            file_format, total_snp = conn.execute(
+                "SELECT file_format, total_snps FROM reports WHERE report_id = ?", (source_id,)
+            ).fetchone()
+            conn.execute('''
+                INSERT INTO reports (report_id, user_id, file_format, data_source, name, select_default, total_snps, upload_date, content_hash, rawdata_path)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (report_id, user_id, file_format, source_from, report_name, default_report, total_snp, datetime.now().isoformat(), key, raw_file))
+            if default_report:
+                conn.execute('UPDATE reports SET select_default = 0 WHERE user_id = ? AND report_id != ?', (user_id, report_id))
+    except Exception:
+        for path in (raw_file, report_file):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        conn.close()
+    link_packed_genotypes(source_id, report_id)
+
+    seconds = time.perf_counter() - start
+    print(f"报告 {report_id} 与报告 {source_id} 的原始数据相同，直接使用已有结果，耗时 {seconds:.2f} 秒")
+    return {'report_id': report_id, 'timings': {'total': seconds}, 'duplicate_of': source_id}
+
+def release_report_data(conn, report_id, reindex=None):
+    """
+    删除报告前处理SNP表的引用
+    报告自己的数据仍被其他报告引用时，把SNP表改名给其中一个引用的报告，其余引用改为指向它
+    :param reindex: reindex(conn, 表名)，改名后按新表名重建索引
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(reports)")}
+    if 'data_ref' not in columns:
+        drop_report_data(conn, report_id)
+        return
+    row = conn.execute("SELECT data_ref FROM reports WHERE report_id = ?", (report_id,)).fetchone()
+    if row is not None and row[0]:
+        conn.execute(f'DROP VIEW IF EXISTS "{report_id}"')
+        drop_clinvar_data(conn, report_id)
+        return
+
+    dependents = [r[0] for r in conn.execute(
+        "SELECT report_id FROM reports WHERE data_ref = ? ORDER BY upload_date", (report_id,)
+    )]
+    if not dependents:
+        drop_report_data(conn, report_id)
+        return
+
+    # 改名后其他视图中引用的表名由SQLite自动更新，各报告的ClinVar表是单独的，只删除自己的
+    heir = dependents[0]
+    drop_clinvar_data(conn, report_id)
+    conn.execute(f'DROP VIEW IF EXISTS "{heir}"')
+    indexes = [r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (report_id,)
+    )]
+    conn.execute(f'ALTER TABLE "{report_id}" RENAME TO "{heir}"')
+    if reindex is not None:
+        for index in indexes:
+            conn.execute(f'DROP INDEX IF EXISTS "{index}"')
+        reindex(conn, heir)
+    conn.execute("UPDATE reports SET data_ref = NULL WHERE report_id = ?", (heir,))
+    conn.execute("UPDATE reports SET data_ref = ? WHERE data_ref = ?", (heir, report_id))
@@ -4,10 +4,25 @@
 # 会从sqlite数据库中删除对应的报告
 # 并会重新设定默认报告
 
-import sqlite3
+import os
 import argparse
 import sys
 
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import transaction
+    from scripts.rootara_genotype_store import remove_packed_genotypes
+    from scripts.rootara_report_dedup import release_report_data
+    from scripts.rootara_snp_2_db import create_report_indexes
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import transaction
+    from scripts.rootara_genotype_store import remove_packed_genotypes
+    from scripts.rootara_report_dedup import release_report_data
+    from scripts.rootara_snp_2_db import create_report_indexes
+
 def delete_report(report_id, db_file):
     print("删除报告：{report_id}".format(report_id=report_id))
 
@@ -15,41 +30,47 @@ def delete_report(report_id, db_file):
         print("模板报告不能删除")
         return
 
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-
-    # 删除报告表 - 使用引用标识符语法
-    cursor.execute("DROP TABLE IF EXISTS [{}]".format(report_id))
+    # 在一个事务中删除，异常时回滚，不会留下删除了一半的报告
+    with transaction(db_file) as conn:
+        cursor = conn.cursor()
 
-    # 删除admixture表记录
-    cursor.execute("DELETE FROM admixture WHERE report_id = ?", (report_id,))
+        # 删除admixture表记录
+        cursor.execute("DELETE FROM admixture WHERE report_id = ?", (report_id,))
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='admixture_result'")
+        if cursor.fetchone():
+            cursor.execute("DELETE FROM admixture_result WHERE report_id = ?", (report_id,))
 
-    # 删除单倍群表记录
-    cursor.execute("DELETE FROM haplogroup WHERE report_id =?", (report_id,))
+        # 删除单倍群表记录
+        cursor.execute("DELETE FROM haplogroup WHERE report_id =?", (report_id,))
 
-    # 删除报告记录
-    # 首先先查看这个报告是不是默认报告
-    cursor.execute("SELECT select_default FROM reports WHERE report_id =?", (report_id,))
-    result = cursor.fetchone()
+        # 删除报告记录
+        # 首先先查看这个报告是不是默认报告
+        cursor.execute("SELECT select_default FROM reports WHERE report_id =?", (report_id,))
+        result = cursor.fetchone()
     
-    # 如果是，则先需要将其他报告设置为默认报告
-    if result:
-        # 按上传时间排序选择最新的报告作为默认报告，排除当前要删除的报告
-        cursor.execute("""
-            UPDATE reports 
-            SET select_default = True 
-            WHERE report_id = (
-                SELECT report_id 
-                FROM reports 
-                WHERE report_id != ? 
-                ORDER BY upload_date DESC 
-                LIMIT 1
-            )
-        """, (report_id,))
-        conn.commit()
-
-    cursor.execute("DELETE FROM reports WHERE report_id = ?", (report_id,))
-    conn.commit()
+        # 如果是，则先需要将其他报告设置为默认报告
+        if result:
+            # 按上传时间排序选择最新的报告作为默认报告，排除当前要删除的报告
+            cursor.execute("""
+                UPDATE reports 
+                SET select_default = True 
+                WHERE report_id = (
+                    SELECT report_id 
+                    FROM reports 
+                    WHERE report_id != ? 
+                    ORDER BY upload_date DESC 
+                    LIMIT 1
+                )
+            """, (report_id,))
+
+        # 删除报告表，重复上传的报告只删除视图，被其他报告引用的表转给引用的报告
+        # 单独文件保存的报告直接删除文件，放在其他语句之后，前面的语句失败时文件不受影响
+        release_report_data(conn, report_id, create_report_indexes)
+
+        cursor.execute("DELETE FROM reports WHERE report_id = ?", (report_id,))
+
+    # 数据库中的记录删除后再删除压缩的基因型
+    remove_packed_genotypes(report_id)
 
 def main():
     parser = argparse.ArgumentParser(description='删除报告')
@@ -1,27 +1,32 @@
 # coding=utf-8
 # 将一份报告设置为默认报告
 
-import sqlite3
+import os
+import sys
 
-def set_default_report(report_id, db_path):
-    # 连接到数据库
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import transaction
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import transaction
 
-    # 检查report_id是否存在于reports表中
-    cursor.execute("SELECT COUNT(*) FROM reports WHERE report_id=?", (report_id,))
-    if cursor.fetchone()[0] == 0:
-        print("报告不存在！")
-        return
+def set_default_report(report_id, db_path):
+    # 在一个事务中修改，异常时回滚
+    with transaction(db_path) as conn:
+        cursor = conn.cursor()
 
-    # 将指定报告的is_default字段设置为1
-    cursor.execute("UPDATE reports SET select_default=1 WHERE report_id=?", (report_id,))
-    conn.commit()
+        # 检查report_id是否存在于reports表中
+        cursor.execute("SELECT COUNT(*) FROM reports WHERE report_id=?", (report_id,))
+        if cursor.fetchone()[0] == 0:
+            print("报告不存在！")
+            return
 
-    # 将其他报告的is_default字段设置为0
-    cursor.execute("UPDATE reports SET select_default=0 WHERE report_id<>?", (report_id,))
-    conn.commit()
+        # 将指定报告的is_default字段设置为1
+        cursor.execute("UPDATE reports SET select_default=1 WHERE report_id=?", (report_id,))
 
-    # 关闭数据库连接
-    conn.close()
+        # 将其他报告的is_default字段设置为0
+        cursor.execute("UPDATE reports SET select_default=0 WHERE report_id<>?", (report_id,))
     print("报告设置成功！")
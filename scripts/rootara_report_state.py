@@ -0,0 +1,430 @@
+# coding=utf-8
+# pzw
+# 报告创建的阶段状态与检查点
+# 每个报告创建时在数据库中记录各阶段的状态和结果，原始数据与转换结果保存在报告自己的工作目录中
+# 某个阶段失败后可以从第一个未完成的阶段继续，长时间未完成的报告由清理线程删除
+# 运行中的报告记录所有者（主机名、进程号）和心跳，只有所有者已退出的报告才会被标记为中断
+
+import os
+import sys
+import json
+import shutil
+import socket
+import sqlite3
+import threading
+import contextlib
+from datetime import datetime, timedelta
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import connect
+    from scripts.rootara_snp_2_db import drop_report_data
+    from scripts.rootara_genotype_store import remove_packed_genotypes
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import connect
+    from scripts.rootara_snp_2_db import drop_report_data
+    from scripts.rootara_genotype_store import remove_packed_genotypes
+
+# 报告创建的工作目录，保存原始数据和转换结果，创建完成后删除
+BUILD_DIR = '/data/temp/reports'
+
+# 未完成的报告保留的时间（小时），超过后由清理线程删除
+BUILD_TTL_HOURS = float(os.environ.get('ROOTARA_BUILD_TTL_HOURS', '72'))
+
+# 清理线程的运行间隔（秒）
+SWEEP_INTERVAL = int(os.environ.get('ROOTARA_BUILD_SWEEP_INTERVAL', '3600'))
+
+# 运行中的报告更新心跳的间隔（秒），超过HEARTBEAT_TIMEOUT秒没有心跳的报告视为所有者已退出
+HEARTBEAT_INTERVAL = int(os.environ.get('ROOTARA_BUILD_HEARTBEAT_INTERVAL', '30'))
+HEARTBEAT_TIMEOUT = int(os.environ.get('ROOTARA_BUILD_HEARTBEAT_TIMEOUT', '300'))
+
+# 当前进程作为报告创建所有者的标识
+OWNER_HOST = socket.gethostname()
+
+BUILD_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS report_builds (
+        report_id TEXT PRIMARY KEY,
+        user_id TEXT,
+        source_from TEXT,
+        report_name TEXT,
+        default_report BOOLEAN,
+        input_file TEXT,
+        work_dir TEXT,
+        content_hash TEXT,
+        status TEXT,
+        error TEXT,
+        owner_host TEXT,
+        owner_pid INTEGER,
+        heartbeat_at TIMESTAMP,
+        created_at TIMESTAMP,
+        updated_at TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS report_build_stages (
+        report_id TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        status TEXT,
+        result TEXT,
+        updated_at TIMESTAMP,
+        PRIMARY KEY (report_id, stage)
+    )
+    '''
+]
+
+# 当前进程中正在运行的报告，不能被重试或清理
+_active = set()
+_active_lock = threading.Lock()
+
+class ReportBuildError(Exception):
+    """报告创建记录不存在或当前状态不允许该操作"""
+    pass
+
+def _now():
+    return datetime.now().isoformat()
+
+# 较早创建的report_builds表缺少的列
+BUILD_COLUMNS = {
+    'content_hash': 'TEXT',
+    'owner_host': 'TEXT',
+    'owner_pid': 'INTEGER',
+    'heartbeat_at': 'TIMESTAMP'
+}
+
+# 已检查过表结构的数据库
+_migrated = set()
+
+def _connect(db_path):
+    conn = connect(db_path)
+    if db_path not in _migrated:
+        for sql in BUILD_TABLES:
+            conn.execute(sql)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(report_builds)")}
+        for column, column_type in BUILD_COLUMNS.items():
+            if column not in columns:
+                conn.execute(f"ALTER TABLE report_builds ADD COLUMN {column} {column_type}")
+        conn.commit()
+        _migrated.add(db_path)
+    return conn
+
+def build_work_dir(report_id):
+    return os.path.join(BUILD_DIR, report_id)
+
+def claim_build(report_id):
+    """标记报告在当前进程中运行，已在运行时返回False"""
+    with _active_lock:
+        if report_id in _active:
+            return False
+        _active.add(report_id)
+        return True
+
+def release_build(report_id):
+    with _active_lock:
+        _active.discard(report_id)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def owned_here(build):
+    return build['owner_host'] == OWNER_HOST and build['owner_pid'] == os.getpid()
+
+def build_owner_alive(build):
+    """
+    报告创建的所有者是否仍在运行
+    - 所有者是当前进程：报告在当前进程中运行
+    - 所有者在同一主机上：进程存在且心跳未超时（进程号可能已被其他进程复用）
+    - 其他主机或没有所有者记录（较早的记录）：心跳未超时
+    """
+    if owned_here(build):
+        with _active_lock:
+            return build['report_id'] in _active
+    if build['owner_host'] == OWNER_HOST and build['owner_pid'] is not None and not _pid_alive(build['owner_pid']):
+        return False
+    heartbeat = build['heartbeat_at'] or build['updated_at']
+    deadline = (datetime.now() - timedelta(seconds=HEARTBEAT_TIMEOUT)).isoformat()
+    return heartbeat is not None and heartbeat >= deadline
+
+def start_build(db_path, report_id, user_id, source_from, report_name, default_report, input_file, work_dir, stages, content_hash=None):
+    """记录新的报告创建，各阶段为pending"""
+    conn = _connect(db_path)
+    try:
+        with conn:
+            now = _now()
+            conn.execute('''
+                INSERT INTO report_builds (report_id, user_id, source_from, report_name, default_report,
+                                           input_file, work_dir, content_hash, status, error,
+                                           owner_host, owner_pid, heartbeat_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'running', NULL, ?, ?, ?, ?, ?)
+            ''', (report_id, user_id, source_from, report_name, default_report, input_file, work_dir, content_hash,
+                  OWNER_HOST, os.getpid(), now, now, now))
+            conn.executemany(
+                "INSERT INTO report_build_stages (report_id, stage, status, result, updated_at) VALUES (?, ?, 'pending', NULL, ?)",
+                [(report_id, stage, now) for stage in stages]
+            )
+    finally:
+        conn.close()
+
+def get_build(db_path, report_id):
+    """
+    :return: 报告创建记录，包含stages {阶段: {'status', 'result'}}，不存在时返回None
+    """
+    conn = _connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute("SELECT * FROM report_builds WHERE report_id = ?", (report_id,)).fetchone()
+        if row is None:
+            return None
+        build = dict(row)
+        build['stages'] = {
+            stage['stage']: {'status': stage['status'], 'result': json.loads(stage['result']) if stage['result'] else None}
+            for stage in conn.execute("SELECT stage, status, result FROM report_build_stages WHERE report_id = ?", (report_id,))
+        }
+    finally:
+        conn.close()
+    with _active_lock:
+        build['active'] = report_id in _active
+    # 其他进程正在运行的报告同样不能重试
+    if not build['active'] and build['status'] == 'running' and not owned_here(build):
+        build['active'] = build_owner_alive(build)
+    return build
+
+def list_builds(db_path):
+    """列出未完成的报告创建"""
+    conn = _connect(db_path)
+    try:
+        report_ids = [row[0] for row in conn.execute("SELECT report_id FROM report_builds ORDER BY created_at")]
+    finally:
+        conn.close()
+    return [build for build in (get_build(db_path, report_id) for report_id in report_ids) if build is not None]
+
+def set_build_status(db_path, report_id, status, error=None):
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.execute("UPDATE report_builds SET status = ?, error = ?, updated_at = ? WHERE report_id = ?",
+                         (status, error, _now(), report_id))
+    finally:
+        conn.close()
+
+def acquire_build(db_path, report_id):
+    """
+    当前进程成为报告创建的所有者，状态改为running
+    :return: 其他存活的进程正在创建该报告时返回False
+    """
+    conn = _connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT * FROM report_builds WHERE report_id = ?", (report_id,)).fetchone()
+            if row is None:
+                raise ReportBuildError(f"报告 {report_id} 的创建记录不存在")
+            if row['status'] == 'running' and not owned_here(row) and build_owner_alive(row):
+                conn.rollback()
+                return False
+            now = _now()
+            conn.execute('''
+                UPDATE report_builds SET status = 'running', error = NULL, owner_host = ?, owner_pid = ?,
+                                         heartbeat_at = ?, updated_at = ?
+                WHERE report_id = ?
+            ''', (OWNER_HOST, os.getpid(), now, now, report_id))
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.close()
+
+def touch_build(db_path, report_id):
+    """更新当前进程运行中报告的心跳"""
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.execute("UPDATE report_builds SET heartbeat_at = ? WHERE report_id = ? AND owner_host = ? AND owner_pid = ?",
+                         (_now(), report_id, OWNER_HOST, os.getpid()))
+    finally:
+        conn.close()
+
+@contextlib.contextmanager
+def build_heartbeat(db_path, report_id, interval=HEARTBEAT_INTERVAL):
+    """报告创建期间在后台线程中定时更新心跳"""
+    stopping = threading.Event()
+
+    def run():
+        while not stopping.wait(interval):
+            try:
+                touch_build(db_path, report_id)
+            except Exception as e:
+                print(f"更新报告 {report_id} 的心跳失败: {str(e)}")
+
+    thread = threading.Thread(target=run, name=f'rootara_build_heartbeat_{report_id}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopping.set()
+        thread.join()
+
+def set_stage_status(db_path, report_id, stage, status, result=None):
+    """阶段完成时保存结果作为检查点，结果需要可以序列化为JSON"""
+    conn = _connect(db_path)
+    try:
+        with conn:
+            now = _now()
+            conn.execute('''
+                INSERT OR REPLACE INTO report_build_stages (report_id, stage, status, result, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (report_id, stage, status, json.dumps(result) if result is not None else None, now))
+            conn.execute("UPDATE report_builds SET updated_at = ?, heartbeat_at = ? WHERE report_id = ?", (now, now, report_id))
+    finally:
+        conn.close()
+
+def finish_build(db_path, report_id):
+    """报告创建完成，删除状态记录和工作目录"""
+    build = get_build(db_path, report_id)
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM report_build_stages WHERE report_id = ?", (report_id,))
+            conn.execute("DELETE FROM report_builds WHERE report_id = ?", (report_id,))
+    finally:
+        conn.close()
+    if build is not None and build['work_dir'] and os.path.exists(build['work_dir']):
+        shutil.rmtree(build['work_dir'])
+
+def mark_interrupted_builds(db_path):
+    """
+    API进程启动时和清理线程中调用，所有者已退出的运行中报告标记为失败，之后可以重试
+    其他存活的进程（包括其他主机）正在运行的报告不受影响
+    :return: 标记的报告数
+    """
+    conn = _connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            running = conn.execute("SELECT * FROM report_builds WHERE status = 'running'").fetchall()
+            report_ids = [row['report_id'] for row in running if not build_owner_alive(row)]
+            for report_id in report_ids:
+                conn.execute("UPDATE report_build_stages SET status = 'pending' WHERE report_id = ? AND status = 'running'", (report_id,))
+                conn.execute(
+                    "UPDATE report_builds SET status = 'failed', error = '创建报告的进程已退出，报告创建中断', updated_at = ? WHERE report_id = ? AND status = 'running'",
+                    (_now(), report_id)
+                )
+            return len(report_ids)
+    finally:
+        conn.close()
+
+def discard_build(db_path, report_id):
+    """删除未完成报告已写入的数据、工作目录和状态记录"""
+    build = get_build(db_path, report_id)
+    if build is None:
+        return
+    conn = _connect(db_path)
+    try:
+        with conn:
+            # 已写入reports表的报告已经完成，只删除状态记录
+            discarded = conn.execute("SELECT COUNT(*) FROM reports WHERE report_id = ?", (report_id,)).fetchone()[0] == 0
+            if discarded:
+                drop_report_data(conn, report_id)
+                tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+                for table in ('admixture', 'admixture_result', 'haplogroup'):
+                    if table in tables:
+                        conn.execute(f"DELETE FROM {table} WHERE report_id = ?", (report_id,))
+            conn.execute("DELETE FROM report_build_stages WHERE report_id = ?", (report_id,))
+            conn.execute("DELETE FROM report_builds WHERE report_id = ?", (report_id,))
+    finally:
+        conn.close()
+    if discarded:
+        remove_packed_genotypes(report_id)
+    if build['work_dir'] and os.path.exists(build['work_dir']):
+        shutil.rmtree(build['work_dir'])
+
+def sweep_abandoned_builds(db_path, ttl_hours=BUILD_TTL_HOURS):
+    """
+    清理超过保留时间仍未完成的报告
+    :return: 清理的报告编号列表
+    """
+    deadline = (datetime.now() - timedelta(hours=ttl_hours)).isoformat()
+    conn = _connect(db_path)
+    try:
+        report_ids = [row[0] for row in conn.execute("SELECT report_id FROM report_builds WHERE updated_at < ?", (deadline,))]
+    finally:
+        conn.close()
+
+    swept = []
+    for report_id in report_ids:
+        build = get_build(db_path, report_id)
+        # 其他进程仍在运行的报告不清理
+        if build is None or build['active'] or not claim_build(report_id):
+            continue
+        try:
+            discard_build(db_path, report_id)
+            swept.append(report_id)
+            print(f"清理未完成的报告: {report_id}")
+        finally:
+            release_build(report_id)
+    return swept
+
+# API进程中定时运行清理
+class BuildSweeper:
+    def __init__(self, db_path, interval=SWEEP_INTERVAL, ttl_hours=BUILD_TTL_HOURS):
+        self.db_path = db_path
+        self.interval = interval
+        self.ttl_hours = ttl_hours
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                interrupted = mark_interrupted_builds(self.db_path)
+                if interrupted:
+                    print(f"{interrupted} 个报告创建的进程已退出，可以重试")
+                sweep_abandoned_builds(self.db_path, self.ttl_hours)
+            except Exception as e:
+                print(f"清理未完成的报告失败: {str(e)}")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='rootara_build_sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+_sweeper = None
+
+def start_build_sweeper(db_path):
+    """在API进程启动时调用：所有者已退出的报告标记为失败，启动定时清理"""
+    global _sweeper
+    if not os.path.exists(db_path):
+        return None
+    interrupted = mark_interrupted_builds(db_path)
+    if interrupted:
+        print(f"{interrupted} 个报告创建在上次运行时中断，可以重试")
+    if _sweeper is None:
+        _sweeper = BuildSweeper(db_path)
+    _sweeper.start()
+    return _sweeper
+
+def stop_build_sweeper():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.stop()
+        _sweeper = None
@@ -2,37 +2,42 @@
 # pzw
 # 主要用于调整和查询报告的信息
 
-import sqlite3
+import os
+import sys
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import get_connection, transaction
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import get_connection, transaction
 
 # 调整报告的自定义名称
 def update_report_name(report_id, new_name, db_file):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE reports SET name = ? WHERE report_id = ?", (new_name, report_id))
-    conn.commit()
-    conn.close()
+    with transaction(db_file) as conn:
+        conn.execute("UPDATE reports SET name = ? WHERE report_id = ?", (new_name, report_id))
 
 # 查询报告的信息
 def get_report_info(report_id, db_file):
-    conn = sqlite3.connect(db_file)
+    conn = get_connection(db_file)
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM reports WHERE report_id =?", (report_id,))
     report_info = cursor.fetchone()
-    conn.close()
     return report_info
 
 # 列出所有报告的ID
 def list_all_report_ids(db_file):
-    conn = sqlite3.connect(db_file)
+    conn = get_connection(db_file)
     cursor = conn.cursor()
     cursor.execute("SELECT report_id FROM reports")
     report_ids = cursor.fetchall()
-    conn.close()
     return [report_id[0] for report_id in report_ids]
 
 # 所有的报告信息 || 现在没有区分用户，所以不需要用户ID
 def get_all_report_info(db_file):
-    conn = sqlite3.connect(db_file)
+    conn = get_connection(db_file)
     cursor = conn.cursor()
 
     # 当报告的数目≥2，不需要显示默认报告RPT_TEMPLATE01
@@ -43,7 +48,6 @@ def get_all_report_info(db_file):
     else:
         cursor.execute("SELECT * FROM reports")
     report_info = cursor.fetchall()
-    conn.close()
 
     sample_info_json = []
     for i in report_info:
@@ -1,18 +1,710 @@
 # coding=utf-8
 # 将数据进行转换，并写入数据库
 
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+import itertools
 import pandas as pd
 import sqlite3
 
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_columnar import load_dataframe
+    from scripts.rootara_db import (connect, write_lock, report_db_path, main_db_path, attach_report, detach_report,
+                                    link_file, Connection)
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_columnar import load_dataframe
+    from scripts.rootara_db import (connect, write_lock, report_db_path, main_db_path, attach_report, detach_report,
+                                    link_file, Connection)
+
+# 报告表结构，顺序与转换程序输出的列一致
+REPORT_COLUMNS = [
+    ('Chrom', 'chromosome', 'TEXT'),
+    ('Start', 'position', 'INTEGER'),
+    ('Ref', 'ref', 'TEXT'),
+    ('Alt', 'alt', 'TEXT'),
+    ('Gene', 'gene', 'TEXT'),
+    ('RSID', 'rsid', 'TEXT'),
+    ('gnomAD_AF', 'gnomAD_AF', 'FLOAT'),
+    ('CLNSIG', 'clnsig', 'TEXT'),
+    ('CLNDN', 'clndn', 'TEXT'),
+    ('Genotype', 'genotype', 'TEXT'),
+    ('Check', 'gt', 'TEXT')
+]
+
+# 报告表的索引 (索引名后缀, 列)
+# rsid、位置、基因、临床意义用于查询和筛选；position、gnomAD_AF为表格常用的排序列，按索引顺序读取，不需要排序整张表
+REPORT_INDEXES = [
+    ('rsid', ['rsid']),
+    ('pos', ['chromosome', 'position']),
+    ('gene', ['gene']),
+    ('clnsig', ['clnsig']),
+    ('position', ['position']),
+    ('af', ['gnomAD_AF'])
+]
+
+# 统计信息采样的行数
+ANALYSIS_LIMIT = 1000
+
+# variants表的索引，(chromosome, position)已是唯一索引的前缀
+VARIANT_INDEXES = [index for index in REPORT_INDEXES if index[0] != 'pos']
+
+# 每批写入的行数
+BATCH_SIZE = 50000
+
+# ClinVar表中保留的临床意义，clnsig有多个分类时以第一个为准 (clinvar_stats的列, clnsig_primary)
+CLINVAR_CATEGORIES = [
+    ('pathogenic', 'Pathogenic'),
+    ('likely_pathogenic', 'Likely_pathogenic'),
+    ('benign', 'Benign'),
+    ('likely_benign', 'Likely_benign'),
+    ('uncertain_significance', 'Uncertain_significance')
+]
+
+# ClinVar表的索引，用于按临床意义、基因、rsid筛选
+CLINVAR_INDEXES = [
+    ('primary', ['clnsig_primary']),
+    ('gene', ['gene']),
+    ('rsid', ['rsid'])
+]
+
+# 每个报告的ClinVar统计，snv_only为1时不包含插入缺失，schema为主数据库或报告文件
+CLINVAR_STATS_TABLE = f'''
+    CREATE TABLE IF NOT EXISTS "{{schema}}".clinvar_stats (
+        report_id TEXT NOT NULL,
+        snv_only INTEGER NOT NULL,
+        {", ".join(f"{column} INTEGER" for column, _ in CLINVAR_CATEGORIES)},
+        total INTEGER,
+        PRIMARY KEY (report_id, snv_only)
+    )
+'''
+
+# 报告的存储方式
+# 每个报告一个数据库文件（reports/报告编号.db），查询时附加到连接上（见rootara_db.attach_report）
+# 注释保存在主数据库中所有报告共用的variants表中，基因型字典编码保存在genotype_codes表中
+# 报告文件的snps、clinvar表只保存 (variant_id, 基因型编码)，附加时通过视图连接共用的表，列与完整的报告表一致
+# 导入时只在合并新位点时短暂持有主数据库的写锁，其余时间只锁报告自己的文件；删除报告只需要删除文件
+# 文件导入完成后不再修改，原始数据相同的报告通过硬链接共用
+# 早期版本保存在主数据库中的报告（以下称旧报告）仍然可以读取，由migrate_report_files转换为报告文件：
+# table: 每个报告一张完整的表，包含所有注释列
+# shared: 与报告文件一样使用共用的表，报告保存 (variant_id, 基因型编码) 的表为 报告编号_gt，报告名为连接两者的视图
+# view: 原始数据相同的报告通过视图引用其他报告的表（reports.data_ref）
+# 更早版本的报告文件保存完整的行，同样由migrate_report_files转换
+LEGACY_STORAGES = ('table', 'shared', 'view')
+
+# 共用的注释表和基因型编码表
+# 同一位点在不同报告中的注释都来自核心库，按 (染色体, 位置, 参考, 变异, rsid) 只保存一份
+VARIANT_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS variants (
+        variant_id INTEGER PRIMARY KEY,
+        chromosome TEXT,
+        position INTEGER,
+        ref TEXT,
+        alt TEXT,
+        gene TEXT,
+        rsid TEXT,
+        gnomAD_AF FLOAT,
+        clnsig TEXT,
+        clndn TEXT
+    )
+    ''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_variants_key ON variants (chromosome, position, ref, alt, IFNULL(rsid, \'\'))',
+    '''
+    CREATE TABLE IF NOT EXISTS genotype_codes (
+        code INTEGER PRIMARY KEY,
+        genotype TEXT,
+        gt TEXT,
+        UNIQUE (genotype, gt)
+    )
+    '''
+]
+
+# 注释列，variants表中的列名与报告表一致
+VARIANT_COLUMNS = ['chromosome', 'position', 'ref', 'alt', 'gene', 'rsid', 'gnomAD_AF', 'clnsig', 'clndn']
+
+# 报告文件中的表，clinvar为有明确临床意义的位点（见build_clinvar_table）
+REPORT_FILE_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS "{schema}".snps (variant_id INTEGER PRIMARY KEY, code INTEGER NOT NULL)',
+    '''
+    CREATE TABLE IF NOT EXISTS "{schema}".clinvar (
+        variant_id INTEGER PRIMARY KEY,
+        code INTEGER NOT NULL,
+        clnsig_primary TEXT,
+        snv INTEGER
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS "{schema}".idx_clinvar_primary ON clinvar (clnsig_primary)'
+]
+
+# 导入时报告文件使用的PRAGMA，只对当前连接生效
+# 主数据库中共用表的写入很短，保持默认设置；journal_mode由查询使用的连接切换为WAL（见rootara_db.enable_wal）
+INGEST_PRAGMAS = [
+    'PRAGMA "{schema}".synchronous = OFF',
+    'PRAGMA "{schema}".cache_size = -262144',
+    'PRAGMA temp_store = MEMORY'
+]
 
 def convert_data_to_df(file_path):
-    df = pd.read_csv(file_path, sep=',', header=0, low_memory=False)
+    # 转换结果为列存储目录时直接映射读取，空字符串与读取CSV时一样作为缺失值
+    if os.path.isdir(file_path):
+        return load_dataframe(file_path, [name for name, _, _ in REPORT_COLUMNS], empty=None)
+    # 染色体按字符串读取，避免只有常染色体时被识别为整数
+    df = pd.read_csv(file_path, sep=',', header=0, dtype={'Chrom': str}, low_memory=False)
     return df
 
+def iter_dataframe_rows(df):
+    """
+    按REPORT_COLUMNS顺序逐行读取DataFrame
+    按列转换为Python对象后再组合成行，缺失值(NaN)写入SQLite时为NULL
+    :return: 元组迭代器
+    """
+    columns = [df[name].to_numpy(dtype=object).tolist() for name, _, _ in REPORT_COLUMNS]
+    return zip(*columns)
+
+# shared存储方式的旧报告保存基因型的表
+def genotype_table(report_id):
+    return f'{report_id}_gt'
+
+def report_storage(conn, report_id):
+    """
+    :return: 'file'(报告文件)，旧报告为'table'、'shared'、'view'（见LEGACY_STORAGES），不存在时返回None
+    """
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name=? AND type IN ('table', 'view')", (report_id,)).fetchone()
+    if row is None:
+        return 'file' if os.path.exists(report_db_path(main_db_path(conn), report_id)) else None
+    if row[0] == 'table':
+        return 'table'
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (genotype_table(report_id),)).fetchone()
+    return 'shared' if exists else 'view'
+
+def report_data_exists(conn, report_id):
+    """报告的SNP数据是否存在，引用其他报告的视图也算存在"""
+    return report_storage(conn, report_id) is not None
+
+def drop_report_data(conn, report_id):
+    """删除报告的SNP数据，不处理其他报告对它的引用"""
+    storage = report_storage(conn, report_id)
+    if storage == 'file':
+        remove_report_file(conn, report_id)
+        return
+    if storage == 'table':
+        conn.execute(f'DROP TABLE "{report_id}"')
+    elif storage is not None:
+        conn.execute(f'DROP VIEW "{report_id}"')
+    conn.execute(f'DROP TABLE IF EXISTS "{genotype_table(report_id)}"')
+    drop_clinvar_data(conn, report_id)
+
+def remove_report_file(conn, report_id):
+    """删除file存储方式的报告文件，其他连接（以及事务中的当前连接）已附加的文件在下次查询时分离"""
+    if isinstance(conn, Connection) and not conn.in_transaction:
+        detach_report(conn, report_id)
+    path = report_db_path(main_db_path(conn), report_id)
+    for name in (path, path + '-journal', path + '.building', path + '.building-journal'):
+        if os.path.exists(name):
+            os.remove(name)
+
+def create_report_indexes(conn, table_name, indexes=REPORT_INDEXES):
+    for suffix, columns in indexes:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_{suffix}" ON "{table_name}" ({", ".join(columns)})')
+
+# 更新查询优化器的统计信息，analysis_limit限制每个索引采样的行数，只需要几毫秒
+def analyze_report(conn, table_name):
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    conn.execute(f'ANALYZE "{table_name}"')
+
+# ClinVar表：报告中有明确临床意义的位点，导入时生成，查询时不需要再扫描整个报告
+def clinvar_table(report_id):
+    return f'{report_id}_clinvar'
+
+def drop_clinvar_data(conn, report_id):
+    # 只删除主数据库中的表，TEMP中同名的是file存储方式报告的视图
+    conn.execute(f'DROP TABLE IF EXISTS main."{clinvar_table(report_id)}"')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='clinvar_stats'").fetchone():
+        conn.execute("DELETE FROM clinvar_stats WHERE report_id = ?", (report_id,))
+
+def save_clinvar_stats(conn, report_id, table=None, schema='main'):
+    """:param schema: ClinVar表和统计所在的数据库，报告文件的统计保存在文件中"""
+    table = table or clinvar_table(report_id)
+    conn.execute(CLINVAR_STATS_TABLE.format(schema=schema))
+    conn.execute(f'DELETE FROM "{schema}".clinvar_stats WHERE report_id = ?', (report_id,))
+    counts = ', '.join(f"SUM(clnsig_primary = '{primary}')" for _, primary in CLINVAR_CATEGORIES)
+    columns = ', '.join(column for column, _ in CLINVAR_CATEGORIES)
+    for snv_only, where in ((0, ''), (1, ' WHERE snv = 1')):
+        conn.execute(f'''
+            INSERT INTO "{schema}".clinvar_stats (report_id, snv_only, {columns}, total)
+            SELECT ?, ?, {counts}, COUNT(*) FROM "{schema}"."{table}"{where}
+        ''', (report_id, snv_only))
+
+def clinvar_query(source, columns='*'):
+    """
+    ClinVar表的查询
+    条件：有基因型（gt不是'.'、'WT'）、有疾病名称、clnsig的第一个分类为CLINVAR_CATEGORIES之一
+    clnsig_primary为clnsig的第一个分类；snv为0时是插入缺失（ref或alt为I/D）
+    :param source: FROM子句，需要包含报告表的列
+    :param columns: 除clnsig_primary、snv外保留的列
+    """
+    primaries = ', '.join(f"'{primary}'" for _, primary in CLINVAR_CATEGORIES)
+    return f'''
+        SELECT * FROM (
+            SELECT {columns},
+                   CASE WHEN INSTR(clnsig, '/') > 0 THEN SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) ELSE clnsig END AS clnsig_primary,
+                   CASE WHEN ref != 'I' AND ref != 'D' AND alt != 'I' AND alt != 'D' THEN 1 ELSE 0 END AS snv
+            FROM {source}
+            WHERE gt != '.' AND gt IS NOT NULL AND gt != 'WT'
+              AND clndn != '.' AND clndn IS NOT NULL
+              AND clnsig != 'Conflicting_classifications_of_pathogenicity' AND clnsig IS NOT NULL
+        )
+        WHERE clnsig_primary IN ({primaries})
+    '''
+
+def build_clinvar_table(conn, report_id):
+    """生成旧报告的ClinVar表和统计，条件见clinvar_query"""
+    table = clinvar_table(report_id)
+    drop_clinvar_data(conn, report_id)
+    source = f'"{report_id}"'
+    conn.execute(f'CREATE TABLE "{table}" AS {clinvar_query(source)}')
+    create_report_indexes(conn, table, CLINVAR_INDEXES)
+    save_clinvar_stats(conn, report_id, table)
+
+def build_report_clinvar(conn, report_id, schema):
+    """生成报告文件的ClinVar表和统计，与snps表一样只保存编码"""
+    source = f'''
+        "{schema}".snps r
+        JOIN main.variants v ON v.variant_id = r.variant_id
+        JOIN main.genotype_codes c ON c.code = r.code
+    '''
+    conn.execute(f'DELETE FROM "{schema}".clinvar')
+    conn.execute(f'''
+        INSERT INTO "{schema}".clinvar (variant_id, code, clnsig_primary, snv)
+        SELECT variant_id, code, clnsig_primary, snv FROM ({clinvar_query(source, 'r.variant_id, r.code')})
+    ''')
+    save_clinvar_stats(conn, report_id, 'clinvar', schema)
+
+def ensure_clinvar_table(db_path, report_id):
+    """早期创建的报告没有ClinVar表，首次查询时生成"""
+    with write_lock(db_path):
+        conn = connect(db_path, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # file存储方式的ClinVar表在报告文件中，导入时已生成
+                if report_storage(conn, report_id) not in (None, 'file') and not conn.execute(
+                        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (clinvar_table(report_id),)).fetchone():
+                    build_clinvar_table(conn, report_id)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+def clinvar_statistics(conn, report_id, snv_only=True):
+    """:return: {clinvar_stats的列: 位点数, 'total': 总数}，没有统计时返回None"""
+    columns = [column for column, _ in CLINVAR_CATEGORIES] + ['total']
+    # file存储方式的统计在报告文件中，硬链接共用的文件中report_id为导入时的报告编号
+    schema = attach_report(conn, report_id) if isinstance(conn, Connection) else None
+    if schema is not None:
+        row = conn.execute(f'SELECT {", ".join(columns)} FROM "{schema}".clinvar_stats WHERE snv_only = ?',
+                           (int(snv_only),)).fetchone()
+        return {column: value or 0 for column, value in zip(columns, row)} if row is not None else None
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='clinvar_stats'").fetchone():
+        return None
+    row = conn.execute(f"SELECT {', '.join(columns)} FROM clinvar_stats WHERE report_id = ? AND snv_only = ?",
+                       (report_id, int(snv_only))).fetchone()
+    if row is None:
+        return None
+    return {column: value or 0 for column, value in zip(columns, row)}
+
+def migrate_clinvar_tables(db_path):
+    """
+    为早期创建的报告生成ClinVar表，每个报告在写锁内单独生成
+    :return: 生成ClinVar表的报告编号列表
+    """
+    conn = connect(db_path)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='reports'").fetchone():
+            return []
+        names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+        report_ids = [row[0] for row in conn.execute("SELECT report_id FROM reports")
+                      if row[0] in names and clinvar_table(row[0]) not in names]
+    finally:
+        conn.close()
+
+    for report_id in report_ids:
+        start = time.perf_counter()
+        ensure_clinvar_table(db_path, report_id)
+        print(f"报告 {report_id} 生成ClinVar表，耗时 {time.perf_counter() - start:.2f} 秒")
+    return report_ids
+
+def missing_report_indexes(conn, table_name, indexes=REPORT_INDEXES):
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=?", (table_name,))}
+    return [index for index in indexes if f'idx_{table_name}_{index[0]}' not in existing]
+
+def migrate_report_indexes(db_path):
+    """
+    为早期创建的报告表和variants表补建索引，已有的索引不重复创建
+    每张表在写锁内单独建立，不会长时间阻塞新报告的写入
+    :return: 补建索引的表名列表
+    """
+    conn = connect(db_path)
+    try:
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        columns = {name for _, name, _ in REPORT_COLUMNS}
+        targets = []
+        for table in tables:
+            if table == 'variants':
+                targets.append((table, VARIANT_INDEXES))
+            elif table.startswith('RPT_') and table.endswith('_clinvar'):
+                targets.append((table, CLINVAR_INDEXES))
+            elif table.startswith('RPT_') and columns <= {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}:
+                targets.append((table, REPORT_INDEXES))
+    finally:
+        conn.close()
+
+    migrated = []
+    for table, indexes in targets:
+        with write_lock(db_path):
+            conn = connect(db_path)
+            try:
+                missing = missing_report_indexes(conn, table, indexes)
+                if not missing:
+                    continue
+                start = time.perf_counter()
+                with conn:
+                    create_report_indexes(conn, table, missing)
+                    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+                    conn.execute(f'ANALYZE "{table}"')
+                migrated.append(table)
+                print(f"数据表 {table} 补建索引 {', '.join(suffix for suffix, _ in missing)}，耗时 {time.perf_counter() - start:.2f} 秒")
+            finally:
+                conn.close()
+    return migrated
+
+# API进程启动时在后台把旧报告转换为报告文件，未能转换的补建索引和ClinVar表，不阻塞启动
+def start_index_migration(db_path):
+    if not os.path.exists(db_path):
+        return None
+
+    def run():
+        try:
+            migrate_report_files(db_path)
+        except Exception as e:
+            print(f"旧报告转换为报告文件失败: {str(e)}")
+        try:
+            migrate_report_indexes(db_path)
+            migrate_clinvar_tables(db_path)
+        except Exception as e:
+            print(f"补建报告表索引失败: {str(e)}")
+
+    thread = threading.Thread(target=run, name='rootara_index_migration', daemon=True)
+    thread.start()
+    return thread
+
+def insert_rows(conn, insert_sql, rows, batch_size):
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return count
+        conn.executemany(insert_sql, batch)
+        count += len(batch)
+
+def stage_report_rows(conn, rows, batch_size):
+    """报告的行先写入临时表，不持有写锁"""
+    columns = ', '.join(f'"{column}" {sql_type}' for _, column, sql_type in REPORT_COLUMNS)
+    conn.execute('DROP TABLE IF EXISTS temp.report_load')
+    conn.execute(f'CREATE TEMP TABLE report_load ({columns})')
+    return insert_rows(conn, f'INSERT INTO temp.report_load VALUES ({", ".join("?" * len(REPORT_COLUMNS))})', rows, batch_size)
+
+def merge_variants(conn, db_path):
+    """
+    把临时表中的位点和基因型合并到共用的表，只在这一步持有主数据库的写锁
+    只写入新位点和注释变化的位点，核心库更新后同一位点的注释以最新写入的为准
+    """
+    variant_columns = ', '.join(VARIANT_COLUMNS)
+    annotations = [column for column in VARIANT_COLUMNS if column not in ('chromosome', 'position', 'ref', 'alt', 'rsid')]
+    with write_lock(db_path):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for sql in VARIANT_TABLES:
+                conn.execute(sql)
+            conn.execute(f'''
+                INSERT INTO main.variants ({variant_columns})
+                SELECT {variant_columns} FROM temp.report_load WHERE true
+                ON CONFLICT (chromosome, position, ref, alt, IFNULL(rsid, '')) DO UPDATE SET
+                    {", ".join(f"{column} = excluded.{column}" for column in annotations)}
+                WHERE {" OR ".join(f"{column} IS NOT excluded.{column}" for column in annotations)}
+            ''')
+            conn.execute('INSERT OR IGNORE INTO main.genotype_codes (genotype, gt) SELECT DISTINCT genotype, gt FROM temp.report_load')
+            # 第一个报告写入后再建立其他索引，排序建立比逐行维护快；之后每个报告只插入少量新位点
+            create_report_indexes(conn, 'variants', VARIANT_INDEXES)
+            # 连接视图时按统计信息选择连接顺序，否则按rsid查询时会先扫描整个报告
+            analyze_report(conn, 'variants')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+def insert_report_codes(conn, schema):
+    """
+    把临时表中的行编码为 (variant_id, 基因型编码) 写入报告文件，报告中重复的位点只保留第一行
+    :return: 写入的行数
+    """
+    cursor = conn.execute(f'''
+        INSERT OR IGNORE INTO "{schema}".snps (variant_id, code)
+        SELECT v.variant_id, c.code
+        FROM temp.report_load t
+        JOIN main.variants v ON v.chromosome = t.chromosome AND v.position = t.position AND v.ref = t.ref AND v.alt = t.alt
+                            AND IFNULL(v.rsid, '') = IFNULL(t.rsid, '')
+        JOIN main.genotype_codes c ON c.genotype IS t.genotype AND c.gt IS t.gt
+    ''')
+    return cursor.rowcount
+
+def bulk_load_rows(db_path, table_name, rows, if_exists='replace', batch_size=BATCH_SIZE):
+    """
+    写入报告文件，见load_report_file；旧报告先转换为报告文件，再替换或追加
+    :param db_path: SQLite数据库文件路径
+    :param table_name: 报告编号
+    :param rows: 按REPORT_COLUMNS顺序排列的元组迭代器
+    :param if_exists: 如果报告已存在，执行的操作：'replace'(替换)、'append'(追加)或'fail'(报错)
+    :param batch_size: 每批写入的行数
+    :return: {'rows': 行数, 'seconds': 耗时, 'rows_per_second': 每秒写入行数}
+    """
+    conn = connect(db_path)
+    try:
+        existing = report_storage(conn, table_name)
+    finally:
+        conn.close()
+    if existing is not None and if_exists == 'fail':
+        raise ValueError(f"数据表 {table_name} 已存在")
+    # 旧报告可能被其他报告引用，先转换（引用的报告硬链接转换前的数据），替换时不影响它们
+    # 保存完整行的报告文件追加前先转换，替换时直接替换
+    if existing in LEGACY_STORAGES or (existing == 'file' and if_exists == 'append'):
+        migrate_report_file(db_path, table_name)
+    return load_report_file(db_path, table_name, rows, if_exists, batch_size)
+
+def write_report_file(db_path, path, report_id, rows=None, batch_size=BATCH_SIZE, base=None, codes=None):
+    """
+    写入报告文件：先写入临时文件，完成后替换，已附加的连接在下次查询时重新附加
+    调用方需要持有报告文件的写锁
+    :param rows: 按REPORT_COLUMNS顺序排列的元组迭代器，新位点合并到共用的表
+    :param base: 追加时已有的报告文件，复制后再写入
+    :param codes: 主数据库中已编码的 (variant_id, code) 表，shared存储方式的旧报告直接复制，不需要rows
+    :return: 写入的行数
+    """
+    building = path + '.building'
+    if os.path.exists(building):
+        os.remove(building)
+    if base is not None:
+        shutil.copyfile(base, building)
+    conn = connect(db_path, isolation_level=None)
+    try:
+        conn.execute('ATTACH DATABASE ? AS building', (building,))
+        for pragma in INGEST_PRAGMAS:
+            conn.execute(pragma.format(schema='building'))
+        if codes is None:
+            stage_report_rows(conn, rows, batch_size)
+            merge_variants(conn, db_path)
+        # 只写入报告文件，不锁主数据库
+        conn.execute('BEGIN')
+        for sql in REPORT_FILE_SCHEMA:
+            conn.execute(sql.format(schema='building'))
+        if codes is None:
+            count = insert_report_codes(conn, 'building')
+        else:
+            count = conn.execute(
+                f'INSERT OR IGNORE INTO building.snps (variant_id, code) SELECT variant_id, code FROM main."{codes}"').rowcount
+        build_report_clinvar(conn, report_id, 'building')
+        analyze_report(conn, 'building')
+        conn.execute('COMMIT')
+        conn.execute('DETACH DATABASE building')
+    except Exception:
+        # 写入失败时保留原来的文件，已合并到共用表的位点不需要删除
+        conn.close()
+        if os.path.exists(building):
+            os.remove(building)
+        raise
+    conn.close()
+    os.replace(building, path)
+    return count
+
+def load_report_file(db_path, table_name, rows, if_exists='replace', batch_size=BATCH_SIZE):
+    """
+    写入报告自己的数据库文件，只在合并新位点时短暂持有主数据库的写锁，不阻塞其他报告的写入
+    参数与返回值同bulk_load_rows，旧报告需要先由migrate_report_file转换
+    """
+    path = report_db_path(db_path, table_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with write_lock(path):
+        start = time.perf_counter()
+        exists = os.path.exists(path)
+        if exists and if_exists == 'fail':
+            raise ValueError(f"数据表 {table_name} 已存在")
+        count = write_report_file(db_path, path, table_name, rows, batch_size,
+                                  base=path if exists and if_exists == 'append' else None)
+
+    seconds = time.perf_counter() - start
+    rows_per_second = count / seconds if seconds > 0 else 0
+    print(f"成功写入报告文件 '{path}'，共 {count} 行，耗时 {seconds:.2f} 秒，{rows_per_second:.0f} 行/秒")
+    return {'rows': count, 'seconds': seconds, 'rows_per_second': rows_per_second}
+
+def report_file_encoded(path):
+    """报告文件是否只保存 (variant_id, 基因型编码)，更早版本的报告文件保存完整的行"""
+    conn = connect(path)
+    try:
+        return any(row[1] == 'variant_id' for row in conn.execute('PRAGMA table_info(snps)'))
+    finally:
+        conn.close()
+
+def data_owner(conn, report_id):
+    """:return: (数据所属的报告编号, 通过视图引用它的报告编号列表)"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(reports)")}
+    if 'data_ref' not in columns:
+        return report_id, []
+    row = conn.execute("SELECT data_ref FROM reports WHERE report_id = ?", (report_id,)).fetchone()
+    owner = row[0] if row is not None and row[0] else report_id
+    dependents = [r[0] for r in conn.execute("SELECT report_id FROM reports WHERE data_ref = ?", (owner,))]
+    return owner, dependents
+
+def encode_report_file(db_path, report_id):
+    """
+    把保存完整行的报告文件转换为只保存编码，硬链接共用这个文件的报告一起替换
+    :return: 转换的报告编号列表，已转换或不存在时为空
+    """
+    start = time.perf_counter()
+    path = report_db_path(db_path, report_id)
+    columns = ', '.join(f'"{column}"' for _, column, _ in REPORT_COLUMNS)
+    with write_lock(path):
+        if not os.path.exists(path) or report_file_encoded(path):
+            return []
+        stat = os.stat(path)
+        directory = os.path.dirname(path)
+        links = [name for name in os.listdir(directory) if name.endswith('.db') and name != os.path.basename(path)
+                 and os.path.samestat(os.stat(os.path.join(directory, name)), stat)]
+        source = connect(path)
+        try:
+            count = write_report_file(db_path, path, report_id, source.execute(f'SELECT {columns} FROM snps'))
+        finally:
+            source.close()
+
+    linked = []
+    for name in links:
+        target = os.path.join(directory, name)
+        # 转换期间被替换的文件不再共用
+        if not os.path.exists(target) or not os.path.samestat(os.stat(target), stat):
+            continue
+        link_file(path, target + '.link')
+        os.replace(target + '.link', target)
+        linked.append(name[:-len('.db')])
+
+    migrated = [report_id] + linked
+    print(f"报告文件 {', '.join(migrated)} 转换为只保存编码，共 {count} 行，耗时 {time.perf_counter() - start:.2f} 秒")
+    return migrated
+
+def migrate_report_file(db_path, report_id):
+    """
+    把旧报告转换为报告文件，通过视图引用同一份数据的报告一起转换，硬链接数据所属报告的文件
+    先写入报告文件，再在写锁内删除主数据库中的数据，转换期间报告仍然可以读取
+    保存完整行的报告文件由encode_report_file转换
+    :return: 转换的报告编号列表，不需要转换时为空
+    """
+    conn = connect(db_path)
+    try:
+        owner, _ = data_owner(conn, report_id)
+        if report_storage(conn, owner) == 'file':
+            return encode_report_file(db_path, owner)
+    finally:
+        conn.close()
+
+    start = time.perf_counter()
+    path = report_db_path(db_path, owner)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    columns = ', '.join(f'"{column}"' for _, column, _ in REPORT_COLUMNS)
+    dependents = []
+    with write_lock(path):
+        # 持有报告文件的写锁后再检查，同时转换同一个报告时只转换一次
+        conn = connect(db_path)
+        try:
+            storage = report_storage(conn, owner)
+            if storage not in ('table', 'shared'):
+                return []
+            # shared存储方式的位点已在共用的表中，直接复制编码
+            if storage == 'shared':
+                count = write_report_file(db_path, path, owner, codes=genotype_table(owner))
+            else:
+                count = write_report_file(db_path, path, owner, conn.execute(f'SELECT {columns} FROM "{owner}"'))
+        except Exception:
+            # 旧报告的数据仍在主数据库中，不保留写了一半的报告文件
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        finally:
+            conn.close()
+
+        with write_lock(db_path):
+            conn = connect(db_path)
+            try:
+                with conn:
+                    # 报告文件写入期间报告被删除时，删除写入的文件
+                    if report_storage(conn, owner) != storage:
+                        os.remove(path)
+                        return []
+                    _, dependents = data_owner(conn, owner)
+                    for dependent in dependents:
+                        link_file(path, report_db_path(db_path, dependent))
+                        conn.execute(f'DROP VIEW IF EXISTS "{dependent}"')
+                        drop_clinvar_data(conn, dependent)
+                    drop_report_data(conn, owner)
+                    if dependents:
+                        conn.execute("UPDATE reports SET data_ref = NULL WHERE data_ref = ?", (owner,))
+            except Exception:
+                for dependent in dependents:
+                    remove_report_file(conn, dependent)
+                if os.path.exists(path):
+                    os.remove(path)
+                raise
+            finally:
+                conn.close()
+
+    migrated = [owner] + dependents
+    print(f"旧报告 {', '.join(migrated)} 转换为报告文件，共 {count} 行，耗时 {time.perf_counter() - start:.2f} 秒")
+    return migrated
+
+def migrate_report_files(db_path):
+    """
+    把所有旧报告和保存完整行的报告文件转换为只保存编码的报告文件，每个报告单独转换
+    共用的variants、genotype_codes表保留，报告文件依赖它们
+    :return: 转换的报告编号列表
+    """
+    conn = connect(db_path)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='reports'").fetchone():
+            return []
+        report_ids = [row[0] for row in conn.execute("SELECT report_id FROM reports ORDER BY upload_date")
+                      if report_storage(conn, row[0]) in ('table', 'shared', 'file')]
+    finally:
+        conn.close()
+
+    migrated = []
+    for report_id in report_ids:
+        if report_id in migrated:
+            continue
+        migrated.extend(migrate_report_file(db_path, report_id))
+    return migrated
+
 def dataframe_to_sqlite(df, db_path, table_name, if_exists='replace'):
     """
     将Pandas DataFrame转换为SQLite表
-    
+
     :param df: Pandas DataFrame对象
     :param db_path: SQLite数据库文件路径
     :param table_name: 要创建的表名
@@ -20,71 +712,52 @@ def dataframe_to_sqlite(df, db_path, table_name, if_exists='replace'):
     :return: 成功返回True，失败返回False
     """
     try:
-        # 连接到数据库
-        conn = sqlite3.connect(db_path)
-        
-        # 重命名DataFrame的列以匹配数据库表结构
-        df_renamed = df.rename(columns={
-            'Chrom': 'chromosome',
-            'Start': 'position',
-            'Ref': 'ref',
-            'Alt': 'alt',
-            'RSID': 'rsid',
-            'gnomAD_AF': 'gnomAD_AF',
-            'Gene': 'gene',
-            'CLNSIG': 'clnsig',
-            'CLNDN': 'clndn',
-            'Genotype': 'genotype',
-            'Check': 'gt'
-        })
-        
-        # 使用pandas的to_sql方法直接将DataFrame写入数据库
-        # 设置index=False避免写入DataFrame的索引列
-        df_renamed.to_sql(
-            name=table_name,
-            con=conn,
-            if_exists=if_exists,
-            index=False,
-            dtype={
-                'chromosome': 'TEXT',
-                'position': 'INTEGER',
-                'ref': 'TEXT',
-                'alt': 'TEXT',
-                'rsid': 'TEXT',
-                'gnomAD_AF': 'FLOAT',
-                'gene': 'TEXT',
-                'clnsig': 'TEXT',
-                'clndn': 'TEXT',
-                'genotype': 'TEXT',
-                'gt': 'TEXT'
-            }
-        )
-        
-        conn.close()
-        
-        print(f"成功将DataFrame转换为SQLite表 '{table_name}'，共 {len(df)} 行")
+        bulk_load_rows(db_path, table_name, iter_dataframe_rows(df), if_exists)
         return True
-    
     except Exception as e:
         print(f"将DataFrame转换为SQLite表失败: {e}")
         return False
 
-# 流程
+# 流程，file_path为转换结果的列存储目录或CSV文件
 def csv_to_sqlite(file_path, db_path, table_name, force=False):
-    df = convert_data_to_df(file_path)
+    """
+    :param force: 是否替换已存在的报告
+    :return: 写入的统计（见bulk_load_rows），报告已存在且force为False时不写入，返回False
+    """
     if_exists = 'fail'
     if force:
         if_exists = 'replace'
-    dataframe_to_sqlite(df, db_path, table_name, if_exists)
+    else:
+        conn = connect(db_path)
+        try:
+            exists = report_data_exists(conn, table_name)
+        finally:
+            conn.close()
+        if exists:
+            print(f"数据表 {table_name} 已存在，未写入")
+            return False
+    df = convert_data_to_df(file_path)
+    return bulk_load_rows(db_path, table_name, iter_dataframe_rows(df), if_exists)
 
 def main():
     parser = argparse.ArgumentParser(description='将Rootara CSV转换为SQLite数据库')
-    parser.add_argument('--input', type=str, help='输入CSV文件路径')
+    parser.add_argument('--input', type=str, help='输入CSV文件或列存储目录路径')
     parser.add_argument('--db', type=str, help='输出数据库文件路径')
     parser.add_argument('--id', type=str, help='数据表名称')
     parser.add_argument('--force', type=bool, help='是否强制覆盖已存在的数据表，默认False', default=False)
+    parser.add_argument('--migrate-indexes', action='store_true', help='为已有的报告表补建索引和ClinVar表，只需要--db')
+    parser.add_argument('--migrate-files', action='store_true', help='把保存在主数据库中的旧报告转换为报告文件，只需要--db')
     args = parser.parse_args()
 
+    if args.migrate_files and args.db:
+        migrate_report_files(args.db)
+        return
+
+    if args.migrate_indexes and args.db:
+        migrate_report_indexes(args.db)
+        migrate_clinvar_tables(args.db)
+        return
+
     # 检查是否提供了所有必需参数
     if not all([args.input, args.db, args.id]):
         parser.print_help()
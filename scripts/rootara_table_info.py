@@ -1,17 +1,28 @@
 # coding=utf-8
 # pzw
 # 单个表格的信息查询和处理
-import sqlite3
+import os
+import sys
+
+# 根据脚本运行方式选择合适的导入路径
+if __name__ == "__main__":
+    # 将项目根目录添加到模块搜索路径
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import get_connection, table_exists, table_columns
+    from scripts.rootara_snp_2_db import clinvar_table, ensure_clinvar_table, clinvar_statistics
+else:
+    # 作为模块导入时使用相对导入
+    from scripts.rootara_db import get_connection, table_exists, table_columns
+    from scripts.rootara_snp_2_db import clinvar_table, ensure_clinvar_table, clinvar_statistics
 
 # 根据RSID查询若干个SNP的信息
 def get_snp_info_by_rsid(rsid_list, report_id, db_path, concise=False):
-    # 连接到数据库
-    conn = sqlite3.connect(db_path)
+    # 使用当前线程复用的连接
+    conn = get_connection(db_path)
     cursor = conn.cursor()
     
     # 检查表是否存在
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (report_id,))
-    if not cursor.fetchone():
+    if not table_exists(db_path, report_id):
         # 表不存在时返回空结果
         empty_result = {}
         for rsid in rsid_list:
@@ -28,7 +39,6 @@ def get_snp_info_by_rsid(rsid_list, report_id, db_path, concise=False):
                 'genotype': None,
                 'check': None
             }
-        conn.close()
         return empty_result
     
     # 创建结果字典
@@ -64,8 +74,6 @@ def get_snp_info_by_rsid(rsid_list, report_id, db_path, concise=False):
             }
             concise_dict[rsid] = [None, None]
     
-    # 关闭数据库连接
-    conn.close()
     if concise:
         return concise_dict
     return result_dict
@@ -73,13 +81,12 @@ def get_snp_info_by_rsid(rsid_list, report_id, db_path, concise=False):
 # 根据chromosome position ref alt查询若干个SNP的信息
 # 这个输入是一个这样的列表[(chromosome, position, ref, alt), (chromosome, position, ref, alt)]
 def get_snp_info_by_chromosome_position_ref_alt(query_list, report_id, db_path):
-    # 连接到数据库
-    conn = sqlite3.connect(db_path)
+    # 使用当前线程复用的连接
+    conn = get_connection(db_path)
     cursor = conn.cursor()
 
     # 检查表是否存在
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (report_id,))
-    if not cursor.fetchone():
+    if not table_exists(db_path, report_id):
         # 表不存在时返回空结果
         empty_result = {}
         for query in query_list:
@@ -97,7 +104,6 @@ def get_snp_info_by_chromosome_position_ref_alt(query_list, report_id, db_path):
                 'genotype': None,
                 'check': None
             }
-        conn.close()
         return empty_result
 
     # 创建结果字典
@@ -132,8 +138,6 @@ def get_snp_info_by_chromosome_position_ref_alt(query_list, report_id, db_path):
                 'check': None
             }
 
-    # 关闭数据库连接
-    conn.close()
     return result_dict
 
 # 整张表的信息输出，表格很大，使用懒惰加载方式处理，支持前端表格展示、搜索和筛选
@@ -148,13 +152,12 @@ def get_all_snp_info(report_id, db_path, page_size=1000, page=1, sort_by="", sor
     if filters == {}:
         filters = None
     
-    # 连接到数据库
-    conn = sqlite3.connect(db_path)
+    # 使用当前线程复用的连接
+    conn = get_connection(db_path)
     cursor = conn.cursor()
 
     # 检查表是否存在
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (report_id,))
-    if not cursor.fetchone():
+    if not table_exists(db_path, report_id):
         # 表不存在时返回空结果
         empty_result = {
             "data": {},
@@ -166,13 +169,10 @@ def get_all_snp_info(report_id, db_path, page_size=1000, page=1, sort_by="", sor
                 "total_pages": 0
             }
         }
-        conn.close()
         return empty_result
     
     # 获取表的列信息
-    cursor.execute(f"PRAGMA table_info({report_id})")
-    columns_info = cursor.fetchall()
-    columns = [col[1] for col in columns_info]
+    columns = table_columns(db_path, report_id)
     
     # 构建基本查询
     base_query = f"FROM {report_id}"
@@ -252,12 +252,11 @@ def get_all_snp_info(report_id, db_path, page_size=1000, page=1, sort_by="", sor
         snp_dict = dict(zip(column_names, row))
         result["data"][snp_dict['rsid']] = snp_dict
     
-    # 关闭数据库连接
-    conn.close()
     return result
 
 # Clinvar表 || 看看能不能在前端实现，不一定要用这个函数
 # 改造后的Clinvar表函数，支持分页、排序和搜索，并增加致病性分类统计
+# 数据来自导入时生成的ClinVar表（clnsig_primary为clnsig的第一个分类，snv为0时是插入缺失），统计来自clinvar_stats表
 def get_clinvar_data(report_id, db_path, sort_by="", sort_order='asc', 
                      search_term="", filters={}, indel=False):
     
@@ -268,14 +267,9 @@ def get_clinvar_data(report_id, db_path, sort_by="", sort_order='asc',
         search_term = None
     if filters == {}:
         filters = None
-    
-    # 连接到数据库
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
 
     # 检查表是否存在
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (report_id,))
-    if not cursor.fetchone():
+    if not table_exists(db_path, report_id):
         # 表不存在时返回空结果
         empty_result = {
             "data": {},
@@ -288,68 +282,28 @@ def get_clinvar_data(report_id, db_path, sort_by="", sort_order='asc',
                 "benign": 0
             }
         }
-        conn.close()
         return empty_result
-    
-    # 获取表的列信息
-    cursor.execute(f"PRAGMA table_info({report_id})")
-    columns_info = cursor.fetchall()
-    columns = [col[1] for col in columns_info]
-    
-    # 构建基本查询条件
-    base_conditions = []
-    base_params = []
-    
-    # 基础条件：gt不是. 和 null 还有WT
-    base_conditions.append("gt!= '.' AND gt IS NOT NULL AND gt!='WT'")
 
-    # 基础条件：clndn不是 . 和 null
-    base_conditions.append("clndn != '.' AND clndn IS NOT NULL")
-    
-    # 基础条件：clnsig不是Conflicting_classifications_of_pathogenicity或null
-    base_conditions.append("clnsig != 'Conflicting_classifications_of_pathogenicity' AND clnsig IS NOT NULL")
-    
-    # 基础条件：处理clnsig中包含'/'的情况，取第一个值为准
-    clnsig_condition = """
-    (CASE
-        WHEN INSTR(clnsig, '/') > 0 THEN
-            CASE
-                WHEN SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Pathogenic' THEN 1
-                WHEN SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Likely_pathogenic' THEN 1
-                WHEN SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Benign' THEN 1
-                WHEN SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Likely_benign' THEN 1
-                WHEN SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Uncertain_significance' THEN 1
-                ELSE 0
-            END
-        ELSE
-            CASE
-                WHEN clnsig = 'Pathogenic' THEN 1
-                WHEN clnsig = 'Likely_pathogenic' THEN 1
-                WHEN clnsig = 'Benign' THEN 1
-                WHEN clnsig = 'Likely_benign' THEN 1
-                WHEN clnsig = 'Uncertain_significance' THEN 1
-                ELSE 0
-            END
-    END) = 1
-    """
-    base_conditions.append(clnsig_condition)
-    
-    # 基础条件：只取特定clnsig值的行
-    base_conditions.append("(clnsig='Pathogenic' OR clnsig='Likely_pathogenic' OR clnsig='Benign' OR clnsig='Likely_benign' OR clnsig='Uncertain_significance' OR clnsig LIKE '%/%')")
-    
-    # 基础条件：处理indel参数
-    if indel is False:
-        base_conditions.append("(ref!='I' AND ref!='D' AND alt!='I' AND alt!='D')")
-    
-    # 构建基本查询
-    base_where = " WHERE " + " AND ".join(base_conditions)
-    base_query = f"FROM {report_id}{base_where}"
-    count_query = f"SELECT COUNT(*) {base_query}"
-    data_query = f"SELECT * {base_query}"
+    # 早期创建的报告没有ClinVar表，首次查询时生成
+    table = clinvar_table(report_id)
+    if not table_exists(db_path, table):
+        ensure_clinvar_table(db_path, report_id)
+
+    # 使用当前线程复用的连接
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+
+    # 返回报告表的列，可以按clnsig_primary筛选
+    columns = table_columns(db_path, report_id)
+    filter_columns = columns + ['clnsig_primary']
     
-    # 构建额外的WHERE子句（用户搜索和筛选）
+    # 构建WHERE子句（插入缺失、用户搜索和筛选）
     where_clauses = []
-    query_params = list(base_params)  # 复制基础参数列表
+    query_params = []
+
+    # 处理indel参数
+    if indel is False:
+        where_clauses.append("snv = 1")
     
     # 添加搜索条件 - 完美匹配
     if search_term:
@@ -364,7 +318,7 @@ def get_clinvar_data(report_id, db_path, sort_by="", sort_order='asc',
     # 添加筛选条件
     if filters and isinstance(filters, dict):
         for col, value in filters.items():
-            if col in columns:
+            if col in filter_columns:
                 if isinstance(value, list):
                     # 处理多选筛选
                     placeholders = ', '.join(['?'] * len(value))
@@ -375,20 +329,27 @@ def get_clinvar_data(report_id, db_path, sort_by="", sort_order='asc',
                     where_clauses.append(f"{col} = ?")
                     query_params.append(value)
     
-    # 组合额外的WHERE子句
+    base_query = f'FROM "{table}"'
     if where_clauses:
-        extra_where = " AND " + " AND ".join(where_clauses)
-        count_query += extra_where
-        data_query += extra_where
+        base_query += " WHERE " + " AND ".join(where_clauses)
+    data_query = f"SELECT {', '.join(columns)} {base_query}"
     
     # 添加排序
     if sort_by and sort_by in columns:
         sort_direction = "DESC" if sort_order.lower() == 'desc' else "ASC"
         data_query += f" ORDER BY {sort_by} {sort_direction}"
-    
-    # 计算总记录数（考虑筛选条件）
-    cursor.execute(count_query, query_params)
-    total_count = cursor.fetchone()[0]
+
+    # 统计不包含用户的搜索和筛选条件
+    statistics = clinvar_statistics(conn, report_id, snv_only=not indel)
+    if statistics is None:
+        statistics = dict.fromkeys(["pathogenic", "likely_pathogenic", "benign", "likely_benign", "uncertain_significance", "total"], 0)
+    
+    # 计算总记录数（考虑筛选条件），没有搜索和筛选时与统计的总数相同
+    if search_term or filters:
+        cursor.execute(f"SELECT COUNT(*) {base_query}", query_params)
+        total_count = cursor.fetchone()[0]
+    else:
+        total_count = statistics["total"]
     
     # 执行查询 - 不再使用分页限制，返回所有数据
     cursor.execute(data_query, query_params)
@@ -402,65 +363,18 @@ def get_clinvar_data(report_id, db_path, sort_by="", sort_order='asc',
         "columns": column_names,
         "total": total_count,  # 保留总记录数信息
         "statistics": {
-            "pathogenic": 0,
-            "likely_pathogenic": 0,
-            "uncertain_significance": 0,
-            "likely_benign": 0,
-            "benign": 0
+            "pathogenic": statistics["pathogenic"],
+            "likely_pathogenic": statistics["likely_pathogenic"],
+            "benign": statistics["benign"],
+            "likely_benign": statistics["likely_benign"],
+            "uncertain_significance": statistics["uncertain_significance"]
         }
     }
     
     # 使用迭代器处理查询结果，避免一次性加载所有数据到内存
     for row in cursor:
         snp_dict = dict(zip(column_names, row))
-        
-        # 处理clnsig字段，确定致病性分类
-        clnsig = snp_dict.get('clnsig', '')
-        if '/' in clnsig:
-            # 如果有多个分类，取第一个
-            primary_clnsig = clnsig.split('/')[0]
-        else:
-            primary_clnsig = clnsig
-            
-        # 根据优先级顺序更新统计数据
-        if primary_clnsig == 'Pathogenic':
-            result["statistics"]["pathogenic"] += 1
-        elif primary_clnsig == 'Likely_pathogenic':
-            result["statistics"]["likely_pathogenic"] += 1
-        elif primary_clnsig == 'Benign':
-            result["statistics"]["benign"] += 1
-        elif primary_clnsig == 'Likely_benign':
-            result["statistics"]["likely_benign"] += 1
-        elif primary_clnsig == 'Uncertain_significance':
-            result["statistics"]["uncertain_significance"] += 1
-            
         # 将数据添加到结果集
         result["data"][snp_dict.get('id', '') or snp_dict.get('rsid', '')] = snp_dict
     
-    # 获取完整的统计数据
-    stats_query = f"""
-    SELECT 
-        SUM(CASE WHEN (INSTR(clnsig, '/') > 0 AND SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Pathogenic') OR clnsig = 'Pathogenic' THEN 1 ELSE 0 END) as pathogenic,
-        SUM(CASE WHEN (INSTR(clnsig, '/') > 0 AND SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Likely_pathogenic') OR clnsig = 'Likely_pathogenic' THEN 1 ELSE 0 END) as likely_pathogenic,
-        SUM(CASE WHEN (INSTR(clnsig, '/') > 0 AND SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Benign') OR clnsig = 'Benign' THEN 1 ELSE 0 END) as benign,
-        SUM(CASE WHEN (INSTR(clnsig, '/') > 0 AND SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Likely_benign') OR clnsig = 'Likely_benign' THEN 1 ELSE 0 END) as likely_benign,
-        SUM(CASE WHEN (INSTR(clnsig, '/') > 0 AND SUBSTR(clnsig, 1, INSTR(clnsig, '/') - 1) = 'Uncertain_significance') OR clnsig = 'Uncertain_significance' THEN 1 ELSE 0 END) as uncertain_significance
-    {base_query}
-    """
-    
-    # 不添加用户筛选条件，直接执行查询
-    cursor.execute(stats_query, base_params)  # 只使用基础参数，不包含用户筛选条件
-    stats = cursor.fetchone()
-    
-    if stats:
-        result["statistics"] = {
-            "pathogenic": stats[0] or 0,
-            "likely_pathogenic": stats[1] or 0,
-            "benign": stats[2] or 0,
-            "likely_benign": stats[3] or 0,
-            "uncertain_significance": stats[4] or 0
-        }
-    
-    # 关闭数据库连接
-    conn.close()
     return result
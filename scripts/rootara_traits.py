@@ -36,16 +36,19 @@ import sys
 from datetime import datetime
 import random
 import json
-import sqlite3
 
 # 根据脚本运行方式选择合适的导入路径
 if __name__ == "__main__":
     # 将项目根目录添加到模块搜索路径
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from scripts.rootara_db import get_connection, transaction
     from scripts.rootara_table_info import get_snp_info_by_rsid
+    from scripts.rootara_genotype_store import open_packed_genotypes
 else:
     # 作为模块导入时使用相对导入
+    from scripts.rootara_db import get_connection, transaction
     from scripts.rootara_table_info import get_snp_info_by_rsid
+    from scripts.rootara_genotype_store import open_packed_genotypes
 
 # 随机ID
 def generate_random_id():
@@ -63,10 +66,6 @@ def generate_random_id():
 # data的格式与json的相同
 # 在main中设定data的格式
 def add_trait(data, db_path, add_mode=True):
-    # 连接到SQLite数据库
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
     # 这个data是一个json格式
     print('Process: ', data)
 
@@ -103,42 +102,35 @@ def add_trait(data, db_path, add_mode=True):
     reference = ";".join(data['reference'])
 
     # 插入数据
-    cursor.execute('''
-    INSERT INTO traits (id, name, description, icon, confidence, isDefault, createdAt, category, rsids, formula, scoreThresholds, result, reference)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (id, name, description, icon, confidence, is_default, created_at, category, rsids, formula, score_thresholds, result, reference))
-
-    conn.commit()
-    conn.close()
+    with transaction(db_path) as conn:
+        conn.execute('''
+        INSERT INTO traits (id, name, description, icon, confidence, isDefault, createdAt, category, rsids, formula, scoreThresholds, result, reference)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (id, name, description, icon, confidence, is_default, created_at, category, rsids, formula, score_thresholds, result, reference))
 
 # 转换默认json为默认特征表，用于初始化数据
 def json_to_trait_table(json_file, db_path):
     data = json.load(open(json_file, 'r', encoding='utf-8'))
 
-    # 连接到SQLite数据库
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
     # 创建特征表 || 这个表暂时不考虑拆分用户的特征，不过可以将用户ID作为保留字段
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS traits (
-        id TEXT PRIMARY KEY,
-        name TEXT,
-        description TEXT,
-        icon TEXT,
-        confidence TEXT,
-        isDefault BOOLEAN,
-        createdAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        category TEXT,
-        rsids TEXT,
-        formula TEXT,
-        scoreThresholds TEXT,
-        result TEXT,
-        reference TEXT
-    )
-    ''')
-    conn.commit()
-    conn.close()
+    with transaction(db_path) as conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS traits (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            icon TEXT,
+            confidence TEXT,
+            isDefault BOOLEAN,
+            createdAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            category TEXT,
+            rsids TEXT,
+            formula TEXT,
+            scoreThresholds TEXT,
+            result TEXT,
+            reference TEXT
+        )
+        ''')
 
     # 遍历JSON数据，插入特征数据
     for item in data:
@@ -149,18 +141,11 @@ def delete_trait(id, db_path):
     if not id.startswith('TRA_'):
         return
 
-    # 连接到SQLite数据库
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # 删除数据
-    cursor.execute('''
-    DELETE FROM traits WHERE id = ?
-    ''', (id,))
-
-    # 提交更改并关闭连接
-    conn.commit()
-    conn.close()
+    # 删除数据，结束时提交
+    with transaction(db_path) as conn:
+        conn.execute('''
+        DELETE FROM traits WHERE id = ?
+        ''', (id,))
 
 # 导入自定义特征
 def self_json_to_trait_table(data, db_path):
@@ -175,8 +160,8 @@ def self_json_to_trait_table(data, db_path):
 # 导出自定义特征
 def self_traits_to_json(db_path):
     # 将特征表处理为一个字典格式
-    # 连接到SQLite数据库
-    conn = sqlite3.connect(db_path)
+    # 使用当前线程复用的连接
+    conn = get_connection(db_path)
     cursor = conn.cursor()
 
     # 查询数据 ||  WHERE isDefault = 0
@@ -185,9 +170,6 @@ def self_traits_to_json(db_path):
     ''')
     rows = cursor.fetchall()
 
-    # 关闭连接
-    conn.close()
-
     # 转换为字典格式
     traits = []
     for row in rows:
@@ -449,11 +431,25 @@ def _find_matching_brace(text, start_index):
                 return i
     return -1
 
+# 读取特征用到的RSID的基因型，优先使用压缩的基因型，未启用或不可用时查询报告表
+def trait_genotypes(rsids, report_id, db_path):
+    """:return: {RSID: 基因型}，报告中没有的RSID为None"""
+    packed = open_packed_genotypes(report_id)
+    if packed is None:
+        rsid_result = get_snp_info_by_rsid(rsids, report_id, db_path, True)
+        return {rsid: rsid_result[rsid][1] for rsid in rsid_result}
+    genotype_dict = {rsid: None for rsid in rsids}
+    # 同一RSID有多个位点时与查询报告表一样取第一个，空的基因型与报告表中的NULL一样为None
+    for rsid, genotype in zip(*packed.rsid_genotypes(rsids)):
+        if genotype_dict[rsid] is None:
+            genotype_dict[rsid] = genotype or None
+    return genotype_dict
+
 # 获取当前特征表结果
 def result_trait_data(report_id, db_path):
     # 将特征表处理为一个字典格式
-    # 连接到SQLite数据库
-    conn = sqlite3.connect(db_path)
+    # 使用当前线程复用的连接
+    conn = get_connection(db_path)
     cursor = conn.cursor()
 
     # 查询数据
@@ -462,9 +458,6 @@ def result_trait_data(report_id, db_path):
     ''')
     rows = cursor.fetchall()
 
-    # 关闭连接
-    conn.close()
-
     # 转换为字典格式
     traits = []
     for row in rows:
@@ -502,10 +495,7 @@ def result_trait_data(report_id, db_path):
     for item in traits:
         rsids.extend(item['rsids'])
     rsids = list(set(rsids))
-    rsid_result = get_snp_info_by_rsid(rsids, report_id, db_path, True)
-    rsid_gt_result = {}
-    for i in rsid_result:
-        rsid_gt_result[i] = rsid_result[i][1]
+    rsid_gt_result = trait_genotypes(rsids, report_id, db_path)
 
     for item in traits:
         # 计算得分或布尔值
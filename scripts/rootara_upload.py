@@ -0,0 +1,131 @@
+# coding=utf-8
+# pzw
+# 流式上传原始数据
+# 直接解析multipart请求体，将文件部分边接收边写入/data下的暂存文件
+# 不在内存中保存整个文件，也不经过框架自己的临时文件
+
+import os
+import uuid
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import FormParserError
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import FormParserError
+
+# 上传文件的暂存目录
+UPLOAD_DIR = '/data/temp/upload'
+
+# 普通表单字段的最大长度
+MAX_FIELD_SIZE = 64 * 1024
+
+class UploadError(Exception):
+    """上传请求格式不正确"""
+    pass
+
+def new_spool_path(source_from='raw', spool_dir=UPLOAD_DIR):
+    """
+    生成暂存文件路径
+    :param source_from: 数据来源，写入文件名中便于排查
+    :param spool_dir: 暂存目录
+    :return: 暂存文件路径
+    """
+    if not os.path.exists(spool_dir):
+        os.makedirs(spool_dir, exist_ok=True)
+    return os.path.join(spool_dir, f'{uuid.uuid4().hex}.{source_from}.txt')
+
+async def spool_multipart_upload(request, file_field='file', spool_dir=UPLOAD_DIR):
+    """
+    解析multipart/form-data请求，文件字段写入暂存文件
+    :param request: starlette的Request对象
+    :param file_field: 文件字段名称
+    :param spool_dir: 暂存目录
+    :return: (表单字段字典, 暂存文件路径)
+    """
+    content_type, params = parse_options_header(request.headers.get('content-type', ''))
+    if content_type != b'multipart/form-data' or b'boundary' not in params:
+        raise UploadError("请求必须是multipart/form-data格式")
+
+    fields = {}
+    spool_path = new_spool_path(spool_dir=spool_dir)
+    spool_file = None
+    state = {'headers': {}, 'field': b'', 'value': b'', 'name': None, 'is_file': False, 'data': bytearray(), 'ended': False}
+
+    def on_part_begin():
+        state['headers'] = {}
+        state['name'] = None
+        state['is_file'] = False
+        state['data'] = bytearray()
+
+    def on_header_field(data, start, end):
+        state['field'] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state['value'] += data[start:end]
+
+    def on_header_end():
+        state['headers'][state['field'].lower()] = state['value']
+        state['field'] = b''
+        state['value'] = b''
+
+    def on_headers_finished():
+        nonlocal spool_file
+        _, disposition = parse_options_header(state['headers'].get(b'content-disposition', b''))
+        state['name'] = disposition.get(b'name', b'').decode('utf-8')
+        state['is_file'] = state['name'] == file_field
+        if state['is_file']:
+            if spool_file is not None:
+                raise UploadError("只能上传一个文件")
+            spool_file = open(spool_path, 'wb')
+
+    def on_part_data(data, start, end):
+        if state['is_file']:
+            spool_file.write(data[start:end])
+        else:
+            state['data'] += data[start:end]
+            if len(state['data']) > MAX_FIELD_SIZE:
+                raise UploadError(f"表单字段 {state['name']} 过长")
+
+    def on_part_end():
+        if not state['is_file'] and state['name']:
+            fields[state['name']] = state['data'].decode('utf-8')
+
+    def on_end():
+        state['ended'] = True
+
+    parser = MultipartParser(params[b'boundary'], {
+        'on_part_begin': on_part_begin,
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+        'on_headers_finished': on_headers_finished,
+        'on_part_data': on_part_data,
+        'on_part_end': on_part_end,
+        'on_end': on_end,
+    })
+
+    try:
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+            parser.finalize()
+        except FormParserError as e:
+            # 请求体格式错误时python-multipart抛出自己的异常，转换为UploadError返回400
+            raise UploadError(f"multipart请求体格式错误: {str(e)}") from e
+        except UnicodeDecodeError as e:
+            raise UploadError(f"表单字段 {state['name']} 不是UTF-8编码") from e
+        # finalize不检查结束边界，请求体被截断时没有on_end回调
+        if not state['ended']:
+            raise UploadError("multipart请求体不完整，缺少结束边界")
+        if spool_file is None:
+            raise UploadError(f"缺少文件字段: {file_field}")
+    except Exception:
+        if spool_file is not None:
+            spool_file.close()
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+        raise
+    spool_file.close()
+
+    return fields, spool_path